@@ -0,0 +1,120 @@
+"""
+    Activity gate: lets the encoder skip frames in which nothing moves.
+
+    Every frame is compared with the one before it on a grid of every
+    downsample-th pixel in both directions (1/64 of the pixels by default,
+    one vectorized absolute difference for a whole batch of frames). The
+    activity of a frame is the share of grid pixels that changed by more than
+    pixel_threshold (in 8 bit units, scaled for 12 bit frames).
+
+    Hysteresis: the gate opens as soon as the activity is above on_fraction and
+    closes only after hold_frames frames in a row below off_fraction. While it
+    is closed, only every idle_keep_every-th frame is kept (0: none), so long
+    quiet periods cost almost no encoder CPU and disk.
+
+    A kept frame keeps its grab index and timestamps in the sidecar, so the
+    timing of the recording can be rebuilt; the frames skipped by the gate are
+    counted separately from dropped frames (see frame_sidecar.py).
+
+    Run this file to measure it on synthetic frames:
+    python activity_gate.py [width] [height]
+"""
+
+import numpy as np
+
+class ActivityGate:
+    """ Decides per frame whether it is encoded (see above). One instance per camera,
+    frames have to be passed in order."""
+
+    def __init__(self, downsample=8, pixel_threshold=12, on_fraction=0.0005, off_fraction=0.0002, hold_frames=60, idle_keep_every=30):
+        if off_fraction > on_fraction:
+            raise ValueError("The activity gate needs off_fraction <= on_fraction.")
+        self.downsample = downsample
+        self.pixel_threshold = pixel_threshold
+        self.on_fraction = on_fraction
+        self.off_fraction = off_fraction
+        self.hold_frames = hold_frames
+        self.idle_keep_every = idle_keep_every
+        self.prev = None # downsampled last frame
+        self.active = True # the start of a recording is kept
+        self.quiet = 0 # frames in a row below off_fraction
+        self.idle = 0 # frames since the gate closed
+        self.frames_seen = 0
+        self.frames_kept = 0
+        self.periods = 0 # times the gate opened
+
+    def activity(self, frames):
+        """ Share of changed grid pixels per frame (the first frame ever counts as fully changed)."""
+        d = self.downsample
+        small = np.stack([f[::d, ::d] for f in frames]).astype(np.int16)
+        threshold = self.pixel_threshold * (16 if frames[0].dtype.itemsize > 1 else 1) # 12 bit values
+        prev = small[:1] if self.prev is None else self.prev[None]
+        changed = np.abs(np.diff(np.concatenate((prev, small)), axis=0)) > threshold
+        result = changed.mean(axis=(1, 2))
+        if self.prev is None:
+            result[0] = 1.0
+        self.prev = small[-1]
+        return result
+
+    def select(self, frames):
+        """ Boolean mask of the frames to keep."""
+        keep = np.zeros(len(frames), dtype=bool)
+        if not len(frames):
+            return keep
+        for i, a in enumerate(self.activity(frames)):
+            if a > self.on_fraction:
+                if not self.active:
+                    self.periods += 1
+                self.active = True
+                self.quiet = 0
+            elif self.active and a < self.off_fraction:
+                self.quiet += 1
+                if self.quiet >= self.hold_frames:
+                    self.active = False
+                    self.idle = 0
+            if self.active:
+                keep[i] = True
+            else:
+                keep[i] = bool(self.idle_keep_every) and self.idle % self.idle_keep_every == 0
+                self.idle += 1
+        self.frames_seen += len(frames)
+        self.frames_kept += int(keep.sum())
+        return keep
+
+    def report(self):
+        return {"frames_seen": self.frames_seen, "frames_kept": self.frames_kept, "periods": self.periods}
+
+    def report_str(self):
+        return "activity gate kept {} of {} frames ({:.0%}), {} active period(s) after the start".format(
+            self.frames_kept, self.frames_seen, self.frames_kept / self.frames_seen if self.frames_seen else 0, self.periods)
+
+def bench_activity_gate(size=(1936, 1216), n=900, batch=8):
+    """ A static noisy scene with a moving square in the middle third of the frames:
+    prints what the gate keeps and its time per frame."""
+    import time
+    rng = np.random.default_rng(0)
+    scene = np.tile(np.linspace(0, 200, size[0], dtype=np.uint8), (size[1], 1))
+    noise = [np.clip(scene + rng.integers(0, 8, scene.shape, dtype=np.uint8), 0, 255).astype(np.uint8) for _ in range(4)]
+    frames = []
+    for i in range(n):
+        f = noise[i % 4].copy()
+        if n // 3 <= i < 2 * n // 3:
+            x = (i * 8) % (size[0] - 100)
+            f[size[1] // 2:size[1] // 2 + 100, x:x + 100] = 255
+        frames.append(f)
+    gate = ActivityGate()
+    keep = []
+    t0 = time.perf_counter()
+    for i in range(0, n, batch):
+        keep.append(gate.select(frames[i:i + batch]))
+    t = (time.perf_counter() - t0) / n
+    keep = np.concatenate(keep)
+    moving = np.zeros(n, dtype=bool)
+    moving[n // 3:2 * n // 3] = True
+    print("{}x{}: {:.2f} ms/frame; {}; all {} frames with movement kept: {}".format(
+        size[0], size[1], t * 1e3, gate.report_str(), int(moving.sum()), bool(keep[moving].all())))
+
+if __name__ == '__main__':
+    import sys
+    size = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (1936, 1216)
+    bench_activity_gate(size)
@@ -0,0 +1,315 @@
+"""
+    Random access to the recorded videos, the counterpart of FFMPEG_VideoWriter
+    in b_record_to_vid.py.
+
+    On the first open of a video, its packets are listed once with ffprobe (or
+    with a stream copy through ffmpeg, which decodes nothing) and the position
+    of every keyframe is saved next to the video (<video>.keyindex.npz, built
+    again if the video changes). get_frame(i) then starts ffmpeg at the last
+    keyframe before frame i, so at most one group of pictures is decoded. The
+    decoder is kept running after that, so reading on (get_frame(i + 1),
+    get_range(i, j), iterating) continues where it stopped. Decoded frames are
+    kept in a cache with a limit in bytes that drops the least recently used
+    frames first; one cache can be shared by several readers.
+
+    Raw recordings ('.raw', see raw_writer.py) are read through RawVideo,
+    which needs no decoding.
+
+    python b_read_vid.py <video> [frame]
+"""
+
+import os
+import re
+import shutil
+import subprocess as sp
+from collections import OrderedDict
+import numpy as np
+
+KEYINDEX_VERSION = 1
+
+def ffprobe_command(ffmpeg='ffmpeg'):
+    """ ffprobe next to the given ffmpeg or on the PATH, None if there is none."""
+    directory, name = os.path.split(ffmpeg)
+    if directory:
+        candidate = os.path.join(directory, name.replace('ffmpeg', 'ffprobe'))
+        if os.path.isfile(candidate):
+            return candidate
+    return shutil.which('ffprobe')
+
+def keyindex_filename(filename):
+    return filename + ".keyindex.npz"
+
+def scan_packets_ffprobe(filename, ffprobe):
+    """ Stream info and, per packet in file order, its time in seconds and whether it is a keyframe."""
+    out = sp.run([ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height,pix_fmt,r_frame_rate',
+                  '-of', 'csv=p=0', filename], stdout=sp.PIPE, stderr=sp.PIPE, check=True).stdout.decode()
+    width, height, pix_fmt, rate = out.strip().splitlines()[0].split(',')[:4]
+    num, den = rate.split('/')
+    out = sp.run([ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=dts_time,flags',
+                  '-of', 'csv=p=0', filename], stdout=sp.PIPE, stderr=sp.PIPE, check=True).stdout.decode()
+    times, keys = [], []
+    for line in out.splitlines():
+        dts, flags = line.split(',')[:2]
+        times.append(float(dts) if dts not in ('', 'N/A') else np.nan)
+        keys.append('K' in flags)
+    return {"width": int(width), "height": int(height), "pix_fmt": pix_fmt, "fps": int(num) / int(den)}, np.array(times), np.array(keys, dtype=bool)
+
+def scan_packets_ffmpeg(filename, ffmpeg):
+    """ Like scan_packets_ffprobe, from ffmpeg's per-packet checksums of a stream copy (framecrc)."""
+    proc = sp.run([ffmpeg, '-hide_banner', '-i', filename, '-map', '0:v:0', '-c', 'copy', '-f', 'framecrc', '-'],
+                  stdout=sp.PIPE, stderr=sp.PIPE, check=True)
+    out = proc.stdout.decode(errors='replace')
+    tb = re.search(r'^#tb 0: (\d+)/(\d+)', out, re.M)
+    size = re.search(r'^#dimensions 0: (\d+)x(\d+)', out, re.M)
+    stream = re.search(r'Video: \w+[^,]*, (\w+).*?([\d.]+) fps', proc.stderr.decode(errors='replace'))
+    if tb is None or size is None or stream is None:
+        raise ValueError("{} has no video stream.".format(filename))
+    times, keys = [], []
+    for line in out.splitlines():
+        if line.startswith('#'):
+            continue
+        fields = [f.strip() for f in line.split(',')]
+        times.append(int(fields[1]) * int(tb.group(1)) / int(tb.group(2))) # dts
+        # the flags are only listed if they are not just 'keyframe'
+        flags = [f for f in fields[6:] if f.startswith('F=')]
+        keys.append(not flags or bool(int(flags[0][2:], 16) & 1))
+    return ({"width": int(size.group(1)), "height": int(size.group(2)), "pix_fmt": stream.group(1), "fps": float(stream.group(2))},
+            np.array(times), np.array(keys, dtype=bool))
+
+def build_keyindex(filename, ffmpeg='ffmpeg', ffprobe=None):
+    """ Lists the packets of a video and saves its keyframe index next to it. Returns the index as a dict."""
+    if ffprobe:
+        info, times, keys = scan_packets_ffprobe(filename, ffprobe)
+    else:
+        info, times, keys = scan_packets_ffmpeg(filename, ffmpeg)
+    stat = os.stat(filename)
+    index = dict(info, version=KEYINDEX_VERSION, frames=len(times), times=times, keyframes=np.flatnonzero(keys),
+                 source_size=stat.st_size, source_mtime=stat.st_mtime)
+    tmp = keyindex_filename(filename) + ".tmp.npz"
+    try:
+        np.savez(tmp, **index)
+        os.replace(tmp, keyindex_filename(filename))
+    except OSError: # e.g. a read-only archive, the index is only kept in memory then
+        pass
+    return index
+
+def load_keyindex(filename, ffmpeg='ffmpeg', ffprobe=None):
+    """ The saved keyframe index of a video, built first if there is none or the video has changed since."""
+    try:
+        with np.load(keyindex_filename(filename)) as data:
+            index = {k: data[k] for k in data.files}
+        stat = os.stat(filename)
+        if int(index["version"]) == KEYINDEX_VERSION and int(index["source_size"]) == stat.st_size and float(index["source_mtime"]) == stat.st_mtime:
+            for key in ("width", "height", "frames"):
+                index[key] = int(index[key])
+            index["fps"] = float(index["fps"])
+            index["pix_fmt"] = str(index["pix_fmt"])
+            return index
+    except (OSError, KeyError, ValueError):
+        pass
+    return build_keyindex(filename, ffmpeg, ffprobe)
+
+class FrameCache:
+    """ Decoded frames by (video, frame number), the least recently used are dropped above max_bytes."""
+
+    def __init__(self, max_bytes=512 * 2**20):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            return
+        if frame.nbytes > self.max_bytes:
+            return
+        self.frames[key] = frame
+        self.nbytes += frame.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.frames.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def stats_str(self):
+        total = self.hits + self.misses
+        return "{} frames cached ({:.1f} of {:.0f} MB), {:.0%} hits".format(
+            len(self.frames), self.nbytes / 2**20, self.max_bytes / 2**20, self.hits / total if total else 0)
+
+class FFMPEG_VideoReader:
+    """ Reads frames of a video by number.
+
+    Parameters
+    -----------
+
+    filename
+      A video written by the recorder (any format ffmpeg reads, or '.raw').
+
+    out_pixfmt
+      Pixel format of the returned frames: 'gray' (uint8) or 'gray12le'/'gray16le'
+      (uint16). None: 'gray' for 8 bit videos, 'gray12le' for deeper ones.
+
+    cache
+      A FrameCache, e.g. shared with other readers. None: a new one of cache_bytes.
+
+    ffmpeg_command
+      The ffmpeg executable (ffprobe is used if it is next to it or on the PATH).
+
+    """
+
+    def __init__(self, filename, out_pixfmt=None, cache=None, cache_bytes=512 * 2**20, ffmpeg_command='ffmpeg'):
+        self.filename = filename
+        self.ffmpeg_command = ffmpeg_command
+        self.cache = cache if cache is not None else FrameCache(cache_bytes)
+        self.proc = None # running decoder
+        self.proc_pos = None # number of the frame the decoder delivers next
+        self.seeks = 0
+        self.frames_decoded = 0
+        self.raw = None
+        if filename.endswith(".raw"):
+            from raw_writer import RawVideo
+            self.raw = RawVideo(filename)
+            self.size = (self.raw.header["width"], self.raw.header["height"])
+            self.fps = self.raw.fps
+            self.n_frames = len(self.raw)
+            self.dtype = self.raw.dtype
+            return
+        index = load_keyindex(filename, ffmpeg_command, ffprobe_command(ffmpeg_command))
+        self.size = (index["width"], index["height"])
+        self.fps = index["fps"]
+        self.n_frames = index["frames"]
+        self.times = index["times"]
+        self.keyframes = index["keyframes"]
+        if out_pixfmt is None:
+            out_pixfmt = 'gray' if not re.match(r'gray(9|1\d)', index["pix_fmt"]) else 'gray12le'
+        self.out_pixfmt = out_pixfmt
+        self.dtype = np.dtype(np.uint8 if out_pixfmt == 'gray' else '<u2')
+        self.frame_bytes = self.size[0] * self.size[1] * self.dtype.itemsize
+
+    def __len__(self):
+        return self.n_frames
+
+    def keyframe_before(self, i):
+        """ Number of the last keyframe at or before frame i."""
+        k = np.searchsorted(self.keyframes, i, 'right') - 1
+        return int(self.keyframes[k]) if k >= 0 else 0
+
+    def start_decoder(self, k):
+        """ Starts ffmpeg at keyframe k."""
+        self.stop_decoder()
+        cmd = [self.ffmpeg_command, '-loglevel', 'error', '-nostdin']
+        if k > 0:
+            # About halfway to the next keyframe: the demuxer goes back to keyframe k and, without accurate seeking,
+            # the output starts there. Just past its decoding time is not enough, with B-frames it is shown a few
+            # frames later. A quarter frame past a whole frame, because the time is rounded to the nearest frame.
+            nxt = np.searchsorted(self.keyframes, k, 'right')
+            gop = (self.keyframes[nxt] if nxt < len(self.keyframes) else self.n_frames) - k
+            cmd.extend(['-noaccurate_seek', '-ss', '{:.6f}'.format(self.times[k] + (gop // 2 + 0.25) / self.fps)])
+        cmd.extend(['-i', self.filename, '-map', '0:v:0', '-vsync', '0', '-f', 'rawvideo', '-pix_fmt', self.out_pixfmt, '-'])
+        self.proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.DEVNULL, bufsize=0)
+        self.proc_pos = k
+        self.seeks += 1
+
+    def stop_decoder(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+            self.proc_pos = None
+
+    def read_decoded(self):
+        """ The decoder's next frame (and puts it in the cache)."""
+        buf = bytearray(self.frame_bytes)
+        view = memoryview(buf)
+        n = 0
+        while n < self.frame_bytes:
+            got = self.proc.stdout.readinto(view[n:])
+            if not got:
+                raise IOError("{} ended at frame {} of {}.".format(self.filename, self.proc_pos, self.n_frames))
+            n += got
+        frame = np.frombuffer(buf, dtype=self.dtype).reshape(self.size[1], self.size[0])
+        self.cache.put((self.filename, self.proc_pos), frame)
+        self.proc_pos += 1
+        self.frames_decoded += 1
+        return frame
+
+    def get_frame(self, i):
+        """ Frame i as an array (height, width); do not change it, it may be cached."""
+        if i < 0:
+            i += self.n_frames
+        if not 0 <= i < self.n_frames:
+            raise IndexError("Frame {} of a video with {} frames.".format(i, self.n_frames))
+        if self.raw is not None:
+            return self.raw.frame(i)
+        frame = self.cache.get((self.filename, i))
+        if frame is not None:
+            return frame
+        k = self.keyframe_before(i)
+        # continue the running decoder unless starting at the keyframe is shorter
+        if self.proc is None or not k <= self.proc_pos <= i:
+            self.start_decoder(k)
+        while True:
+            frame = self.read_decoded()
+            if self.proc_pos > i:
+                return frame
+
+    def get_range(self, i, j):
+        """ Frames i to j-1 as one array (j-i, height, width)."""
+        return np.stack([self.get_frame(k) for k in range(i, j)]) if j > i else np.empty((0, self.size[1], self.size[0]), self.dtype)
+
+    def __iter__(self):
+        for i in range(self.n_frames):
+            yield self.get_frame(i)
+
+    def close(self):
+        self.stop_decoder()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+def check_reader(filename, ffmpeg='ffmpeg', n_random=20):
+    """ Compares random access with decoding the whole video once."""
+    import time
+    t0 = time.perf_counter()
+    reader = FFMPEG_VideoReader(filename, ffmpeg_command=ffmpeg, cache_bytes=0)
+    t_open = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    frames = [f.copy() for f in reader]
+    t_all = time.perf_counter() - t0
+    reader.close()
+    reader = FFMPEG_VideoReader(filename, ffmpeg_command=ffmpeg)
+    rng = np.random.default_rng(0)
+    t0 = time.perf_counter()
+    for i in rng.integers(0, len(frames), n_random):
+        if not np.array_equal(reader.get_frame(int(i)), frames[i]):
+            raise AssertionError("Frame {} differs from the one decoded in order.".format(i))
+    t_random = (time.perf_counter() - t0) / n_random
+    print("{}: {} frames, {} keyframes, index {:.2f} s; all in order {:.2f} s; random frame {:.1f} ms on average ({} seeks, {})".format(
+        filename, len(frames), len(reader.keyframes) if reader.raw is None else len(frames), t_open, t_all, t_random * 1e3,
+        reader.seeks, reader.cache.stats_str()))
+    reader.close()
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 2:
+        with FFMPEG_VideoReader(sys.argv[1]) as reader:
+            frame = reader.get_frame(int(sys.argv[2]))
+            print("Frame {} of {}: {} {}, mean {:.2f}".format(sys.argv[2], len(reader), frame.shape, frame.dtype, frame.mean()))
+    else:
+        check_reader(sys.argv[1])
@@ -8,10 +8,49 @@
     It is supposed to be used in some GUI. After start_recording has been called, all
     connected Basler cameras will record.
     
-    There is a preview window opening, when recording. The grabbing of frames and the
-    writing of the video are done in a separate thread from the previewing.
+    There is a preview window opening, when recording (one mosaic of all cameras at a
+    few fps, see preview.py; it can be switched off for headless runs). The grabbing of
+    frames and the writing of the video are done in a separate thread from the previewing.
+    Each camera has a grab thread and an encode thread, connected by a ring of
+    preallocated frames (see frame_ring.py), so a slow ffmpeg pipe does not block
+    RetrieveResult. With encoder_backend='process' the encoding is done in worker
+    processes instead, fed through shared memory (see mp_encoder.py).
+    pylon hands out every frame in order by default (grab strategy OneByOne, with
+    max_num_buffer buffers), and the frames lost before the ring (failed grabs,
+    frames pylon skipped, the stream grabber's statistics) are logged per segment
+    (see grab_stats.py).
+
+    On a rollover (requested by BeDSy, or in free-run mode after segment_seconds or
+    segment_bytes), the cameras keep grabbing: every encoder switches to an
+    already started writer for the next segment at an exact frame index and closes
+    the old file in the background (see frame_encoder.py). The index is the
+    camera's frame count when the rollover is made; with BeDSy that is after the
+    triggers paused ([STOP_ROLLOVER], then no frame retrieved for three frame
+    intervals), so every frame triggered before the stop is in the old segment
+    and the new one starts with the first trigger after [START]. Every finished segment is
+    listed in the session's segment index (see segment_index.py). When the recording
+    stops, the frames of all cameras are aligned by trigger (BeDSy) or time in the
+    session's frame table (see session_index.py).
+
+    The videos can be spread over several volumes (storage_volumes): every
+    segment's file goes to the volume with room and throughput to spare, and
+    is preallocated. The free space is checked every second, and the cameras
+    writing to a volume that is running full are rolled over to another one
+    right away (see storage.py). Logs, indexes and status stay in vid_dir.
     
-    Camera settings are hard coded below (in "set_cam_settings").
+    Camera settings are hard coded below (in "set_cam_settings"). The cameras are
+    opened and configured in parallel, and the configuration is cached as a pylon
+    feature file per camera (see feature_cache.py), so the next start loads it in
+    one go. How long each step of the start took is logged ("startup").
+
+    A recording can be armed ahead of time (arm_recording_thread): the cameras
+    are set up and grabbing and the writers of the first segment are running,
+    but no frame is recorded. start_armed() then only opens the gate: the first
+    frame retrieved after it is the first one in the videos. stop_recording()
+    closes it again at the next frame. The measured start latency (start to
+    every camera's first frame) and stop latency (stop to the grabbing stopped
+    and to the files closed) are logged and kept in self.latency. See
+    rec_control.py for starting and stopping over a local socket.
 """
 
 import os
@@ -20,19 +59,38 @@ from pathlib import Path
 import time
 from datetime import datetime, timedelta
 import threading
-import cv2
+from concurrent.futures import ThreadPoolExecutor
 import platform
 from bedsy.bedsy import Bedsy
 import queue
-from collections import deque
 
 if platform.system() == 'Windows':
     from reset_USB import reset_baslers_windows as reset_baslers
 else:
     from reset_USB import reset_baslers_linux as reset_baslers
+from reset_USB import reset_report_str, find_baslers_sysfs
+from capacity_planner import camera_spec, plan, plan_str
 
 from logger import Logger
-import b_record_to_vid as r2v
+from frame_ring import FrameRing
+from frame_sidecar import FrameSidecar, sidecar_filename
+from frame_encoder import FrameEncoder
+from cpu_meter import ThreadCpuMeter
+from preview import MosaicPreview
+from segment_index import SegmentIndex, segment_index_filename
+from session_index import SessionIndex, frame_table_filename
+from encoder_profiles import ENCODER_PROFILES, DEFAULT_PROFILE, profile_writer_args, faster_profile, profile_extension, create_writer
+from raw_writer import raw_size
+from backpressure import BackpressureMonitor
+from metrics import MetricsRegistry, MetricsExporter
+from feature_cache import FeatureCache
+from pixel_formats import PIXEL_FORMATS, check_pixel_format, unpack_mono12p
+from activity_gate import ActivityGate
+from storage import StorageManager, DEFAULT_FILE_SECONDS
+from grab_stats import GrabStats, check_grab_settings, read_stream_statistics, DEFAULT_GRAB_STRATEGY, DEFAULT_MAX_NUM_BUFFER, LOSSLESS_GRAB_STRATEGIES
+import mp_encoder
+
+CAM_SETTINGS_VERSION = 1 # increase when set_cam_settings changes, so cached feature files are not used any more
 
 class BaslerMouseRecorder():
 
@@ -41,12 +99,34 @@ class BaslerMouseRecorder():
         d = d.replace('\\', '/')
         return d
 
-    def __init__(self, vid_dir, size=(1936,1216), fps=41, ffmpeg='ffmpeg', use_bedsy=False, bedsy_fps=None):
+    def __init__(self, vid_dir, size=(1936,1216), fps=41, ffmpeg='ffmpeg', use_bedsy=False, bedsy_fps=None, ring_depth=64, write_batch=8,
+                 encoder_backend='thread', cameras_per_process=1, show_preview=True, preview_fps=4, segment_seconds=None, segment_bytes=None,
+                 encoder_profile=DEFAULT_PROFILE, camera_profiles=None, backpressure_seconds=5.0, metrics_port=None, status_json=False,
+                 feature_cache_dir=str(Path.home() / ".basler_recorder" / "features"), usb_reset='unhealthy', usb_reset_serials=None,
+                 pixel_format='Mono8', activity_gate=None, storage_volumes=None, min_free_bytes=5e9, preallocate=True,
+                 grab_strategy=DEFAULT_GRAB_STRATEGY, max_num_buffer=DEFAULT_MAX_NUM_BUFFER, camera_grab=None):
         # switch this (True/False) to use BeDSy, an external bedsy device for triggering frame captures
         self.use_bedsy = use_bedsy
 
-        self.bedsy_fps = float(bedsy_fps)
+        self.bedsy_fps = float(bedsy_fps) if bedsy_fps is not None else None
         self.size = size
+        # 'Mono8' or 'Mono12p' (12 bit, packed over USB and unpacked by the grab threads, see pixel_formats.py)
+        check_pixel_format(pixel_format)
+        self.pixel_format = pixel_format
+        # parameters of an ActivityGate per camera (see activity_gate.py, {} for the defaults), which leaves
+        # frames without movement out of the videos; None: every frame is written
+        if activity_gate is not None:
+            ActivityGate(**activity_gate) # check the parameters now, not in the encoders
+        self.activity_gate = activity_gate
+        # pylon grab strategy and number of grab buffers for all cameras (see grab_stats.py, None: pylon's default),
+        # camera_grab maps a serial to different ones, e.g. {"22334455": {"strategy": 'OneByOne', "max_num_buffer": 64}}
+        self.grab_strategy = grab_strategy
+        self.max_num_buffer = max_num_buffer
+        self.camera_grab = dict(camera_grab) if camera_grab else dict()
+        for settings in [{}] + list(self.camera_grab.values()):
+            check_grab_settings(settings.get("strategy", grab_strategy), settings.get("max_num_buffer", max_num_buffer))
+        self.grab_stats = dict() # serial -> GrabStats
+        self.final_statistics = dict() # serial -> stream grabber statistics read when its grabbing stopped
         self.fps = fps
         self.total_t = 0
         self.fpre = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) # file prefix
@@ -54,30 +134,143 @@ class BaslerMouseRecorder():
         if self.use_bedsy:
             self.vid_dir = self.vid_dir / self.fpre
         self.set_logfile()
+        # folders (one per disk) the videos are spread over (see storage.py), None: all in vid_dir.
+        # With BeDSy, the session gets a subfolder on every volume, like in vid_dir
+        self.storage_volumes = None
+        if storage_volumes:
+            self.storage_volumes = [Path(BaslerMouseRecorder.replace_backslash_in_dir(str(v))) for v in storage_volumes]
+            if self.use_bedsy:
+                self.storage_volumes = [v / self.fpre for v in self.storage_volumes]
+        self.min_free_bytes = min_free_bytes # left free on every volume, new segments go elsewhere before
+        self.preallocate = preallocate # reserve the blocks of every segment's file when it is opened
+        self.storage = None
+        self.segment_files = dict() # (serial, segment) -> video file name, on the volume chosen for it
+        self.disk_rates = dict() # serial -> expected bytes per second written (capacity plan, then the closed segments)
         self.ffmpeg_command = ffmpeg
         self.manager_running = False
-        self.writers_running = False
+        self.writers_stop = threading.Event() # set to make the threads which grab frames and write them to a file finish
         #self.writer_thread = None
         self.c_threads = dict()
+        self.e_threads = dict() # encode threads
+        self.rings = dict()
+        self.encoders = dict() # serial -> FrameEncoder (thread backend)
+        self.encoder_procs = [] # EncoderProcess (process backend)
+        # 'thread': one encode thread per camera. 'process': one encoder process per cameras_per_process cameras,
+        # so the encoding does not compete with grabbing and preview for the GIL
+        self.encoder_backend = encoder_backend
+        self.cameras_per_process = cameras_per_process
+        self.writer_args = dict() # serial -> keyword arguments for the writer (see create_writer), except the file name and profile
+        self.encoder_proc_of = dict() # serial -> EncoderProcess (process backend)
+        self.segment = 0 # number of the current segment, files are rolled over on BeDSy's request
+        # without BeDSy: start new files after segment_seconds, or once a camera's file has segment_bytes (None: one file)
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        # encoder profile (see encoder_profiles.py) for all cameras, camera_profiles maps a serial to a different one
+        self.encoder_profile = encoder_profile
+        self.camera_profiles = dict(camera_profiles) if camera_profiles else dict()
+        for name in [encoder_profile] + list(self.camera_profiles.values()):
+            if name not in ENCODER_PROFILES:
+                raise ValueError("Unknown encoder profile '{}', available: {}".format(name, ", ".join(ENCODER_PROFILES)))
+        self.profiles = dict() # serial -> encoder profile of the current (and next) segment
+        # an encoder that is behind its camera for this long gets a faster profile for the next segment
+        self.backpressure_seconds = backpressure_seconds
+        self.backpressure = None
+        # live metrics (see metrics.py): Prometheus text on http://127.0.0.1:<metrics_port>/metrics
+        # and/or <vid_dir>/<date>_status.json, rewritten every second
+        self.metrics_port = metrics_port
+        self.status_json = status_json
+        self.metrics = None
+        self.metrics_exporter = None
+        self.show_preview = show_preview # False for headless runs
+        self.preview_fps = preview_fps
+        self.preview = None
+        self.ring_depth = ring_depth # number of preallocated frames buffered per camera between grabbing and encoding
+        self.write_batch = write_batch # max. number of queued frames written to ffmpeg with one vectored write
         self.use_dummy_camera = False
-        self.writers_ready = {}
-        reset_baslers()
+        self.writers_ready = {} # serial -> threading.Event, set once the camera is grabbing (and armed for the trigger)
+        self.cpu_meters = {} # thread name -> ThreadCpuMeter
+        # pylon feature files of the configured cameras (see feature_cache.py), None: always set the nodes one by one
+        self.feature_cache = FeatureCache(feature_cache_dir) if feature_cache_dir else None
+        self.startup_times = None # timing of the last start, logged once the recorder is armed
+        self.first_frame_t = dict() # serial -> time.time() when its first recorded frame arrived
+        # armed: cameras grabbing and writers running, waiting for start_event. start_cue_t and stop_cue_t are the
+        # times of the start and stop (time.time()), frames retrieved before or after them are not recorded
+        self.armed = threading.Event()
+        self.start_event = threading.Event()
+        self.first_frames_in = threading.Event() # set once every camera has its first recorded frame
+        self.auto_start = True
+        self.start_cue_t = None
+        self.stop_cue_t = None
+        self.grab_stopped_t = dict() # serial -> time.time() when its grab thread stopped
+        self.last_grab_t = dict() # serial -> time.time() of the last frame its grab thread retrieved
+        self.latency = dict() # "start": serial -> seconds to the first frame, "stop": seconds to the grabbing stopped and the files closed
+        # which cameras get a USB reset before the recording (see reset_USB.py): 'never', 'unhealthy' (not listed
+        # by pylon or slower than USB 3), 'selected' (usb_reset_serials) or 'all'
+        self.usb_reset_report = self.reset_cameras(usb_reset, usb_reset_serials)
+
+    def reset_cameras(self, mode, serials=None):
+        """ Resets the USB connection of the cameras selected by mode and waits until pylon lists them again."""
+        if mode == 'never':
+            return None
+        tl = pylon.TlFactory.GetInstance()
+        list_serials = lambda: [d.GetSerialNumber() for d in tl.EnumerateDevices()]
+        report = reset_baslers(mode, serials, list_serials() if mode == 'unhealthy' else None, list_serials=list_serials)
+        print(reset_report_str(report))
+        return report
 
     def set_logfile(self):
         self.fpre = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) # file prefix
         self.logger = Logger(self.vid_dir)
 
-    def set_cam_settings(self, cam, i):
+    def open_cam(self, cam, i):
         cam.Attach(self.tlFactory.CreateDevice(self.devices[i]))
-        cam.Open()
         if cam.DeviceInfo.GetDeviceClass() == "BaslerCamEmu":
             cam.RegisterConfiguration(pylon.SoftwareTriggerConfiguration(), pylon.RegistrationMode_ReplaceAll,
                                       pylon.Cleanup_Delete)
+            self.use_dummy_camera = True
+        cam.Open()
+
+    def cam_config(self, cam):
+        """ What set_cam_settings depends on. A cached feature file is only used if this is unchanged."""
+        return {"version": CAM_SETTINGS_VERSION, "device_class": cam.DeviceInfo.GetDeviceClass(), "size": list(self.size),
+                "pixel_format": self.pixel_format, "use_bedsy": self.use_bedsy}
+
+    def setup_cam(self, cam, i):
+        """ Opens and configures one camera (run in parallel for all cameras). The settings are loaded
+        from the feature cache if possible. Returns the serial, the settings read back and the timing."""
+        t0 = time.perf_counter()
+        self.open_cam(cam, i)
+        t_open = time.perf_counter()
+        serial = cam.DeviceInfo.GetSerialNumber()
+        model = cam.GetDeviceInfo().GetModelName()
+        config = self.cam_config(cam)
+        source = 'nodes'
+        if self.feature_cache is not None and self.feature_cache.load(cam, serial, model, config):
+            source = 'cache'
+        else:
+            self.set_cam_settings(cam)
+        t_config = time.perf_counter()
+        settings = self.cam_settings(cam)
+        t_read = time.perf_counter()
+        if source == 'cache' and (settings["Size Width"], settings["Size Height"], settings["Pixel Format"]) != (self.size[0], self.size[1], self.pixel_format):
+            # should not happen, but a wrong frame size would break the recording
+            self.feature_cache.invalidate(serial)
+            self.set_cam_settings(cam)
+            source = 'nodes'
+            t_config = time.perf_counter()
+            settings = self.cam_settings(cam)
+            t_read = time.perf_counter()
+        if source == 'nodes' and self.feature_cache is not None:
+            self.feature_cache.save(cam, serial, model, config)
+        timing = {"open": t_open - t0, "configure": t_config - t_open, "read_back": t_read - t_config, "settings_from": source}
+        return serial, model, settings, timing
+
+    def set_cam_settings(self, cam):
         cam.OffsetX = 0
         cam.OffsetY = 0
         cam.Width = self.size[0]
         cam.Height = self.size[1]
-        cam.PixelFormat = "Mono8"
+        cam.PixelFormat = self.pixel_format
         cam.ExposureAuto = "Off"
         cam.ExposureTime = 20000 # microseconds
         #cam.DeviceLinkThroughputLimitMode = "Off"
@@ -97,24 +290,29 @@ class BaslerMouseRecorder():
             cam.AcquisitionFrameRate = 30 # the frame rate that he is trying to do
             # he estimates the actual frame rate in cam.ResultingFrameRate. Tests have shown that this is also not always accurate though - especially when using 12 bit pixels (Mono12p).
         if cam.DeviceInfo.GetDeviceClass() == "BaslerCamEmu":
-            self.use_dummy_camera = True
             cam.TestImageSelector.SetValue("Testimage2")
 
-    def get_cam_settings(self, cam):
-        result = []
-        result.append("Size Width: {}\n".format(cam.Width.Value))
-        result.append("Size Height: {}\n".format(cam.Height.Value))
-        result.append("Offset X: {}\n".format(cam.OffsetX.Value))
-        result.append("Offset Y: {}\n".format(cam.OffsetY.Value))
-        result.append("Pixel Format: {}\n".format(cam.PixelFormat.Value))
-        result.append("Exposure Auto: {}\n".format(cam.ExposureAuto.Value))
-        result.append("Exposure Time: {}\n".format(cam.ExposureTime.Value))
-        result.append("Throughput Limit Mode: {}\n".format(cam.DeviceLinkThroughputLimitMode.Value))
-        result.append("Acquisition Frame Rate Enable: {}\n".format(cam.AcquisitionFrameRateEnable.Value))
-        result.append("Acquisition Frame Rate: {}\n".format(cam.AcquisitionFrameRate.Value))
+    def cam_settings(self, cam):
+        """ The camera's current settings (name as in the log -> value)."""
+        result = {"Size Width": cam.Width.Value,
+                  "Size Height": cam.Height.Value,
+                  "Offset X": cam.OffsetX.Value,
+                  "Offset Y": cam.OffsetY.Value,
+                  "Pixel Format": cam.PixelFormat.Value,
+                  "Exposure Auto": cam.ExposureAuto.Value,
+                  "Exposure Time": cam.ExposureTime.Value,
+                  "Throughput Limit Mode": cam.DeviceLinkThroughputLimitMode.Value,
+                  "Acquisition Frame Rate Enable": cam.AcquisitionFrameRateEnable.Value,
+                  "Acquisition Frame Rate": cam.AcquisitionFrameRate.Value}
         if not self.use_bedsy:
-            result.append("->Resulting Frame Rate: {}\n".format(cam.ResultingFrameRate.Value))
-        return "".join(result)
+            result["->Resulting Frame Rate"] = cam.ResultingFrameRate.Value
+        return result
+
+    def get_cam_settings(self, cam, settings=None):
+        """ The settings as lines for the text log (read from the camera unless given)."""
+        if settings is None:
+            settings = self.cam_settings(cam)
+        return "".join("{}: {}\n".format(name, value) for name, value in settings.items())
 
     # def start_writing_frames(self):
     #     self.writer_ready = False
@@ -151,38 +349,460 @@ class BaslerMouseRecorder():
     #     self.cameras.StopGrabbing()
 
     def cam_start_writing_frames(self, c, serial):
-        if self.use_bedsy:
-            c.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
-        else:
-            c.StartGrabbing()
+        ring = self.rings[serial]
+        grab_seconds = self.metrics[serial].grab_seconds
+        packed = PIXEL_FORMATS[self.pixel_format]["packed"]
+        cpu = self.cpu_meters["grab " + serial] = ThreadCpuMeter()
+        cpu.start('idle')
+        stats = self.grab_stats[serial]
+        if stats.max_num_buffer is not None:
+            c.MaxNumBuffer.SetValue(stats.max_num_buffer)
+        c.StartGrabbing(getattr(pylon, "GrabStrategy_" + stats.strategy))
+        if not self.use_bedsy:
+            self.writers_ready[serial].set()
         #time.sleep(3)
         first_frame = True
-        while self.writers_running:
-            if self.use_dummy_camera:
-                if c.DeviceInfo.GetDeviceClass() == "BaslerCamEmu":
-                    c.ExecuteSoftwareTrigger()
-            if self.use_bedsy:
-                if first_frame:
-                    while not c.AcquisitionStatus.GetValue():
-                        time.sleep(0)
-                    first_frame = False
-                    self.writers_ready[serial] = True
-                    #self.start_t = self.logger.logWithTime("Started recording with {} Basler camera{}.".format(self.num_cams, 's' if self.num_cams>1 else ''), stdout=True)
-                grabResult = c.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
+        try:
+            while not self.writers_stop.is_set():
+                if self.use_dummy_camera:
+                    if c.DeviceInfo.GetDeviceClass() == "BaslerCamEmu":
+                        c.ExecuteSoftwareTrigger()
+                if self.use_bedsy:
+                    if first_frame:
+                        # The camera has no event for this, so poll it without burning a core.
+                        # A frame at 30 fps takes 33 ms, so 5 ms does not delay anything.
+                        while not c.AcquisitionStatus.GetValue():
+                            if self.writers_stop.wait(0.005):
+                                break
+                        first_frame = False
+                        self.writers_ready[serial].set()
+                        if self.writers_stop.is_set():
+                            break
+                        #self.start_t = self.logger.logWithTime("Started recording with {} Basler camera{}.".format(self.num_cams, 's' if self.num_cams>1 else ''), stdout=True)
+                # Armed with BeDSy, there is no trigger until the start (BeDSy is started after it): wait in short
+                # steps, so a stop before the start is noticed right away.
+                timeout = 500 if self.start_event.is_set() else 50
+                grabResult = c.RetrieveResult(timeout, pylon.TimeoutHandling_Return)
+                if not grabResult.IsValid():
+                    continue # no frame yet (armed, or BeDSy pauses the triggers for a rollover); checks the stop flag again
+                host_t = time.time()
+                self.last_grab_t[serial] = host_t
+                t_grab = time.perf_counter()
+                if not self.start_event.is_set() or host_t < self.start_cue_t:
+                    grabResult.Release() # armed, not recording yet
+                    continue
+                if self.stop_cue_t is not None and host_t >= self.stop_cue_t:
+                    grabResult.Release() # retrieved after the stop
+                    break
+                if not stats.result(grabResult):
+                    # no frame (e.g. an incomplete buffer): counted, and a BlockID gap in the sidecar
+                    grabResult.Release()
+                    continue
+                #serial = self.cameras[grabResult.GetCameraContext()].DeviceInfo.GetSerialNumber()
+                # Hand the image over to the encode thread. The grab buffer is copied once,
+                # straight into a preallocated ring slot, before it goes back to pylon.
+                meta = (host_t, grabResult.TimeStamp, grabResult.BlockID, self.frame_counter_dict[serial])
+                if packed:
+                    # Mono12p is unpacked while it is copied, straight from pylon's buffer into the slot
+                    with grabResult.GetArrayZeroCopy(raw=True) as buf:
+                        slot = ring.reserve() # None (and a drop is counted) if the encoder is too far behind
+                        if slot is not None:
+                            unpack_mono12p(buf, slot)
+                            ring.commit(meta)
+                            self.preview.offer(serial, slot)
+                else:
+                    with grabResult.GetArrayZeroCopy() as frame:
+                        self.preview.offer(serial, frame) # copies a downsampled tile only a few times per second
+                        ring.put(frame, meta) # counts a drop if the encoder is too far behind
+                grabResult.Release()
+                grab_seconds.observe(time.perf_counter() - t_grab)
+                if self.frame_counter_dict[serial] == 0:
+                    cpu.phase('recording')
+                    self.first_frame_t[serial] = host_t
+                    if len(self.first_frame_t) == len(self.serials):
+                        self.first_frames_in.set()
+                self.frame_counter_dict[serial] += 1
+        except Exception as e:
+            # e.g. the camera was unplugged: the other cameras go on, and the encoder writes what it has
+            self.logger.event("grab_error", "Cam {}: grabbing stopped after {} frame(s): {!r}".format(serial, self.frame_counter_dict[serial], e),
+                              stdout=True, serial=serial, frames=self.frame_counter_dict[serial], error=repr(e))
+        finally:
+            #self.end_t = time.time()
+            self.grab_stopped_t[serial] = time.time()
+            ring.close() # the encoder finishes and stop_writers() does not wait for it forever
+            self.writers_ready[serial].set() # nothing to wait for
+            try:
+                self.final_statistics[serial] = read_stream_statistics(c) # before StopGrabbing closes the stream grabber
+                c.StopGrabbing()
+            except Exception:
+                pass # the camera is gone
+            cpu.stop()
+
+    def ring_dtype(self):
+        return PIXEL_FORMATS[self.pixel_format]["dtype"]
+
+    def log_startup_times(self, startup_t0):
+        """ Logs how long each step of the start took, up to the recorder being armed (once per start)."""
+        times = self.startup_times
+        self.startup_times = None
+        times["armed"] = time.perf_counter() - startup_t0
+        cams = ", ".join("{} open {:.2f} s, configure {:.2f} s ({}), read back {:.2f} s".format(
+            serial, c["open"], c["configure"], c["settings_from"], c["read_back"]) for serial, c in times["cameras"].items())
+        self.logger.event("startup", "Startup: enumerate {:.2f} s, set up cameras {:.2f} s, storage {:.2f} s, start writers {:.2f} s, armed after {:.2f} s; {}.".format(
+            times["enumerate"], times["setup"], times["storage"], times["start_writers"], times["armed"], cams), stdout=True, **times)
+
+    def log_start_latency(self):
+        """ Logs how long after the start every camera's first recorded frame was retrieved."""
+        self.latency["start"] = {serial: t - self.start_cue_t for serial, t in self.first_frame_t.items()}
+        self.logger.event("start_latency", "Start latency: {}.".format(", ".join("cam {} {:.1f} ms".format(serial, 1e3 * t) for serial, t in self.latency["start"].items())),
+                          stdout=True, start_time=self.start_cue_t, first_frame=self.latency["start"])
+
+    def log_stop_latency(self):
+        """ Logs how long after the stop the grabbing stopped and the files were closed."""
+        now = time.time()
+        self.latency["stop"] = {"grabbing_stopped": max(self.grab_stopped_t.values(), default=now) - self.stop_cue_t, "files_closed": now - self.stop_cue_t}
+        self.logger.event("stop_latency", "Stop latency: grabbing stopped after {:.1f} ms, files closed after {:.1f} ms.".format(
+            1e3 * self.latency["stop"]["grabbing_stopped"], 1e3 * self.latency["stop"]["files_closed"]), stdout=True, stop_time=self.stop_cue_t, **self.latency["stop"])
+
+    def check_capacity(self, setups):
+        """ Logs whether USB, CPU and disk should keep up with these cameras (see capacity_planner.py)."""
+        usb = {dev["serial"]: dev for dev in find_baslers_sysfs()}
+        cams = []
+        for serial, model, settings, timing in setups:
+            bus = int(usb[serial]["devfs"].split("/")[-2]) if serial in usb else None
+            cams.append(camera_spec(serial, settings["Size Width"], settings["Size Height"], self.writer_args[serial]["fps"],
+                                    settings["Pixel Format"], self.profiles[serial], settings["Exposure Time"], model,
+                                    bus, usb.get(serial, {}).get("speed")))
+        report = plan(cams, duration=3600)
+        self.disk_rates = {serial: c["disk_bytes_per_second"] for serial, c in report["cameras"].items()}
+        self.logger.event("capacity_plan", plan_str(report), **report)
+        for problem in report["problems"]:
+            self.logger.log("Warning: " + problem, stdout=True)
+
+    def bedsy_message(self, msg):
+        """ Logs a message from the BeDSy queue (a tuple of its isoformat timestamp and the text) and returns it."""
+        host_t = time.time()
+        self.bedsy_messages.append((host_t, msg[0], msg[1]))
+        self.logger.event("bedsy", "BeDSy: {}".format(msg[1]), host_time=host_t, bedsy_time=str(msg[0]), message=msg[1])
+        return msg
+
+    def save_session_index(self):
+        """ Writes the session's frame table (see session_index.py), which frame of each camera belongs to which trigger or instant."""
+        fname = frame_table_filename(self.segment_index.filename)
+        try:
+            index = SessionIndex.build(self.segment_index.filename, self.bedsy_messages, 'trigger' if self.use_bedsy else 'time')
+            index.save(fname)
+        except Exception as e: # the videos are complete anyway, the table can be built again later
+            self.logger.log("Could not write the frame table {}: {}".format(fname, e), stdout=True)
+            return
+        self.logger.event("session_index", "Frame table {}: {}.".format(os.path.basename(fname), index.summary_str()), stdout=True,
+                          filename=fname, rows=len(index), align=index.align)
+
+    def log_grab_stats(self, serial, segment, statistics):
+        """ Logs the frames of this camera lost before the ring during the segment (see grab_stats.py), on stdout only if there were some."""
+        stats = self.grab_stats[serial]
+        report = stats.segment_report(statistics)
+        self.logger.event("grab_stats", "Cam {} segment {}: {}.".format(serial, segment, stats.report_str(report)), stdout=report["lost"] > 0,
+                          serial=serial, segment=segment, **report)
+
+    def log_ring_stats(self):
+        for serial, ring in self.rings.items():
+            self.logger.log("Cam {}: {}.".format(serial, ring.stats_str()), stdout=True)
+
+    def log_cpu_usage(self):
+        """ CPU used per camera by its grab thread (idle = waiting for the first frame) and its encode thread."""
+        for name, meter in sorted(self.cpu_meters.items()):
+            self.logger.log("{} thread: {}.".format(name.capitalize(), meter.report_str()), stdout=True)
+        self.cpu_meters = dict()
+
+    def encoder_failed(self, serial, err):
+        self.logger.event("encoder_failed", "Writer of cam {} failed: {}".format(serial, err), stdout=True, serial=serial, error=str(err))
+
+    def segment_closed(self, serial, info):
+        """ Called (from a background thread) when the file of a segment is complete."""
+        report = info["report"]
+        if info["first_host_time"] is not None and info["end_time"] > info["first_host_time"]:
+            # share of the segment's time the encoder spent waiting for ffmpeg to take frames, near 100% means it is at its limit
+            busy = info["write_seconds"] / (info["end_time"] - info["first_host_time"])
+            report += ", writer busy {:.0%} of the time".format(busy)
+            if info["write_seconds"] > 0:
+                report += " ({:.1f} MB/s into {})".format(info["bytes_written"] / info["write_seconds"] / 1e6, "the raw files" if info["filename"].endswith(".raw") else "ffmpeg")
+        self.logger.event("segment_closed", "Cam {} segment {} ({}): {}.".format(serial, info["segment"], os.path.basename(info["filename"]), report),
+                          stdout=True, serial=serial, **{k: v for k, v in info.items() if k != "report"})
+        self.segment_index.add(serial, info)
+        size = self.storage.closed(info["filename"])
+        if info["first_host_time"] is not None and info["end_time"] > info["first_host_time"] + 1.0:
+            self.disk_rates[serial] = size / (info["end_time"] - info["first_host_time"]) # plans the next files of this camera
+
+    def handle_encoder_messages(self, msgs):
+        """ Logs what the encoder processes reported."""
+        for msg in msgs:
+            if msg[0] == 'error':
+                self.encoder_failed(msg[1] if msg[1] else "(process)", msg[2])
+            elif msg[0] == 'closed':
+                self.segment_closed(msg[1], msg[2])
+            elif msg[0] == 'cpu':
+                self.logger.log("Encode {} process: {}.".format(msg[1], msg[2]), stdout=True)
+            elif msg[0] == 'log':
+                self.logger.log("Cam {}: {}.".format(msg[1], msg[2]), stdout=True)
+            elif msg[0] == 'metrics':
+                self.metrics[msg[1]].encoder = msg[2]["encoder"]
+                self.metrics[msg[1]].write_latency.set_state(msg[2]["write_latency"])
+
+    def collect_metrics(self):
+        """ Copies the current counters into the metrics registry (called by the metrics exporter thread)."""
+        for serial, m in self.metrics.cameras.items():
+            m.frames_grabbed = self.frame_counter_dict[serial]
+            m.grab = self.grab_stats[serial].totals(read_stream_statistics(self.camera_of[serial]))
+            ring = self.rings.get(serial)
+            if ring is not None:
+                m.ring = ring.stats()
+            encoder = self.encoders.get(serial)
+            if encoder is not None: # the encoder processes send theirs
+                m.encoder = encoder.metrics()
+        self.metrics.extra = {"segment": self.segment, "encoder_profiles": dict(self.profiles), "storage": self.storage.status()}
+
+    def segmented(self):
+        """ True if the recording can roll over to new files."""
+        return self.use_bedsy or bool(self.segment_seconds) or bool(self.segment_bytes)
+
+    def time_to_segment_end(self):
+        """ Seconds until the current segment is due to end by its duration (free-run mode)."""
+        if not self.segment_seconds:
+            return float('inf')
+        return max(0.0, self.start_t + self.segment_seconds - time.time())
+
+    def segment_due(self):
+        """ True if the current segment has reached segment_seconds or one of its videos segment_bytes (free-run mode)."""
+        if self.segment_seconds and self.time_to_segment_end() == 0:
+            return True
+        if self.segment_bytes:
+            for serial in self.serials:
+                fname = self.segment_filename(serial, self.segment)
+                try:
+                    size = raw_size(fname) if fname.endswith(".raw") else os.path.getsize(fname)
+                except OSError:
+                    continue
+                if size >= self.segment_bytes:
+                    return True
+        return False
+
+    def segment_filename(self, serial, segment):
+        """ The video file of a segment, on the volume chosen for it when it was first asked for."""
+        if (serial, segment) not in self.segment_files:
+            self.segment_files[(serial, segment)] = self.new_segment_file(serial, segment)
+        return self.segment_files[(serial, segment)]
+
+    def expected_segment_bytes(self, serial):
+        if self.segment_bytes:
+            return self.segment_bytes
+        return self.disk_rates[serial] * (self.segment_seconds or DEFAULT_FILE_SECONDS)
+
+    def new_segment_file(self, serial, segment):
+        """ Chooses the volume for a segment's video and reserves its space (see storage.py)."""
+        ext = profile_extension(self.profiles[serial])
+        if self.segmented():
+            # numbered, because the file of the next segment is opened before it starts
+            name = "{}_{}_rec_{:04d}.{}".format(self.fpre, serial, segment, ext)
+        else:
+            name = self.fpre+'_'+serial+'_rec.'+ext
+        nbytes = self.expected_segment_bytes(serial)
+        volume = self.storage.choose(serial, nbytes, self.disk_rates[serial])
+        if not self.storage.fits(volume, nbytes):
+            self.logger.log("Warning: no volume has {:.1f} GB (plus {:.1f} GB to keep free) for segment {} of cam {}, it goes to {} ({:.1f} GB free).".format(
+                nbytes / 1e9, self.min_free_bytes / 1e9, segment, serial, volume.folder, volume.free() / 1e9), stdout=True)
+        fname = os.path.join(volume.folder, name)
+        # raw videos allocate their chunk files themselves
+        self.storage.reserve(fname, nbytes, allocate=ENCODER_PROFILES[self.profiles[serial]].get("writer", "ffmpeg") == "ffmpeg")
+        return fname
+
+    def segment_writer_args(self, serial, segment):
+        args = dict(filename=self.segment_filename(serial, segment), **self.writer_args[serial])
+        args.update(profile_writer_args(self.profiles[serial], args["pixfmt"]))
+        args["preallocate_bytes"] = self.storage.preallocation(args["filename"]) # done by create_writer, after a replaced writer removed the file
+        return args
+
+    def check_storage(self):
+        """ Checks the free space of the volumes (at most once a second) and moves the next segment of the
+        cameras away from volumes that are running full. Returns True if a camera is writing to such a
+        volume now and its next segment could be moved, i.e. if there should be a rollover now."""
+        now = time.time()
+        if now < self.storage_check_t + 1.0:
+            return False
+        self.storage_check_t = now
+        low = self.storage.low_volumes()
+        for v in low:
+            if v.folder not in self.storage_low:
+                self.logger.event("storage_low", "Volume {} has only {:.1f} GB left (keeping {:.1f} GB free){}.".format(
+                    v.folder, v.available() / 1e9, self.min_free_bytes / 1e9, "" if self.segmented() else ", but this recording is not segmented"),
+                    stdout=True, folder=v.folder, free_bytes=v.free(), available_bytes=v.available())
+        self.storage_low = {v.folder for v in low}
+        if not low or not self.segmented():
+            return False
+        move = [serial for serial in self.serials if self.storage.volume_of(self.segment_files[(serial, self.segment + 1)]) in low]
+        if move:
+            self.prepare_next_segment(move, replace=True, new_files=True)
+        on_low = [serial for serial in self.serials if self.storage.volume_of(self.segment_files[(serial, self.segment)]) in low]
+        movable = [serial for serial in on_low if self.storage.volume_of(self.segment_files[(serial, self.segment + 1)]) not in low]
+        if movable:
+            self.logger.event("storage_redirect", "Cams {} move to {} with segment {}.".format(
+                ", ".join(movable), ", ".join(sorted({self.storage.volume_of(self.segment_files[(s, self.segment + 1)]).folder for s in movable})), self.segment + 1),
+                stdout=True, serials=movable, segment=self.segment + 1)
+        return bool(movable)
+
+    def start_encoders(self):
+        self.segment = 0
+        if self.encoder_backend == 'process':
+            self.encoder_procs = []
+            for group in mp_encoder.group_serials(self.serials, self.cameras_per_process):
+                specs = []
+                for serial in group:
+                    args = self.segment_writer_args(serial, self.segment)
+                    specs.append({"serial": serial, "ring": self.rings[serial].spec(), "writer": args,
+                                  "sidecar": sidecar_filename(args["filename"]), "segment": self.segment, "write_batch": self.write_batch,
+                                  "activity_gate": self.activity_gate})
+                proc = mp_encoder.EncoderProcess(specs)
+                self.encoder_procs.append(proc)
+                for serial in group:
+                    self.encoder_proc_of[serial] = proc
+        else:
+            for serial in self.serials:
+                args = self.segment_writer_args(serial, self.segment)
+                writer = create_writer(**args)
+                sidecar = FrameSidecar(sidecar_filename(args["filename"]))
+                self.encoders[serial] = FrameEncoder(serial, self.rings[serial], writer, sidecar, self.write_batch,
+                                                     on_error=self.encoder_failed, on_segment_closed=self.segment_closed, segment=self.segment,
+                                                     on_written=self.metrics[serial].written,
+                                                     gate=ActivityGate(**self.activity_gate) if self.activity_gate is not None else None)
+                self.e_threads[serial] = threading.Thread(target=self.encoders[serial].run)
+                self.e_threads[serial].daemon = True
+                self.e_threads[serial].start()
+        if self.segmented():
+            self.prepare_next_segment()
+
+    def prepare_next_segment(self, serials=None, replace=False, new_files=False):
+        """ Starts the writers of the next segment ahead of time, so a rollover only has to switch to them.
+        With replace=True, the writers already prepared for these cameras are replaced (new settings),
+        with new_files=True also their files (on the volume chosen now)."""
+        for serial in (self.serials if serials is None else serials):
+            if replace and self.encoder_backend != 'process':
+                self.encoders[serial].discard_prepared() # the encoder processes do that themselves
+            if new_files and (serial, self.segment + 1) in self.segment_files:
+                self.storage.forget(self.segment_files.pop((serial, self.segment + 1)))
+            args = self.segment_writer_args(serial, self.segment + 1)
+            if self.encoder_backend == 'process':
+                self.encoder_proc_of[serial].send(('prepare', serial, args, sidecar_filename(args["filename"]), replace))
             else:
-                grabResult = c.RetrieveResult(500, pylon.TimeoutHandling_ThrowException)
-                #self.start_t = self.logger.logWithTime("Started recording with {} Basler camera{}.".format(self.num_cams, 's' if self.num_cams>1 else ''), stdout=True)
-            #serial = self.cameras[grabResult.GetCameraContext()].DeviceInfo.GetSerialNumber()
-            # Write image to video
-            frame = grabResult.GetArray()
-            #self.frames[serial] = frame
-            self.frames[serial].append(frame)
-            self.writers[serial].write_frame(frame)
-            grabResult.Release()
-            self.frame_counter_dict[serial] += 1
-            time.sleep(0)
-        #self.end_t = time.time()
-        c.StopGrabbing()
+                self.encoders[serial].prepare(create_writer(**args), FrameSidecar(sidecar_filename(args["filename"])))
+
+    def handle_backpressure(self, serial):
+        """ The encoder of this camera has been behind for a while: encode its next segment with a
+        faster profile (if there is one and the recording is segmented) and refresh the preview less often.
+        A profile that writes more (ffv1_gray -> rawvideo) is only taken if the disk would keep up."""
+        self.logger.event("backpressure", "Encoder of cam {} cannot keep up ({}).".format(serial, self.backpressure.status_str(serial)),
+                          stdout=True, serial=serial, **self.backpressure.status.get(serial, {}))
+        profile = self.profiles[serial]
+        raw_rate = self.uncompressed_bytes_per_second(serial)
+        cpu_bound = self.disk_keeps_up(serial, raw_rate)
+        faster = faster_profile(profile, cpu_bound)
+        if faster is not None and self.segmented():
+            self.logger.event("profile_changed", "Cam {}: encoder profile {} -> {} from segment {} on.".format(serial, profile, faster, self.segment + 1),
+                              stdout=True, serial=serial, old=profile, new=faster, segment=self.segment + 1)
+            self.profiles[serial] = faster
+            writes_more = ENCODER_PROFILES[profile].get("faster_if_cpu_bound", False)
+            if writes_more:
+                self.disk_rates[serial] = raw_rate # the space of the next file is planned for that
+            self.prepare_next_segment([serial], replace=True, new_files=writes_more)
+        elif faster is None and faster_profile(profile) is not None:
+            self.logger.log("Cam {}: keeping profile {}, the disk may be the limit and {} would write {:.1f} MB/s.".format(
+                serial, profile, faster_profile(profile), raw_rate / 1e6), stdout=True)
+        elif faster is not None:
+            self.logger.log("Cam {}: profile {} would be faster, but this recording is not segmented.".format(serial, faster), stdout=True)
+        if self.preview.enabled and self.preview.slow_down():
+            self.logger.log("Preview slowed down to {:.2f} fps.".format(1.0 / self.preview.interval), stdout=True)
+
+    def uncompressed_bytes_per_second(self, serial):
+        """ What this camera's frames take on disk without compression, at the rate it delivers them."""
+        width, height = self.writer_args[serial]["size"]
+        fps = self.backpressure.status.get(serial, {}).get("camera_fps") or self.writer_args[serial]["fps"]
+        return width * height * self.ring_dtype()().itemsize * fps
+
+    def disk_keeps_up(self, serial, nbytes_per_second):
+        """ Whether the volume of this camera's next file takes nbytes_per_second on top of what the other
+        cameras write to it (measured speed, see storage.py). If it does, an encoder that is behind is limited
+        by its CPU, not by the disk. False where the speed is not known."""
+        filename = self.segment_files.get((serial, self.segment + 1)) or self.segment_files.get((serial, self.segment))
+        volume = self.storage.volume_of(filename) if filename else None
+        if volume is None or not volume.measured_bytes_per_second:
+            return False
+        return self.storage.spare_bytes_per_second(volume, serial) >= nbytes_per_second
+
+    def rollover(self):
+        """ Switches every camera to the next segment's writer at its current frame, without
+        stopping the grabbing. The old files are closed in the background.
+        Returns the grab index of every camera's first frame in the new segment."""
+        switch_indices = dict()
+        for serial in self.serials:
+            # the next frame grabbed by this camera is the first one of the new segment
+            switch_indices[serial] = self.frame_counter_dict[serial]
+            if self.encoder_backend == 'process':
+                self.encoder_proc_of[serial].send(('switch', serial, switch_indices[serial]))
+            else:
+                self.encoders[serial].switch_at(switch_indices[serial])
+        for serial in self.serials:
+            self.log_grab_stats(serial, self.segment, read_stream_statistics(self.camera_of[serial]))
+        self.segment += 1
+        self.logger.event("rollover", "Segment {} starts at frame {}.".format(self.segment, switch_indices), stdout=True,
+                          segment=self.segment, switch_indices=switch_indices)
+        self.prepare_next_segment()
+        return switch_indices
+
+    def wait_for_trigger_pause(self, timeout=2.0):
+        """ Waits until no camera has retrieved a frame for three frame intervals (after BeDSy stopped the
+        triggers for a rollover), so the frames triggered before the stop but still queued in pylon are
+        counted in the old segment. Returns False if the frames kept coming until the timeout."""
+        t_end = time.time() + timeout
+        while True:
+            now = time.time()
+            if all(now - self.last_grab_t.get(serial, 0.0) > 3.0 / self.writer_args[serial]["fps"] for serial in self.serials):
+                return True
+            if now > t_end:
+                return False
+            time.sleep(0.005)
+
+    def stop_writers(self):
+        """ Stops the grab threads, lets the encoders write what is still queued, closes
+        the videos and logs per camera what was recorded and dropped."""
+        self.writers_stop.set()
+        for t in self.c_threads.values():
+            if t.is_alive():
+                t.join()
+        for t in self.e_threads.values():
+            if t.is_alive():
+                t.join()
+        for serial in self.grab_stats:
+            self.log_grab_stats(serial, self.segment, self.final_statistics.get(serial))
+        for serial, encoder in self.encoders.items():
+            encoder.close() # logs the last segment through segment_closed
+            self.cpu_meters["encode " + serial] = encoder.cpu
+            if encoder.gate is not None:
+                self.logger.log("Cam {}: {}.".format(serial, encoder.gate.report_str()), stdout=True)
+        for proc in self.encoder_procs:
+            self.handle_encoder_messages(proc.stop())
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.stop() # writes the final status
+            self.metrics_exporter = None
+        self.log_ring_stats()
+        self.log_cpu_usage()
+        for ring in self.rings.values():
+            if isinstance(ring, mp_encoder.SharedFrameRing):
+                ring.detach()
+        self.c_threads = dict()
+        self.e_threads = dict()
+        self.encoders = dict()
+        self.encoder_procs = []
+        self.encoder_proc_of = dict()
+        self.rings = dict()
 
     # def start_writing_frames_in_thread(self):
     #     self.writer_thread = threading.Thread(target=self.start_writing_frames, args=())
@@ -194,16 +814,26 @@ class BaslerMouseRecorder():
             serial = c.GetDeviceInfo().GetSerialNumber()
             self.c_threads[serial] = threading.Thread(target=self.cam_start_writing_frames, args=(c, serial))
             self.c_threads[serial].daemon = True
-            self.writers_ready[serial] = False
-            self.c_threads[serial].start()
-            self.frames[serial] = deque(maxlen=1)
-        self.start_t = self.logger.logWithTime("Started recording with {} Basler camera{}.".format(self.num_cams, 's' if self.num_cams>1 else ''), stdout=True)
+            self.writers_ready[serial] = threading.Event()
+            ring_class = mp_encoder.SharedFrameRing if self.encoder_backend == 'process' else FrameRing
+            self.rings[serial] = ring_class((self.size[1], self.size[0]), dtype=self.ring_dtype(), depth=self.ring_depth)
+        self.metrics = MetricsRegistry(self.serials, self.fpre)
+        self.start_encoders()
+        if self.status_json or self.metrics_port is not None:
+            json_path = str(self.vid_dir / (self.fpre + "_status.json")) if self.status_json else None
+            self.metrics_exporter = MetricsExporter(self.metrics, self.collect_metrics, json_path, self.metrics_port,
+                                                    on_error=lambda e: self.logger.log("Warning: metrics not updated: {!r}".format(e), stdout=True))
+        for t in self.c_threads.values():
+            t.start()
 
     def start_recording(self):
+        startup_t0 = time.perf_counter()
         self.set_logfile()
         self.logger.startLogging()
+        self.storage = None
+        self.segment_index = SegmentIndex(segment_index_filename(self.vid_dir, self.fpre))
+        self.bedsy_messages = [] # (host time, BeDSy time, message), for the session's frame table
         self.frame_counter_dict = dict()
-        self.frames = dict()
         recmanager_thread = threading.currentThread()
 
         #self.manager_running = True
@@ -213,173 +843,262 @@ class BaslerMouseRecorder():
         self.tlFactory = pylon.TlFactory.GetInstance()
 
         # Get all attached devices and exit application if no device is found.
-        # Rescan for 5 seconds before giving up
+        # Rescan for 5 seconds before giving up, waiting longer each time (cameras that were just reset take a while)
         self.devices = None
         timeout = timedelta(seconds=5)
         start = datetime.now()
+        delay = 0.05
         while (not self.devices) and ((datetime.now()-start) < timeout):
             self.devices = self.tlFactory.EnumerateDevices()
+            if not self.devices:
+                time.sleep(delay)
+                delay = min(2 * delay, 1.0)
+        self.startup_times = {"enumerate": time.perf_counter() - startup_t0}
+        if self.usb_reset_report is not None:
+            self.logger.event("usb_reset", reset_report_str(self.usb_reset_report), **self.usb_reset_report)
+            self.usb_reset_report = None # it happened before this recording only
+        self.first_frame_t = dict()
+        self.grab_stopped_t = dict()
+        self.last_grab_t = dict()
+        self.latency = dict()
         if len(self.devices) == 0:
             self.logger.log("Cannot start: No Basler camera found.", stdout=True)
+            self.segment_index.close()
             self.logger.closeLogger()
             return 1
+        recording_start_t = None
+        bedsy_started = False
         try:
             bedsy_initialised = False
-            #print("running main loop")
-            while getattr(recmanager_thread, "thread_running"):
-                #print("running recurring loop")
+            self.writers_stop.clear() # this flag controls the threads which grab frames and write them to a file
+            # start up the bedsy
+            if self.use_bedsy:
+                #print("DEBUG", "Initializing BeDSy...")
+                q = queue.Queue()
+                bedsy = Bedsy(q, ["VID:PID=16C0:0483", "SER=13567420"]) # teensy 4.0                
+                #bedsy = Bedsy(q, ["VID:PID=16C0:0483", "SER=14487510"]) # teensy 4.1
+            # Create an array of instant cameras for the found devices and avoid exceeding a maximum number of devices.
+            # Attach all Pylon Devices, make settings and create writers.
+            # This is done once: on a rollover the cameras keep grabbing and only the files change.
+            self.cameras = pylon.InstantCameraArray(min(len(self.devices), maxCamerasToUse))
+            # Make the setup for each cam, log that it was found, create a writer for it etc.
+            self.writer_args = dict()
+            self.serials = []
+            self.camera_of = dict() # serial -> InstantCamera
+            self.grab_stats = dict()
+            self.final_statistics = dict()
+            self.num_cams = 0
+            # Opening and configuring takes a while per camera (USB round trips), so all cameras are set up at the same time.
+            t_setup = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=len(self.cameras)) as pool:
+                setups = list(pool.map(self.setup_cam, self.cameras, range(len(self.cameras))))
+            self.startup_times["setup"] = time.perf_counter() - t_setup
+            self.startup_times["cameras"] = dict()
+            for cam, (serial, model, settings, timing) in zip(self.cameras, setups):
+                self.serials.append(serial)
+                self.camera_of[serial] = cam
+                self.startup_times["cameras"][serial] = timing
+                self.logger.event("camera_found", "Found Basler cam {} ({}).".format(serial, model), stdout=True,
+                                  serial=serial, model=model, settings=settings)
+                self.logger.log("Settings:", stdout=False)
+                self.logger.log(self.get_cam_settings(cam, settings), stdout=False)
+                self.num_cams += 1
+                pixfmt = PIXEL_FORMATS[settings["Pixel Format"]]["pixfmt"]
+                fps = self.bedsy_fps if self.use_bedsy else settings["->Resulting Frame Rate"]
+                self.writer_args[serial] = dict(size=self.size, fps=fps, pixfmt=pixfmt, ffmpeg_command=self.ffmpeg_command)
+                self.profiles[serial] = self.camera_profiles.get(serial, self.encoder_profile)
+                self.logger.log("Cam {} encoder profile: {}.".format(serial, self.profiles[serial]), stdout=True)
+                grab = self.camera_grab.get(serial, dict())
+                self.grab_stats[serial] = GrabStats(grab.get("strategy", self.grab_strategy), grab.get("max_num_buffer", self.max_num_buffer))
+                self.logger.log("Cam {} grab strategy {} with {} buffers{}.".format(serial, self.grab_stats[serial].strategy, self.grab_stats[serial].max_num_buffer or "pylon's default number of",
+                                "" if self.grab_stats[serial].strategy in LOSSLESS_GRAB_STRATEGIES else " (drops frames when the recorder falls behind, they are counted)"), stdout=True)
+                self.frame_counter_dict[serial] = 0
+            self.check_capacity(setups)
+            t_storage = time.perf_counter()
+            # the write speed decides between the volumes, and whether an encoder that falls behind may change to a profile that writes more
+            measure = (self.storage_volumes and len(self.storage_volumes) > 1) or (
+                self.segmented() and any(ENCODER_PROFILES[p].get("faster_if_cpu_bound") for p in self.profiles.values()))
+            self.storage = StorageManager(self.storage_volumes or [self.vid_dir], self.min_free_bytes, self.preallocate,
+                                          measure_bytes=64 * 2**20 if measure else 0)
+            self.startup_times["storage"] = time.perf_counter() - t_storage
+            self.segment_files = dict()
+            self.storage_check_t = 0.0
+            self.storage_low = set() # folders of the volumes reported as running full
+            self.logger.event("storage", "Storage: {}.".format(self.storage.status_str()), stdout=True, volumes=self.storage.status())
+            self.preview = MosaicPreview(self.serials, self.size, enabled=self.show_preview, fps=self.preview_fps)
+            # Start grabbing and writing to video file
+            t_start = time.perf_counter()
+            self.cam_start_writing_frames_in_thread()
+            self.startup_times["start_writers"] = time.perf_counter() - t_start
+            if self.use_bedsy:
+                #print("DEBUG","Hello")
+                stopping = False
+                for ready in self.writers_ready.values():
+                    while not ready.wait(timeout=0.5):
+                        if not getattr(recmanager_thread, "thread_running"):
+                            stopping = True # stopped while waiting, do not wait for the other cameras
+                            break
+                    if stopping:
+                        break
+            self.log_startup_times(startup_t0)
+            self.armed.set()
+            if self.auto_start:
+                self.start_armed()
+            else:
+                self.logger.event("armed", "Armed, waiting for the start.", stdout=True)
+            while not self.start_event.wait(0.05):
+                if not getattr(recmanager_thread, "thread_running"):
+                    break
+            if self.start_event.is_set() and getattr(recmanager_thread, "thread_running"):
+                self.start_t = recording_start_t = self.start_cue_t
+                self.logger.event("recording_started", "Started recording with {} Basler camera{}.".format(self.num_cams, 's' if self.num_cams>1 else ''),
+                                  stdout=True, serials=self.serials, session=self.fpre, start_time=self.start_cue_t)
+            if self.use_bedsy and recording_start_t is not None:
+                #print("DEBUG", "Starting BeDSy...")
+                bedsy.start_bedsy()
+                bedsy_started = True
+                msg = self.bedsy_message(q.get(timeout=3))
+                #print("DEBUG", msg)
+                if "[START]" not in msg[1]:
+                    #print("DEBUG", "[START] not in msg")
+                    while q.qsize() > 0:
+                        msg = self.bedsy_message(q.get())
+                        #print("DEBUG", msg)
+                        if "[START]" in msg[1]:
+                            break
+                if "[START]" not in msg[1]:
+                    raise IOError("Problem with the BeDSy!")
+                else:
+                    self.logger.logWithTime("BeDSy started.")
+                    #print("DEBUG", "BeDSy started.")
+                    bedsy_initialised = True
+            segment_start_counts = {serial: 0 for serial in self.serials}
+            self.backpressure = BackpressureMonitor(self.rings, hold_seconds=self.backpressure_seconds)
+
+            # Display current frames
+            while getattr(recmanager_thread, "thread_running") and not self.writers_stop.is_set():
                 do_rollover = False
-                self.writers_running = True # this flag controls the thread which grabs frames and writes them to a file
-                # start up the bedsy
-                if self.use_bedsy and not bedsy_initialised:
-                    #print("DEBUG", "Initializing BeDSy...")
-                    q = queue.Queue()
-                    bedsy = Bedsy(q, ["VID:PID=16C0:0483", "SER=13567420"]) # teensy 4.0                
-                    #bedsy = Bedsy(q, ["VID:PID=16C0:0483", "SER=14487510"]) # teensy 4.1
-                # Create an array of instant cameras for the found devices and avoid exceeding a maximum number of devices.
-                # Attach all Pylon Devices, make settings and create writers.
-                self.cameras = pylon.InstantCameraArray(min(len(self.devices), maxCamerasToUse))
-                # Make the setup for each cam, log that it was found, create a writer for it etc.
-                self.writers = dict()
-                self.serials = []
-                self.num_cams = 0
-                for n, cam in enumerate(self.cameras):
-                    self.set_cam_settings(cam, n)
-                    serial = cam.DeviceInfo.GetSerialNumber()
-                    self.serials.append(serial)
-                    self.logger.log("Found Basler cam {} ({}).".format(serial, cam.GetDeviceInfo().GetModelName()), stdout=True)
-                    self.logger.log("Settings:", stdout=False)
-                    self.logger.log(self.get_cam_settings(cam), stdout=False)
-                    self.num_cams += 1
-                #while getattr(recmanager_thread, "thread_running", True):
-                    #for n, cam in enumerate(self.cameras):
-                    #    self.set_cam_settings(cam, n)
-                    #self.writers_running = True
-                    if self.use_bedsy:
-                        # Make sure the filename changes for rollover logs
-                        fpre_upd = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
-                        vid_fname = str(self.vid_dir / (fpre_upd+'_'+serial+'_rec.avi'))
-                        print(vid_fname)
-                    else:
-                        vid_fname = str(self.vid_dir / (self.fpre+'_'+serial+'_rec.avi'))
-                    pixfmt = 'gray' if cam.PixelFormat.Value=='Mono8' else ('gray12le' if cam.PixelFormat.Value=='Mono12p' else 'error')
-                    if self.use_bedsy:
-                        self.writers[serial] = r2v.FFMPEG_VideoWriter(vid_fname, self.size, fps=self.bedsy_fps, pixfmt=pixfmt, ffmpeg_command=self.ffmpeg_command)
+                trigger_pause = False
+                self.preview.show({serial: ring.dropped for serial, ring in self.rings.items()})
+                for proc in self.encoder_procs:
+                    self.handle_encoder_messages(proc.poll())
+                for serial in self.backpressure.sample():
+                    self.handle_backpressure(serial)
+                if "start" not in self.latency and self.first_frames_in.is_set():
+                    self.log_start_latency()
+                if self.use_bedsy:
+                    try:
+                        # try to get a message from the queue
+                        # they will be tuples:
+                        # first item: isoformat timestamp, second item: message
+                        # this blocks until a message arrives, so the loop does not spin
+                        msg = self.bedsy_message(q.get(timeout=0.1))
+                    except queue.Empty:
+                        self.preview.wait(1)
                     else:
-                        self.writers[serial] = r2v.FFMPEG_VideoWriter(vid_fname, self.size, fps=cam.ResultingFrameRate.Value, pixfmt=pixfmt, ffmpeg_command=self.ffmpeg_command)
-                    self.frame_counter_dict[serial] = 0
-                # Start grabbing and writing to video file
-                self.cam_start_writing_frames_in_thread()
-                self.logger.logWithTime("Started recording.", stdout=True)
-                if self.use_bedsy and not bedsy_initialised:
-                    #print("DEBUG","Hello")
-                    while not all(self.writers_ready):
-                        time.sleep(0)
-                    #print("DEBUG", "Starting BeDSy...")
-                    bedsy.start_bedsy()
-                    got_start_msg = False
-                    msg = q.get(timeout=3)
-                    #print("DEBUG", msg)
-                    if "[START]" not in msg[1]:
-                        #print("DEBUG", "[START] not in msg")
-                        while q.qsize() > 0:
-                            msg = q.get()
-                            #print("DEBUG", msg)
-                            if "[START]" in msg[1]:
-                                break
-                    if "[START]" not in msg[1]:
-                        raise IOError("Problem with the BeDSy!")
-                    else:
-                        self.logger.logWithTime("BeDSy started.")
-                        #print("DEBUG", "BeDSy started.")
-                        bedsy_initialised = True
-                        
-                #time.sleep(1)
-                # Display current frames
-                for serial in self.serials:
-                    cv2.namedWindow(f'Basler {serial}', cv2.WINDOW_NORMAL)
-                    cv2.resizeWindow(f'Basler {serial}', 968, 608)
-                while getattr(recmanager_thread, "thread_running") and not do_rollover:
-                    for serial in self.serials:
-                        if serial in self.frames:
-                            try:
-                                cv2.imshow(f'Basler {serial}', self.frames[serial].pop())
-                            except IndexError:
-                                pass
-                    if self.use_bedsy:
-                        try:
-                            # try to get a message from the queue
-                            # they will be tuples:
-                            # first item: isoformat timestamp, second item: message
-                            msg = q.get(block=False)
-                        except queue.Empty:
-                            cv2.waitKey(1)
-                            time.sleep(0)
-                        else:
-                            if "[STOP_ROLLOVER]" in msg[1]:
-                                self.writers_running = False
-                                self.end_t = time.time()
-                                self.logger.logWithTime("Recording rollover...", stdout=True)
-                                cv2.destroyAllWindows()
-                                #self.writer_thread.join()
-                                for t in self.c_threads.values():
-                                    t.join()
-                                for writer in self.writers.values(): writer.close()
-                                self.frames = dict()
-                                frame_avg = sum([f for f in self.frame_counter_dict.values()]) / len(self.frame_counter_dict)
-                                self.total_t += self.end_t-self.start_t
-                                self.logger.log("Recorded {} frames in about {:.2f} seconds ({}) -> about {:.2f} fps.".format(self.frame_counter_dict, self.end_t-self.start_t, self.logger.durationToTimeStr(self.start_t,self.end_t), frame_avg/(self.end_t-self.start_t)), stdout=True)
-                                #for serial in self.serials:
-                                #    cv2.namedWindow(f'Basler {serial}', cv2.WINDOW_NORMAL)
-                                #    cv2.resizeWindow(f'Basler {serial}', 968, 608)
-                                do_rollover = True
-                    else:
-                        cv2.waitKey(750) # ms
-                        time.sleep(0)
+                        # BeDSy sends [START] again after a rollover, the cameras are still grabbing then
+                        do_rollover = trigger_pause = "[STOP_ROLLOVER]" in msg[1]
+                else:
+                    self.preview.wait(min(750, 1000 * self.preview.interval, 1000 * self.time_to_segment_end()), self.writers_stop) # ms
+                    do_rollover = self.segment_due()
+                do_rollover = self.check_storage() or do_rollover
+                if do_rollover:
+                    self.end_t = time.time()
+                    self.logger.logWithTime("Recording rollover...", stdout=True)
+                    if trigger_pause and not self.wait_for_trigger_pause():
+                        self.logger.log("Warning: the frames kept coming after BeDSy's [STOP_ROLLOVER], the segments are split where the cameras are now.", stdout=True)
+                    switch_indices = self.rollover()
+                    frames = {serial: switch_indices[serial] - segment_start_counts[serial] for serial in self.serials}
+                    segment_start_counts = switch_indices
+                    frame_avg = sum(frames.values()) / len(frames)
+                    self.total_t += self.end_t-self.start_t
+                    self.logger.log("Recorded {} frames in about {:.2f} seconds ({}) -> about {:.2f} fps.".format(frames, self.end_t-self.start_t, self.logger.durationToTimeStr(self.start_t,self.end_t), frame_avg/(self.end_t-self.start_t)), stdout=True)
+                    self.start_t = self.end_t
 
         finally: # Clean up and log the fps
-            self.writers_running = False
+            self.writers_stop.set()
             setattr(recmanager_thread, "thread_running", False)
             self.manager_running = False
-            if self.use_bedsy:
+            if bedsy_started:
                 bedsy.stop_bedsy()
-                msg = q.get(timeout=3)
+                msg = self.bedsy_message(q.get(timeout=3))
                 if "[STOP_PERMANENT]" not in msg[1]:
                     while q.qsize() > 0:
-                        msg = q.get()
+                        msg = self.bedsy_message(q.get())
                         if "[STOP_PERMANENT]" in msg[1]:
                             self.logger.logWithTime("BeDSy stopped.")
                             bedsy_initialised = False
                             break
-            self.logger.logWithTime("Stopped recording.", stdout=True)
-            time.sleep(1)
-            cv2.destroyAllWindows()
+            self.logger.event("recording_stopped", "Stopped recording.", stdout=True)
+            if self.preview is not None:
+                self.logger.log(self.preview.stats_str(), stdout=True)
+                self.preview.close()
+                self.preview = None
             #self.cameras.StopGrabbing()
             #if self.writer_thread is not None and self.writer_thread.is_alive(): self.writer_thread.join()
             #self.writer_thread = None
-            for t in self.c_threads.values():
-                if t.is_alive():
-                    t.join()
             self.end_t = time.time()
-            self.c_threads = dict()
-            for writer in self.writers.values(): writer.close()
+            self.stop_writers()
+            if self.storage is not None:
+                self.logger.event("storage_summary", "Storage: {}.".format(self.storage.status_str()), stdout=True, volumes=self.storage.status())
+            self.segment_index.close()
+            if self.stop_cue_t is not None:
+                self.log_stop_latency()
+            self.save_session_index()
             frame_avg = sum([f for f in self.frame_counter_dict.values()]) / len(self.frame_counter_dict)
             #if not self.use_bedsy:
-            self.total_t = self.end_t-self.start_t
-            self.logger.log("\nRecorded {} frames in about {:.2f} seconds ({}) -> about {:.2f} fps.".format(self.frame_counter_dict, self.total_t, self.logger.durationToTimeStr(self.total_t), frame_avg/(self.total_t)), stdout=True)
+            self.total_t = self.end_t-recording_start_t if recording_start_t is not None else 0.0 # over all segments
+            if self.total_t > 0:
+                self.logger.log("\nRecorded {} frames in about {:.2f} seconds ({}) -> about {:.2f} fps.".format(self.frame_counter_dict, self.total_t, self.logger.durationToTimeStr(self.total_t), frame_avg/(self.total_t)), stdout=True)
+            else:
+                self.logger.log("Stopped before the recording was started.", stdout=True)
+            self.logger.event("recording_summary", frames=self.frame_counter_dict, seconds=self.total_t, segments=self.segment + 1, latency=self.latency)
             self.logger.closeLogger()
         return 0
 
-    def start_recording_thread(self):
+    def start_recording_thread(self, auto_start=True):
+        """ Sets up the cameras and writers and records in the background. With auto_start=False it only
+        arms the recorder, and start_armed() starts the recording."""
+        self.auto_start = auto_start
+        self.armed.clear()
+        self.start_event.clear()
+        self.first_frames_in.clear()
+        self.start_cue_t = None
+        self.stop_cue_t = None
         self.manager_thread = threading.Thread(target=self.start_recording)
         self.manager_running = True
         self.manager_thread.thread_running = True
         self.manager_thread.start()
 
+    def arm_recording_thread(self):
+        """ Arms the recorder in the background: cameras grabbing, writers running, nothing recorded until start_armed()."""
+        self.start_recording_thread(auto_start=False)
+
+    def wait_armed(self, timeout=None):
+        """ Waits until the recorder is armed. Returns False if that failed (the recording thread ended) or took longer than timeout."""
+        t_end = None if timeout is None else time.time() + timeout
+        while not self.armed.wait(0.05):
+            if not self.manager_thread.is_alive() or (t_end is not None and time.time() > t_end):
+                return self.armed.is_set()
+        return True
+
+    def start_armed(self):
+        """ Starts the recording of an armed recorder: the first frame retrieved after this call is the
+        first one recorded. Returns the time of the start (time.time())."""
+        if not self.start_event.is_set():
+            self.start_cue_t = time.time()
+            self.start_event.set()
+        return self.start_cue_t
+
     def stop_recording(self):
+        """ Stops the recording at the next frame (none retrieved after this call is recorded) and returns
+        once the files are closed, with the measured latencies (see self.latency)."""
+        self.stop_cue_t = time.time()
+        self.writers_stop.set() # the grab threads stop now, not when the recording thread notices
         self.manager_running = False
         self.manager_thread.thread_running = False
         self.manager_thread.join()
+        return self.latency
 
 if __name__=="__main__":
     import threading
@@ -388,10 +1107,7 @@ if __name__=="__main__":
     rec = BaslerMouseRecorder(vid_dir, size)
 
     video_length = 3 # seconds
-    start = time.time()
-    threading.Thread(target=rec.start_recording, args=()).start() # use threading to have the recording run in the background. E.g. in a gui.
-    now = start
+    rec.start_recording_thread() # use threading to have the recording run in the background. E.g. in a gui.
     video_length += 1 # another second for setting everything up, so the recording time is roughly the previously given time
-    while now - start < video_length:
-        now = time.time()
+    time.sleep(video_length)
     rec.stop_recording()
@@ -10,8 +10,31 @@ import time
 import sys
 import subprocess as sp
 import os
+import threading
+from collections import deque
 from pathlib import Path
-from pypylon import pylon
+import numpy as np
+
+def frame_buffer(img_array):
+    """ Flat byte view of a frame for writing to a pipe. Only copies if the
+    array is not C-contiguous (e.g. a strided view)."""
+    if not img_array.flags['C_CONTIGUOUS']:
+        img_array = np.ascontiguousarray(img_array)
+    return memoryview(img_array).cast('B')
+
+def writev_all(fd, bufs):
+    """ os.writev until all buffers are written. A pipe may accept only part of
+    a large vectored write, in which case the rest is written again."""
+    remaining = sum(b.nbytes for b in bufs)
+    while True:
+        n = os.writev(fd, bufs)
+        remaining -= n
+        if remaining <= 0:
+            return
+        while n >= bufs[0].nbytes:
+            n -= bufs[0].nbytes
+            bufs = bufs[1:]
+        bufs = [bufs[0][n:]] + bufs[1:]
 
 class FFMPEG_VideoWriter:
     """ A class for FFMPEG-based video writing.
@@ -53,7 +76,7 @@ class FFMPEG_VideoWriter:
       Sets the time that FFMPEG will take to compress the video. The slower,
       the better the compression rate. Possibilities are: ultrafast,superfast,
       veryfast, faster, fast, medium (default), slow, slower, veryslow,
-      placebo.
+      placebo. None for codecs without presets (e.g. 'ffv1', 'rawvideo').
 
     bitrate
       Only relevant for codecs which accept a bitrate. "5000k" offers
@@ -63,11 +86,16 @@ class FFMPEG_VideoWriter:
       Boolean. Set to ``True`` if there is a mask in the video to be
       encoded.
 
+    out_pixfmt
+      Pixel format of the encoded video (e.g. 'gray' to keep gray frames
+      gray). If None, 'libx264' uses yuv420p as described above. See
+      encoder_profiles.py for tested combinations.
+
     """
 
     def __init__(self, filename, size, fps, codec="libx264", audiofile=None,
                  preset="medium", bitrate=None, pixfmt="rgba",
-                 logfile=None, threads=None, ffmpeg_command='ffmpeg', ffmpeg_params=None):
+                 logfile=None, threads=None, ffmpeg_command='ffmpeg', ffmpeg_params=None, out_pixfmt=None):
 
         if logfile is None:
             logfile = sp.PIPE
@@ -90,8 +118,11 @@ class FFMPEG_VideoWriter:
         ]
         cmd.extend([
             '-vcodec', codec,
-            '-preset', preset,
         ])
+        if preset is not None:
+            cmd.extend([
+                '-preset', preset
+            ])
         if ffmpeg_params is not None:
             cmd.extend(ffmpeg_params)
         if bitrate is not None:
@@ -101,7 +132,11 @@ class FFMPEG_VideoWriter:
         if threads is not None:
             cmd.extend(["-threads", str(threads)])
 
-        if ((codec == 'libx264') and
+        if out_pixfmt is not None:
+            cmd.extend([
+                '-pix_fmt', out_pixfmt
+            ])
+        elif ((codec == 'libx264') and
                 (size[1] % 2 == 0) and
                 (size[0] % 2 == 0)):
             cmd.extend([
@@ -121,61 +156,111 @@ class FFMPEG_VideoWriter:
             popen_params["creationflags"] = 0x08000000  # CREATE_NO_WINDOW
 
         self.proc = sp.Popen(cmd, **popen_params)
+        self.bytes_written = 0
+        self.write_seconds = 0.0 # time spent in writes to the pipe, i.e. waiting for ffmpeg
+        # ffmpeg's messages are read as they come (a full stderr pipe would block ffmpeg)
+        self.stderr_lines = 0
+        self.stderr_tail = deque(maxlen=20)
+        self.stderr_reader = None
+        if self.proc.stderr is not None:
+            self.stderr_reader = threading.Thread(target=self.read_stderr, daemon=True)
+            self.stderr_reader.start()
+
+    def read_stderr(self):
+        for line in iter(self.proc.stderr.readline, b''):
+            self.stderr_tail.append(line.decode(errors='replace').rstrip())
+            self.stderr_lines += 1
 
 
     def write_frame(self, img_array):
-        """ Writes one frame in the file."""
+        """ Writes one frame in the file.
+
+        The array is handed to the pipe through the buffer protocol, so a
+        C-contiguous frame is not copied again (no tobytes())."""
+        t = time.perf_counter()
         try:
-               self.proc.stdin.write(img_array.tobytes())
+            self.proc.stdin.write(frame_buffer(img_array))
         except IOError as err:
-            _, ffmpeg_error = self.proc.communicate()
-            error = (str(err) + ("\n\nMoviePy error: FFMPEG encountered "
-                                 "the following error while writing file %s:"
-                                 "\n\n %s" % (self.filename, str(ffmpeg_error))))
+            self.raise_ffmpeg_error(err)
+        self.write_seconds += time.perf_counter() - t
+        self.bytes_written += img_array.nbytes
+
+    def write_frames(self, img_arrays, meta=None):
+        """ Writes several frames with one vectored write (os.writev) where the
+        platform supports it, otherwise one write per frame. meta (the frames'
+        ring records) is only used by writers that keep an index, see raw_writer.py."""
+        if not hasattr(os, 'writev'):
+            for img_array in img_arrays:
+                self.write_frame(img_array)
+            return
+        bufs = [frame_buffer(a) for a in img_arrays]
+        t = time.perf_counter()
+        try:
+            self.proc.stdin.flush() # nothing may be left in the buffered writer before writing to the fd
+            writev_all(self.proc.stdin.fileno(), bufs)
+        except IOError as err:
+            self.raise_ffmpeg_error(err)
+        self.write_seconds += time.perf_counter() - t
+        self.bytes_written += sum(b.nbytes for b in bufs)
+
+    def raise_ffmpeg_error(self, err):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        self.proc.wait()
+        if self.stderr_reader is not None:
+            self.stderr_reader.join()
+        ffmpeg_error = "\n".join(self.stderr_tail).encode()
+        error = (str(err) + ("\n\nMoviePy error: FFMPEG encountered "
+                             "the following error while writing file %s:"
+                             "\n\n %s" % (self.filename, str(ffmpeg_error))))
 
-            if b"Unknown encoder" in ffmpeg_error:
+        if b"Unknown encoder" in ffmpeg_error:
 
-                error = error+("\n\nThe video export "
-                  "failed because FFMPEG didn't find the specified "
-                  "codec for video encoding (%s). Please install "
-                  "this codec or change the codec when calling "
-                  "write_videofile. For instance:\n"
-                  "  >>> clip.write_videofile('myvid.webm', codec='libvpx')")%(self.codec)
+            error = error+("\n\nThe video export "
+              "failed because FFMPEG didn't find the specified "
+              "codec for video encoding (%s). Please install "
+              "this codec or change the codec when calling "
+              "write_videofile. For instance:\n"
+              "  >>> clip.write_videofile('myvid.webm', codec='libvpx')")%(self.codec)
 
-            elif b"incorrect codec parameters ?" in ffmpeg_error:
+        elif b"incorrect codec parameters ?" in ffmpeg_error:
 
-                 error = error+("\n\nThe video export "
-                  "failed, possibly because the codec specified for "
-                  "the video (%s) is not compatible with the given "
-                  "extension (%s). Please specify a valid 'codec' "
-                  "argument in write_videofile. This would be 'libx264' "
-                  "or 'mpeg4' for mp4, 'libtheora' for ogv, 'libvpx for webm. "
-                  "Another possible reason is that the audio codec was not "
-                  "compatible with the video codec. For instance the video "
-                  "extensions 'ogv' and 'webm' only allow 'libvorbis' (default) as a"
-                  "video codec."
-                  )%(self.codec, self.ext)
+             error = error+("\n\nThe video export "
+              "failed, possibly because the codec specified for "
+              "the video (%s) is not compatible with the given "
+              "extension (%s). Please specify a valid 'codec' "
+              "argument in write_videofile. This would be 'libx264' "
+              "or 'mpeg4' for mp4, 'libtheora' for ogv, 'libvpx for webm. "
+              "Another possible reason is that the audio codec was not "
+              "compatible with the video codec. For instance the video "
+              "extensions 'ogv' and 'webm' only allow 'libvorbis' (default) as a"
+              "video codec."
+              )%(self.codec, self.ext)
 
-            elif  b"encoder setup failed" in ffmpeg_error:
+        elif  b"encoder setup failed" in ffmpeg_error:
 
-                error = error+("\n\nThe video export "
-                  "failed, possibly because the bitrate you specified "
-                  "was too high or too low for the video codec.")
+            error = error+("\n\nThe video export "
+              "failed, possibly because the bitrate you specified "
+              "was too high or too low for the video codec.")
 
-            elif b"Invalid encoder type" in ffmpeg_error:
+        elif b"Invalid encoder type" in ffmpeg_error:
 
-                error = error + ("\n\nThe video export failed because the codec "
-                  "or file extension you provided is not a video")
+            error = error + ("\n\nThe video export failed because the codec "
+              "or file extension you provided is not a video")
 
 
-            raise IOError(error)
+        raise IOError(error)
 
     def close(self):
         if self.proc:
             self.proc.stdin.close()
+            self.proc.wait()
+            if self.stderr_reader is not None:
+                self.stderr_reader.join()
             if self.proc.stderr is not None:
                 self.proc.stderr.close()
-            self.proc.wait()
 
         self.proc = None
 
@@ -188,6 +273,7 @@ class FFMPEG_VideoWriter:
         self.close()
 
 if __name__ == '__main__':
+    from pypylon import pylon
     vid_dir = Path("/home/niek/Videos/basler")
     vid_dir.mkdir(parents=True, exist_ok=True)
 
@@ -211,7 +297,8 @@ if __name__ == '__main__':
         while now - time_initiated < total_record_time:
             #print("time passed:", now-time_initiated)
             res = cam.RetrieveResult(100)
-            writer.write_frame(res.Array)
+            with res.GetArrayZeroCopy() as frame: # written straight from the grab buffer
+                writer.write_frame(frame)
             res.Release()
             count += 1
             now = time.time()
@@ -0,0 +1,68 @@
+"""
+    Notices when an encoder cannot keep up with its camera.
+
+    Only looks at the frame rings (see frame_ring.py), so it works the same for
+    encode threads and encoder processes: the camera rate is what the grab
+    thread put into the ring (or dropped), the encoder rate is what was taken
+    out. An encoder is behind while its ring is filling up (more than high_fill
+    of the slots in use) or frames are dropped. If that lasts longer than
+    hold_seconds, sample() reports the camera once, and again only if it is
+    still behind hold_seconds after that.
+
+    What to do about it (a faster encoder profile for the next segment, a slower
+    preview) is up to the recorder.
+"""
+
+import time
+
+class BackpressureMonitor:
+    def __init__(self, rings, hold_seconds=5.0, high_fill=0.5, interval=1.0):
+        """
+            @param rings: dict serial -> FrameRing or SharedFrameRing
+            @param hold_seconds: how long an encoder has to be behind before it is reported
+            @param high_fill: share of the ring's slots in use above which the encoder counts as behind
+            @param interval: min. seconds between two samples
+        """
+        self.rings = rings
+        self.hold_seconds = hold_seconds
+        self.high_fill = high_fill
+        self.interval = interval
+        self.t_last = None
+        self.last = dict() # serial -> ring stats at the last sample
+        self.behind_since = dict() # serial -> time since when the encoder is behind
+        self.status = dict() # serial -> rates and fill of the last interval
+
+    def sample(self):
+        """ Call regularly from the manager thread. Returns the serials of the cameras
+        whose encoder has been behind for hold_seconds (usually an empty list)."""
+        t = time.perf_counter()
+        if self.t_last is not None and t - self.t_last < self.interval:
+            return []
+        result = []
+        for serial, ring in self.rings.items():
+            s = ring.stats()
+            prev = self.last.get(serial)
+            self.last[serial] = s
+            if prev is None:
+                continue
+            dt = t - self.t_last
+            offered = (s["frames_in"] + s["dropped"]) - (prev["frames_in"] + prev["dropped"])
+            encoded = (s["frames_in"] - s["depth"]) - (prev["frames_in"] - prev["depth"])
+            dropped = s["dropped"] - prev["dropped"]
+            fill = s["depth"] / s["capacity"]
+            self.status[serial] = {"camera_fps": offered / dt, "encoder_fps": encoded / dt, "fill": fill, "dropped": dropped}
+            if fill > self.high_fill or dropped > 0:
+                since = self.behind_since.setdefault(serial, t)
+                if t - since >= self.hold_seconds:
+                    result.append(serial)
+                    self.behind_since[serial] = t # report again only if it stays behind
+            else:
+                self.behind_since.pop(serial, None)
+        self.t_last = t
+        return result
+
+    def status_str(self, serial):
+        s = self.status.get(serial)
+        if s is None:
+            return "no data yet"
+        return "camera {camera_fps:.1f} fps, encoder {encoder_fps:.1f} fps, queue {fill:.0%} full, {dropped} dropped".format(**s)
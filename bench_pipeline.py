@@ -0,0 +1,254 @@
+"""
+    End-to-end benchmark of the recording pipeline, no camera needed.
+
+    synthetic
+      N NumPy sources, paced at the camera frame rate, feed the same pipeline
+      as the recorder's grab threads: FrameRing (or SharedFrameRing) ->
+      FrameEncoder -> the profile's writer (FFMPEG_VideoWriter, or RawFrameWriter
+      for raw_mmap) + FrameSidecar.
+    emulated
+      Runs BaslerMouseRecorder itself with pylon's emulated cameras
+      (BaslerCamEmu, PYLON_CAMEMU=N), one subprocess per camera count. Needs
+      pypylon. The emulated cameras run at the rate set in set_cam_settings,
+      so --fps is ignored, and there is no latency measurement.
+    writer
+      Only the writers: N of them in parallel, each fed as fast as it
+      takes the frames. Shows the encoder's ceiling.
+
+    Reported for every camera count: sustained fps (slowest camera and mean),
+    drop rate, grab-to-written latency percentiles (time.time() at the grab
+    until the frame was handed to ffmpeg, thread backend only) and CPU per
+    camera (Python and ffmpeg, in % of one core; ffmpeg only on Unix).
+
+    Exits with 1 if any run drops more than --max-drop of its frames or its
+    slowest camera misses the target rate by more than 2 %, so it can be used
+    to catch regressions before a long experiment.
+
+    Usage: python bench_pipeline.py [synthetic|emulated|writer] [--cams 1,2,4,8]
+           [--size 1936x1216] [--fps 30] [--seconds 10] [--profile x264_ultrafast_gray]
+           [--backend thread|process] [--ffmpeg ffmpeg]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+
+from frame_ring import FrameRing
+from frame_sidecar import FrameSidecar
+from frame_encoder import FrameEncoder
+from encoder_profiles import profile_writer_args, profile_extension, create_writer
+import mp_encoder
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+def cpu_seconds():
+    """ CPU time of this process and of its finished child processes (ffmpeg, encoder workers)."""
+    if resource is None:
+        return time.process_time()
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def synthetic_frames(size, n=8):
+    """ A static gradient with sensor noise, closer to a camera image than pure noise."""
+    rng = np.random.default_rng(0)
+    scene = np.tile(np.linspace(0, 200, size[0]).astype(np.uint8), (size[1], 1))
+    return [scene + rng.integers(0, 16, scene.shape, dtype=np.uint8) for _ in range(n)]
+
+def synthetic_camera(ring, frames, fps, stop):
+    """ Puts frames into the ring at a fixed rate, like a free-running camera and its grab thread."""
+    period = 1.0 / fps
+    t_next = time.perf_counter()
+    i = 0
+    while not stop.is_set():
+        t_next += period
+        delay = t_next - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        host_t = time.time()
+        ring.put(frames[i % len(frames)], (host_t, int(host_t * 1e9), i, i))
+        i += 1
+    ring.close()
+
+def percentiles(latencies):
+    if len(latencies) == 0:
+        return None
+    return [float(x) * 1e3 for x in np.percentile(latencies, [50, 95, 99, 100])]
+
+def run_synthetic(n_cams, args, out_dir):
+    size = args.size
+    frames = synthetic_frames(size)
+    serials = ["synth{:02d}".format(i) for i in range(n_cams)]
+    stop = threading.Event()
+    latencies = {s: [] for s in serials}
+    def on_written(serial, meta, t):
+        latencies[serial].append(t - meta['host_time'])
+    ring_class = mp_encoder.SharedFrameRing if args.backend == 'process' else FrameRing
+    rings = {s: ring_class((size[1], size[0]), dtype=np.uint8, depth=args.ring_depth) for s in serials}
+    ext = "." + profile_extension(args.profile)
+    writer_args = {s: dict(filename=os.path.join(out_dir, s + ext), size=size, fps=args.fps, pixfmt='gray',
+                           ffmpeg_command=args.ffmpeg, **profile_writer_args(args.profile, 'gray')) for s in serials}
+    infos = dict()
+    encoders, threads, procs = [], [], []
+    if args.backend == 'process':
+        for group in mp_encoder.group_serials(serials, args.cameras_per_process):
+            procs.append(mp_encoder.EncoderProcess([{"serial": s, "ring": rings[s].spec(), "writer": writer_args[s],
+                "sidecar": os.path.join(out_dir, s + "_frames.bin"), "segment": 0, "write_batch": 8} for s in group]))
+    else:
+        for s in serials:
+            encoders.append(FrameEncoder(s, rings[s], create_writer(**writer_args[s]), FrameSidecar(os.path.join(out_dir, s + "_frames.bin")),
+                                         on_segment_closed=lambda serial, info: infos.__setitem__(serial, info), on_written=on_written))
+            threads.append(threading.Thread(target=encoders[-1].run, daemon=True))
+    cpu0 = cpu_seconds()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    cams = [threading.Thread(target=synthetic_camera, args=(rings[s], frames, args.fps, stop), daemon=True) for s in serials]
+    for c in cams:
+        c.start()
+    time.sleep(args.seconds)
+    stop.set()
+    elapsed = time.perf_counter() - t0
+    for c in cams:
+        c.join()
+    for t in threads:
+        t.join()
+    for e in encoders:
+        e.close()
+    for p in procs:
+        for msg in p.stop():
+            if msg[0] == 'closed':
+                infos[msg[1]] = msg[2]
+            elif msg[0] == 'error':
+                print("encoder error:", msg[2], file=sys.stderr)
+    # CPU until everything is written, per second of recording
+    cpu = cpu_seconds() - cpu0
+    result = summarize(n_cams, args.fps, cpu / elapsed,
+                       {s: (rings[s].frames_in + rings[s].dropped, infos.get(s, {}).get("frames", 0), elapsed) for s in serials},
+                       np.concatenate([a for l in latencies.values() for a in l] or [np.zeros(0)]))
+    for ring in rings.values():
+        if isinstance(ring, mp_encoder.SharedFrameRing):
+            ring.detach()
+    return result
+
+def run_writer(n_cams, args, out_dir):
+    size = args.size
+    frames = synthetic_frames(size)
+    stop = threading.Event()
+    counts = [0] * n_cams
+    def feed(i):
+        with create_writer(filename=os.path.join(out_dir, "writer{:02d}.{}".format(i, profile_extension(args.profile))), size=size, fps=args.fps, pixfmt='gray',
+                           ffmpeg_command=args.ffmpeg, **profile_writer_args(args.profile, 'gray')) as writer:
+            while not stop.is_set():
+                writer.write_frame(frames[counts[i] % len(frames)])
+                counts[i] += 1
+    threads = [threading.Thread(target=feed, args=(i,), daemon=True) for i in range(n_cams)]
+    cpu0 = cpu_seconds()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    n = list(counts) # frames handed over during the measured time, not while closing
+    elapsed = time.perf_counter() - t0
+    for t in threads:
+        t.join()
+    cpu = cpu_seconds() - cpu0
+    return summarize(n_cams, args.fps, cpu / elapsed, {i: (c, c, elapsed) for i, c in enumerate(n)}, np.zeros(0))
+
+def run_emulated(n_cams, args, out_dir):
+    """ Runs the recorder with n_cams emulated cameras in a subprocess (PYLON_CAMEMU has to be set before pylon starts)."""
+    env = dict(os.environ, PYLON_CAMEMU=str(n_cams))
+    cmd = [sys.executable, os.path.abspath(__file__), "_emulated_run", "--cams", str(n_cams), "--size", "{}x{}".format(*args.size),
+           "--seconds", str(args.seconds), "--profile", args.profile, "--backend", args.backend, "--ffmpeg", args.ffmpeg,
+           "--out", out_dir]
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, universal_newlines=True)
+    for line in proc.stdout.splitlines():
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    raise RuntimeError("emulated run with {} cameras failed:\n{}".format(n_cams, proc.stdout[-2000:]))
+
+def emulated_run(args):
+    from b_record_all_cams import BaslerMouseRecorder
+    from segment_index import read_segment_index
+    import glob
+    rec = BaslerMouseRecorder(args.out, size=args.size, ffmpeg=args.ffmpeg, encoder_backend=args.backend,
+                              show_preview=False, encoder_profile=args.profile, usb_reset='never', feature_cache_dir=None)
+    cpu0 = cpu_seconds()
+    t0 = time.perf_counter()
+    rec.start_recording_thread()
+    time.sleep(args.seconds)
+    rec.stop_recording()
+    elapsed = time.perf_counter() - t0
+    cpu = cpu_seconds() - cpu0
+    # the rates from the first to the last frame of every camera, without the camera setup
+    counts = dict()
+    for row in read_segment_index(sorted(glob.glob(os.path.join(args.out, "*_segments.csv")))[-1]):
+        offered, written, duration = counts.get(row["serial"], (0, 0, 0.0))
+        if row["start_time"] is not None:
+            duration += row["end_time"] - row["start_time"]
+        counts[row["serial"]] = (offered + row["frames"] + row["dropped"], written + row["frames"], duration)
+    target_fps = min(a["fps"] for a in rec.writer_args.values())
+    print("RESULT " + json.dumps(summarize(args.cams[0], target_fps, cpu / elapsed, counts, np.zeros(0))))
+
+def summarize(n_cams, target_fps, cpu_load, counts, latencies):
+    """ counts: camera -> (frames offered by the camera, frames written, seconds recorded).
+    cpu_load: CPU seconds used per second of recording."""
+    offered = sum(c[0] for c in counts.values())
+    fps = [c[1] / c[2] if c[2] > 0 else 0.0 for c in counts.values()]
+    return {"cams": n_cams, "target_fps": target_fps, "min_fps": min(fps) if fps else 0.0,
+            "mean_fps": sum(fps) / len(fps) if fps else 0.0,
+            "drop": 1 - sum(c[1] for c in counts.values()) / offered if offered else 0.0,
+            "latency_ms": percentiles(latencies), "cpu_per_cam": 100 * cpu_load / n_cams}
+
+def print_row(r):
+    lat = "{:6.1f} {:6.1f} {:6.1f} {:7.1f}".format(*r["latency_ms"]) if r["latency_ms"] else "{:>29}".format("n/a")
+    print("{cams:5d} {target_fps:7.1f} {min_fps:8.1f} {mean_fps:8.1f} {drop:7.2%}".format(**r) + "  " + lat + " {:8.1f}%".format(r["cpu_per_cam"]))
+
+def parse_args(argv):
+    p = argparse.ArgumentParser(description="End-to-end benchmark of the recording pipeline.")
+    p.add_argument("mode", choices=["synthetic", "emulated", "writer", "_emulated_run"], nargs="?", default="synthetic")
+    p.add_argument("--cams", default="1,2,4", help="camera counts to run, comma separated (e.g. 1,2,4,8,16,30)")
+    p.add_argument("--size", default="1936x1216", help="frame size WIDTHxHEIGHT")
+    p.add_argument("--fps", type=float, default=30.0)
+    p.add_argument("--seconds", type=float, default=10.0, help="duration of each run")
+    p.add_argument("--profile", default="x264_ultrafast_gray", help="encoder profile, see encoder_profiles.py")
+    p.add_argument("--backend", choices=["thread", "process"], default="thread")
+    p.add_argument("--cameras-per-process", type=int, default=1)
+    p.add_argument("--ring-depth", type=int, default=64)
+    p.add_argument("--ffmpeg", default="ffmpeg")
+    p.add_argument("--max-drop", type=float, default=0.0, help="share of dropped frames that still passes")
+    p.add_argument("--out", default=None, help="directory for the videos (default: a temporary one, deleted afterwards)")
+    args = p.parse_args(argv)
+    args.cams = [int(n) for n in args.cams.split(",")]
+    args.size = tuple(int(x) for x in args.size.lower().split("x"))
+    return args
+
+def main(argv):
+    args = parse_args(argv)
+    if args.mode == "_emulated_run":
+        emulated_run(args)
+        return 0
+    run = {"synthetic": run_synthetic, "emulated": run_emulated, "writer": run_writer}[args.mode]
+    print("{} {}x{}, profile {}, {} backend, {:.0f} s per run".format(args.mode, args.size[0], args.size[1], args.profile, args.backend, args.seconds))
+    print(" cams  target  min fps mean fps   drop  lat p50    p95    p99     max  CPU/cam")
+    failed = False
+    for n in args.cams:
+        with tempfile.TemporaryDirectory(dir=args.out) as out_dir:
+            r = run(n, args, out_dir)
+        print_row(r)
+        if r["drop"] > args.max_drop or r["min_fps"] < 0.98 * r["target_fps"]:
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
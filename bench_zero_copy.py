@@ -0,0 +1,129 @@
+"""
+    Micro-benchmark of the frame write path, no camera needed.
+
+    Compares the old path (GetArray() copy + tobytes() copy + one write per
+    frame) with the zero-copy path (one copy into a ring slot, memoryview write)
+    and the batched path (ring slots with one os.writev per batch).
+    ffmpeg decodes the raw frames into the null muxer, so only the pipe is measured.
+
+    Reported per frame: bytes copied in user space, bytes newly allocated
+    (tracemalloc), write syscalls (from /proc/self/io, Linux only) and time.
+    The copies are counted while they happen: numpy in frame_ring.py and
+    b_record_to_vid.py is replaced by CopyCounter, which counts what copyto()
+    and ascontiguousarray() copy, and the old path copies through it too.
+    Copies inside the io module and the kernel are not counted.
+
+    Usage: python bench_zero_copy.py [ffmpeg command] [number of frames]
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+import b_record_to_vid
+import frame_ring
+from b_record_to_vid import FFMPEG_VideoWriter
+from frame_ring import FrameRing
+
+class CopyCounter:
+    """ Stands in for numpy in the modules of the write path and counts the bytes their copies copy."""
+    def __init__(self):
+        self.bytes = 0
+    def __getattr__(self, name):
+        return getattr(np, name)
+    def copyto(self, dst, src, **kwargs):
+        np.copyto(dst, src, **kwargs)
+        self.bytes += dst.nbytes
+    def ascontiguousarray(self, a, **kwargs):
+        result = np.ascontiguousarray(a, **kwargs)
+        if not np.may_share_memory(result, a):
+            self.bytes += result.nbytes
+        return result
+    # the old path's copies
+    def copy(self, a):
+        self.bytes += a.nbytes
+        return a.copy()
+    def tobytes(self, a):
+        data = a.tobytes()
+        self.bytes += len(data)
+        return data
+
+copies = CopyCounter()
+frame_ring.np = copies
+b_record_to_vid.np = copies
+
+def write_syscalls():
+    """ Number of write syscalls of this process so far, None if unknown."""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('syscw:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+def null_writer(size, ffmpeg_command):
+    return FFMPEG_VideoWriter('-', size, fps=30, codec='rawvideo', pixfmt='gray', ffmpeg_command=ffmpeg_command,
+                              ffmpeg_params=['-f', 'null'])
+
+def run(name, size, n_frames, ffmpeg_command, step):
+    """ Runs step(writer, grab_buffer) for n_frames frames."""
+    grab_buffer = np.random.randint(0, 255, (size[1], size[0]), dtype=np.uint8) # stands in for the pylon buffer
+    with null_writer(size, ffmpeg_command) as writer:
+        step(writer, grab_buffer) # warm up, also allocates the ring
+        copied0 = copies.bytes
+        allocated = 0
+        sys0 = write_syscalls()
+        t0 = time.perf_counter()
+        for _ in range(n_frames):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            step(writer, grab_buffer)
+            _, peak = tracemalloc.get_traced_memory()
+            allocated += peak - before
+        step(writer, None) # flush what a batching step still holds
+        dt = time.perf_counter() - t0
+        sys1 = write_syscalls()
+        copied = copies.bytes - copied0
+    syscalls = "{:.2f}".format((sys1 - sys0) / n_frames) if sys0 is not None else "n/a"
+    print("{:<28} {:>12.0f} {:>12.0f} {:>10} {:>9.3f}".format(name, copied / n_frames, allocated / n_frames, syscalls, dt / n_frames * 1e3))
+
+def old_step(writer, grab_buffer):
+    if grab_buffer is None: return
+    frame = copies.copy(grab_buffer) # grabResult.GetArray()
+    writer.proc.stdin.write(copies.tobytes(frame)) # the former write_frame
+
+class RingStep:
+    """ Grab thread and encode thread of the recorder, run one after the other."""
+    def __init__(self, batch):
+        self.ring = None
+        self.batch = batch
+    def __call__(self, writer, grab_buffer):
+        if grab_buffer is None:
+            self.drain(writer, 1)
+            return
+        if self.ring is None:
+            self.ring = FrameRing(grab_buffer.shape, depth=2*self.batch)
+        self.ring.put(grab_buffer) # with grabResult.GetArrayZeroCopy() as frame: ring.put(frame)
+        self.drain(writer, self.batch)
+    def drain(self, writer, min_frames):
+        if self.ring.depth() < min_frames:
+            return
+        frames = self.ring.get_many(self.batch, timeout=0)
+        if self.batch == 1:
+            writer.write_frame(frames[0])
+        else:
+            writer.write_frames(frames)
+        self.ring.release(len(frames))
+
+if __name__ == '__main__':
+    ffmpeg_command = sys.argv[1] if len(sys.argv) > 1 else 'ffmpeg'
+    n_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    size = (1936, 1216)
+    tracemalloc.start()
+    print("{} frames of {}x{} Mono8 ({} bytes each)".format(n_frames, size[0], size[1], size[0]*size[1]))
+    print("{:<28} {:>12} {:>12} {:>10} {:>9}".format("path", "copied B/fr", "alloc B/fr", "writes/fr", "ms/fr"))
+    run("GetArray + tobytes", size, n_frames, ffmpeg_command, old_step)
+    run("ring slot + memoryview", size, n_frames, ffmpeg_command, RingStep(1))
+    run("ring slot + writev (8)", size, n_frames, ffmpeg_command, RingStep(8))
@@ -0,0 +1,252 @@
+"""
+    Checks before a recording whether the cameras, the USB buses, the CPU and
+    the disk can sustain the planned settings, and suggests what to change if
+    not (frame rate, ROI, binning, pixel format, encoder profile).
+
+    Per camera: bytes per second over USB, the highest frame rate the exposure
+    and the sensor allow, the CPU its encoder needs and the bytes per second it
+    writes to disk. The USB load is summed per bus (host controller), the CPU
+    over all cameras.
+
+    The encoder numbers come from a calibration: encoding synthetic frames with
+    every profile of encoder_profiles.py through FFMPEG_VideoWriter, normalised
+    to one megapixel. DEFAULT_CALIBRATION was measured that way on one machine
+    and is only a rough guess for another one, run
+
+        python capacity_planner.py --calibrate
+
+    once on the recording machine (saved to DEFAULT_CALIBRATION_FILE and used
+    from then on). Compression of real footage differs from the synthetic
+    frames, so the disk numbers of the compressing profiles are estimates.
+
+    python capacity_planner.py [--connected | --cams N] [--size WxH] [--fps FPS]
+        [--pixel-format Mono8] [--profile NAME] [--exposure US] [--duration S] [--vid-dir DIR]
+"""
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+from encoder_profiles import ENCODER_PROFILES, DEFAULT_PROFILE, faster_profile, measure_profiles
+from pixel_formats import PIXEL_FORMATS, check_pixel_format
+
+# Basler's default DeviceLinkThroughputLimit, about what one USB 3.0 host controller sustains
+USB3_BYTES_PER_SECOND = 360e6
+USB2_BYTES_PER_SECOND = 40e6
+USB_HEADROOM = 0.9 # plan the buses to at most this share
+CPU_HEADROOM = 0.75 # share of the cores the encoders may use (grabbing, preview and the OS need the rest)
+
+# full sensor and frame rate at full size, the frame rate grows about inversely with the ROI height
+CAMERA_MODELS = {
+    'acA1920-40um': {"sensor": (1936, 1216), "max_fps": 41.0, "binning": True},
+}
+
+# per profile: ffmpeg CPU seconds and file bytes per megapixel and frame (Mono8, synthetic frames)
+DEFAULT_CALIBRATION = {
+    'x264_medium': {"cpu_seconds_per_megapixel": 0.0794, "bytes_per_pixel": 0.0147},
+    'x264_veryfast': {"cpu_seconds_per_megapixel": 0.0362, "bytes_per_pixel": 0.0108}, # estimated from the gray ones
+    'x264_ultrafast': {"cpu_seconds_per_megapixel": 0.0108, "bytes_per_pixel": 0.104},
+    'x264_archive_gray': {"cpu_seconds_per_megapixel": 0.525, "bytes_per_pixel": 0.129}, # for transcode_batch.py, not live
+    'x264_veryfast_gray': {"cpu_seconds_per_megapixel": 0.0279, "bytes_per_pixel": 0.0100},
+    'x264_ultrafast_gray': {"cpu_seconds_per_megapixel": 0.00715, "bytes_per_pixel": 0.102},
+    'ffv1_gray': {"cpu_seconds_per_megapixel": 0.0247, "bytes_per_pixel": 0.580},
+    'rawvideo': {"cpu_seconds_per_megapixel": 0.00116, "bytes_per_pixel": 1.0},
+    'mjpeg': {"cpu_seconds_per_megapixel": 0.0095, "bytes_per_pixel": 0.103},
+    'raw_mmap': {"cpu_seconds_per_megapixel": 0.0, "bytes_per_pixel": 1.0}, # no ffmpeg, the copy is done by the encode thread
+}
+DEFAULT_CALIBRATION_FILE = str(Path.home() / ".basler_recorder" / "calibration.json")
+
+def calibrate(ffmpeg='ffmpeg', n=120, size=(1936, 1216), filename=DEFAULT_CALIBRATION_FILE):
+    """ Measures every encoder profile on this machine and saves the calibration (if filename is given)."""
+    megapixels = size[0] * size[1] / 1e6
+    calibration = dict()
+    for name, r in measure_profiles(ffmpeg, n, size).items():
+        if r["cpu_seconds_per_frame"] is None: # no resource module, the wall time is an upper bound on one core
+            r["cpu_seconds_per_frame"] = 1.0 / r["fps"]
+        calibration[name] = {"cpu_seconds_per_megapixel": r["cpu_seconds_per_frame"] / megapixels,
+                             "bytes_per_pixel": r["bytes_per_frame"] / (megapixels * 1e6)}
+    if filename:
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(calibration, f, indent=1)
+    return calibration
+
+def load_calibration(filename=DEFAULT_CALIBRATION_FILE):
+    """ The saved calibration, completed with DEFAULT_CALIBRATION for profiles it does not have."""
+    calibration = {name: dict(c) for name, c in DEFAULT_CALIBRATION.items()}
+    try:
+        with open(filename) as f:
+            calibration.update(json.load(f))
+    except (OSError, ValueError, TypeError):
+        pass
+    return calibration
+
+def camera_spec(serial, width, height, fps, pixel_format='Mono8', profile=DEFAULT_PROFILE, exposure_us=20000, model=None,
+                bus=None, speed=None, binning=1):
+    """ What the planner needs to know about one camera (speed: USB link in Mbit/s, None: assume USB 3)."""
+    check_pixel_format(pixel_format)
+    return {"serial": serial, "model": model, "bus": bus, "speed": speed, "width": width, "height": height, "fps": fps,
+            "pixel_format": pixel_format, "profile": profile, "exposure_us": exposure_us, "binning": binning}
+
+def cameras_from_config(n, size=(1936, 1216), fps=30, pixel_format='Mono8', profile=DEFAULT_PROFILE, exposure_us=20000, model='acA1920-40um'):
+    """ n cameras with the same settings, all on one bus (the worst case)."""
+    return [camera_spec("cam{}".format(i), size[0], size[1], fps, pixel_format, profile, exposure_us, model, bus=0) for i in range(n)]
+
+def connected_cameras(size=(1936, 1216), fps=30, pixel_format='Mono8', profile=DEFAULT_PROFILE, exposure_us=20000):
+    """ The connected cameras (model from pylon, bus and link speed from sysfs on Linux) with these settings."""
+    from pypylon import pylon
+    import reset_USB
+    usb = {dev["serial"]: dev for dev in reset_USB.find_baslers_sysfs()}
+    result = []
+    for d in pylon.TlFactory.GetInstance().EnumerateDevices():
+        serial = d.GetSerialNumber()
+        dev = usb.get(serial, {})
+        bus = int(dev["devfs"].split("/")[-2]) if "devfs" in dev else None
+        result.append(camera_spec(serial, size[0], size[1], fps, pixel_format, profile, exposure_us, d.GetModelName(), bus, dev.get("speed")))
+    return result
+
+def usb_capacity(speed):
+    return USB2_BYTES_PER_SECOND if speed is not None and speed < 5000 else USB3_BYTES_PER_SECOND
+
+def camera_load(cam, calibration):
+    """ USB, CPU and disk load of one camera, and the highest frame rate its exposure and sensor allow."""
+    fmt = PIXEL_FORMATS[cam["pixel_format"]]
+    pixels = (cam["width"] // cam["binning"]) * (cam["height"] // cam["binning"])
+    word = fmt["dtype"]().itemsize # bytes per pixel handed to ffmpeg
+    c = calibration[cam["profile"]]
+    sensor_max_fps = float('inf')
+    model = CAMERA_MODELS.get(cam["model"])
+    if model is not None:
+        sensor_max_fps = model["max_fps"] * model["sensor"][1] / max(1, cam["height"] // cam["binning"])
+    return {"usb_bytes_per_second": pixels * fmt["bytes_per_pixel"] * cam["fps"],
+            "sensor_max_fps": sensor_max_fps,
+            "cpu_cores": c["cpu_seconds_per_megapixel"] * pixels / 1e6 * word * cam["fps"],
+            "disk_bytes_per_second": c["bytes_per_pixel"] * pixels * word * cam["fps"],
+            "max_fps": min(sensor_max_fps, 1e6 / cam["exposure_us"] if cam["exposure_us"] else float('inf'))}
+
+def plan(cameras, duration=3600.0, vid_dir=None, cpu_cores=None, disk_bytes_per_second=None, calibration=None):
+    """ Checks the cameras (see camera_spec) against USB, CPU and disk.
+
+        @param duration: planned recording in seconds (for the total size)
+        @param vid_dir: folder of the videos, its free space is checked (None: not checked)
+        @param cpu_cores: cores for the encoders (None: os.cpu_count())
+        @param disk_bytes_per_second: sustained write speed of the disk (None: not checked)
+        @return dict with the loads per camera and bus, the totals, the problems and suggestions
+    """
+    calibration = calibration or load_calibration()
+    cpu_cores = cpu_cores or os.cpu_count() or 1
+    report = {"cameras": dict(), "buses": dict(), "problems": [], "suggestions": [], "duration": duration}
+    for cam in cameras:
+        load = camera_load(cam, calibration)
+        report["cameras"][cam["serial"]] = dict(cam, **load)
+        if cam["fps"] > load["max_fps"]:
+            report["problems"].append("Cam {}: {:g} fps is more than the {:.1f} fps its exposure ({:g} us) and sensor allow.".format(
+                cam["serial"], cam["fps"], load["max_fps"], cam["exposure_us"]))
+            if cam["exposure_us"] and cam["fps"] > 1e6 / cam["exposure_us"]:
+                report["suggestions"].append("Cam {}: exposure at most {:.0f} us for {:g} fps.".format(cam["serial"], 1e6 / cam["fps"], cam["fps"]))
+            if cam["fps"] > load["sensor_max_fps"]:
+                report["suggestions"].append("Cam {}: frame rate at most {:.1f} fps, or ROI height at most {} rows.".format(
+                    cam["serial"], load["sensor_max_fps"], int(cam["height"] * load["sensor_max_fps"] / cam["fps"]) // 8 * 8))
+    for cam in cameras:
+        bus = report["buses"].setdefault(cam["bus"], {"serials": [], "usb_bytes_per_second": 0.0, "capacity": usb_capacity(cam["speed"])})
+        bus["serials"].append(cam["serial"])
+        bus["usb_bytes_per_second"] += report["cameras"][cam["serial"]]["usb_bytes_per_second"]
+        bus["capacity"] = min(bus["capacity"], usb_capacity(cam["speed"]))
+    for name, bus in report["buses"].items():
+        usable = bus["capacity"] * USB_HEADROOM
+        if bus["usb_bytes_per_second"] > usable:
+            factor = bus["usb_bytes_per_second"] / usable
+            cams = [report["cameras"][s] for s in bus["serials"]]
+            report["problems"].append("USB bus {}: {:.0f} MB/s for {} camera(s), but only about {:.0f} MB/s are usable.".format(
+                name if name is not None else "(unknown)", bus["usb_bytes_per_second"] / 1e6, len(cams), usable / 1e6))
+            report["suggestions"].append("USB bus {}: frame rate at most {:.1f} fps, or ROI height at most {} rows, or cameras on another USB controller.".format(
+                name if name is not None else "(unknown)", min(c["fps"] for c in cams) / factor, int(min(c["height"] for c in cams) / factor) // 8 * 8))
+            if factor <= 4 and all(CAMERA_MODELS.get(c["model"], {}).get("binning") for c in cams):
+                report["suggestions"].append("USB bus {}: 2x2 binning (a quarter of the data).".format(name))
+            if factor <= 1.5 and any(c["pixel_format"] == 'Mono12p' for c in cams):
+                report["suggestions"].append("USB bus {}: Mono8 instead of Mono12p (two thirds of the data).".format(name))
+    cpu = sum(c["cpu_cores"] for c in report["cameras"].values())
+    disk = sum(c["disk_bytes_per_second"] for c in report["cameras"].values())
+    report.update({"cpu_cores": cpu, "cpu_cores_available": cpu_cores, "disk_bytes_per_second": disk,
+                   "total_bytes": disk * duration if duration else None})
+    if cpu > cpu_cores * CPU_HEADROOM:
+        report["problems"].append("Encoders need about {:.1f} of the {} CPU cores (at most {:.1f} should be used).".format(cpu, cpu_cores, cpu_cores * CPU_HEADROOM))
+        report["suggestions"].extend(profile_suggestions(cameras, calibration, cpu_cores * CPU_HEADROOM))
+    if disk_bytes_per_second and disk > disk_bytes_per_second:
+        report["problems"].append("Videos are written at about {:.0f} MB/s, the disk sustains {:.0f} MB/s.".format(disk / 1e6, disk_bytes_per_second / 1e6))
+    if vid_dir is not None and duration:
+        free = shutil.disk_usage(vid_dir).free
+        report["free_bytes"] = free
+        if disk * duration > free:
+            report["problems"].append("{:.0f} GB for {:.0f} s of video, but only {:.0f} GB are free in {}.".format(disk * duration / 1e9, duration, free / 1e9, vid_dir))
+            report["suggestions"].append("Record at most {:.0f} s, or use a more compressing profile.".format(free / disk))
+    return report
+
+def profile_suggestions(cameras, calibration, cores):
+    """ The faster profiles (see encoder_profiles.py) that would bring the encoders below cores."""
+    profiles = {cam["serial"]: cam["profile"] for cam in cameras}
+    def total():
+        return sum(camera_load(dict(cam, profile=profiles[cam["serial"]]), calibration)["cpu_cores"] for cam in cameras)
+    changed = True
+    while total() > cores and changed:
+        changed = False
+        # speed up the most expensive camera first
+        for cam in sorted(cameras, key=lambda c: -camera_load(dict(c, profile=profiles[c["serial"]]), calibration)["cpu_cores"]):
+            faster = faster_profile(profiles[cam["serial"]])
+            if faster is not None:
+                profiles[cam["serial"]] = faster
+                changed = True
+                break
+    changes = {cam["serial"]: profiles[cam["serial"]] for cam in cameras if profiles[cam["serial"]] != cam["profile"]}
+    if not changes:
+        return ["Lower the frame rate to about {:.0f}% of the planned one.".format(100 * cores / total())]
+    result = ["Encoder profile {} for cam {} (about {:.1f} cores then).".format(p, s, total()) for s, p in changes.items()]
+    if total() > cores:
+        result.append("Even then, lower the frame rate to about {:.0f}% of the planned one.".format(100 * cores / total()))
+    return result
+
+def plan_str(report):
+    lines = []
+    for serial, c in report["cameras"].items():
+        lines.append("Cam {}: {}x{} {} at {:g} fps ({}): USB {:.0f} MB/s, encoder {:.2f} cores, disk {:.1f} MB/s, at most {:.1f} fps".format(
+            serial, c["width"] // c["binning"], c["height"] // c["binning"], c["pixel_format"], c["fps"], c["profile"],
+            c["usb_bytes_per_second"] / 1e6, c["cpu_cores"], c["disk_bytes_per_second"] / 1e6, c["max_fps"]))
+    for name, bus in report["buses"].items():
+        lines.append("USB bus {}: {:.0f} of {:.0f} MB/s ({} camera(s))".format(name if name is not None else "(unknown)", bus["usb_bytes_per_second"] / 1e6,
+                                                                         bus["capacity"] / 1e6, len(bus["serials"])))
+    lines.append("Encoders: {:.1f} of {} cores. Disk: {:.1f} MB/s{}.".format(
+        report["cpu_cores"], report["cpu_cores_available"], report["disk_bytes_per_second"] / 1e6,
+        ", {:.1f} GB in {:.0f} s".format(report["total_bytes"] / 1e9, report["duration"]) if report["total_bytes"] is not None else ""))
+    if report["problems"]:
+        lines += ["Problem: " + p for p in report["problems"]]
+        lines += ["Suggestion: " + s for s in report["suggestions"]]
+    else:
+        lines.append("The planned settings should be sustainable.")
+    return "\n".join(lines)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Plans USB, CPU and disk load of a recording.")
+    parser.add_argument("--connected", action='store_true', help="plan for the connected cameras")
+    parser.add_argument("--cams", type=int, default=1, help="number of cameras (without --connected)")
+    parser.add_argument("--size", default="1936x1216")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--pixel-format", default='Mono8', choices=list(PIXEL_FORMATS))
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=list(ENCODER_PROFILES))
+    parser.add_argument("--exposure", type=float, default=20000, help="exposure time in us")
+    parser.add_argument("--duration", type=float, default=3600, help="seconds")
+    parser.add_argument("--vid-dir", default=None, help="folder of the videos (checks the free space)")
+    parser.add_argument("--disk-mb-s", type=float, default=None, help="sustained write speed of the disk")
+    parser.add_argument("--calibrate", action='store_true', help="measure the encoder profiles on this machine first")
+    parser.add_argument("--ffmpeg", default='ffmpeg')
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+    if args.calibrate:
+        calibrate(args.ffmpeg)
+        print("Saved the calibration to {}.".format(DEFAULT_CALIBRATION_FILE))
+    if args.connected:
+        cams = connected_cameras(size, args.fps, args.pixel_format, args.profile, args.exposure)
+    else:
+        cams = cameras_from_config(args.cams, size, args.fps, args.pixel_format, args.profile, args.exposure)
+    print(plan_str(plan(cams, args.duration, args.vid_dir, disk_bytes_per_second=args.disk_mb_s * 1e6 if args.disk_mb_s else None)))
@@ -0,0 +1,41 @@
+"""
+    Measures how much CPU time a thread uses, split into named phases
+    (e.g. 'idle' while waiting for the first trigger and 'recording').
+
+    Uses time.thread_time(), so start(), phase() and stop() have to be called
+    from the thread that is measured. Reading the results is fine from any thread.
+"""
+
+import time
+
+class ThreadCpuMeter:
+    def __init__(self):
+        self.phases = dict() # phase name -> [cpu seconds, wall seconds]
+        self.current = None
+
+    def start(self, phase):
+        self.phase(phase)
+
+    def phase(self, name):
+        """ Ends the current phase (if any) and starts the given one."""
+        self.stop()
+        self.current = name
+        self.cpu0 = time.thread_time()
+        self.wall0 = time.perf_counter()
+
+    def stop(self):
+        if self.current is None:
+            return
+        cpu_wall = self.phases.setdefault(self.current, [0.0, 0.0])
+        cpu_wall[0] += time.thread_time() - self.cpu0
+        cpu_wall[1] += time.perf_counter() - self.wall0
+        self.current = None
+
+    def usage(self, name):
+        """ CPU load of a finished phase, in percent of one core."""
+        cpu, wall = self.phases.get(name, (0.0, 0.0))
+        return 100 * cpu / wall if wall > 0 else 0.0
+
+    def report_str(self):
+        return ", ".join("{}: {:.2f} s CPU in {:.2f} s ({:.1f}% of a core)".format(name, cpu, wall, self.usage(name))
+                         for name, (cpu, wall) in self.phases.items())
@@ -0,0 +1,161 @@
+"""
+    Named encoder settings for FFMPEG_VideoWriter.
+
+    The cameras deliver gray frames ('gray' for Mono8, 'gray12le' for Mono12p).
+    The old default (libx264, preset medium, yuv420p) converts every frame to YUV
+    and encodes two empty chroma planes, which is the most expensive step of the
+    recording. The gray profiles hand the frames to the encoder as they are.
+
+    x264_medium
+      The old default, kept for compatibility (yuv420p, plays everywhere).
+    x264_veryfast, x264_ultrafast
+      The same with faster presets, still yuv420p. x264_medium falls back to
+      them, so its videos keep playing everywhere.
+    x264_archive_gray
+      H.264 gray with preset slow and CRF 20, to compress raw or lossless
+      recordings after the session (see transcode_batch.py), too slow for live use.
+    x264_veryfast_gray, x264_ultrafast_gray
+      H.264 in 4:0:0 (gray), 12 bit frames are stored with 10 bits. Needs a
+      player that supports the High 4:0:0 profile (ffmpeg/OpenCV do).
+    ffv1_gray
+      Lossless, split into 16 slices, so it is encoded on several cores.
+    rawvideo
+      No encoding at all, the least CPU but about one frame size per frame on disk.
+    mjpeg
+      Intra-only, cheap to seek. ffmpeg's MJPEG encoder has no gray format,
+      so it is the only profile that still stores (empty) chroma.
+    raw_mmap
+      No ffmpeg: the frames are copied into memory-mapped chunk files with a
+      per-frame index (see raw_writer.py). The most frames per second, for
+      fast disks, to be compressed after the recording.
+
+    If an encoder cannot keep up, the recorder changes to the profile's
+    'faster' one for the next segment (see backpressure.py). ffv1_gray falls
+    back to rawvideo only if the encoder's CPU is the limit: rawvideo writes
+    about twice the bytes, so the recorder first checks that the disk has the
+    throughput for them ("faster_if_cpu_bound").
+
+    Run this file to measure each profile on synthetic frames:
+    python encoder_profiles.py [ffmpeg] [n_frames] [width] [height]
+"""
+
+ENCODER_PROFILES = {
+    'x264_medium': {"codec": "libx264", "preset": "medium", "params": [], "faster": 'x264_veryfast',
+                    "pixfmt": {"gray": "yuv420p", "gray12le": "yuv420p"}},
+    'x264_veryfast': {"codec": "libx264", "preset": "veryfast", "params": [], "faster": 'x264_ultrafast',
+                      "pixfmt": {"gray": "yuv420p", "gray12le": "yuv420p"}},
+    'x264_ultrafast': {"codec": "libx264", "preset": "ultrafast", "params": [], "faster": None,
+                       "pixfmt": {"gray": "yuv420p", "gray12le": "yuv420p"}},
+    'x264_archive_gray': {"codec": "libx264", "preset": "slow", "params": ['-crf', '20'], "faster": 'x264_veryfast_gray',
+                          "pixfmt": {"gray": "gray", "gray12le": "gray10le"}},
+    'x264_veryfast_gray': {"codec": "libx264", "preset": "veryfast", "params": [], "faster": 'x264_ultrafast_gray',
+                           "pixfmt": {"gray": "gray", "gray12le": "gray10le"}},
+    'x264_ultrafast_gray': {"codec": "libx264", "preset": "ultrafast", "params": [], "faster": None,
+                            "pixfmt": {"gray": "gray", "gray12le": "gray10le"}},
+    'ffv1_gray': {"codec": "ffv1", "preset": None, "params": ['-level', '3', '-slices', '16', '-slicecrc', '1', '-g', '1'], "faster": 'rawvideo',
+                  "faster_if_cpu_bound": True,
+                  "pixfmt": {"gray": "gray", "gray12le": "gray12le"}},
+    'rawvideo': {"codec": "rawvideo", "preset": None, "params": [], "faster": None,
+                 "pixfmt": {"gray": "gray", "gray12le": "gray12le"}},
+    'mjpeg': {"codec": "mjpeg", "preset": None, "params": ['-q:v', '3'], "faster": None,
+              "pixfmt": {"gray": "yuvj420p", "gray12le": "yuvj420p"}},
+    'raw_mmap': {"writer": "raw", "ext": "raw", "codec": "raw", "preset": None, "params": [], "faster": None,
+                 "pixfmt": {"gray": "gray", "gray12le": "gray12le"}},
+}
+
+DEFAULT_PROFILE = 'x264_medium'
+
+def profile_writer_args(name, pixfmt):
+    """ Keyword arguments for FFMPEG_VideoWriter (codec, preset, out_pixfmt, ffmpeg_params)
+    to encode frames of the input pixel format pixfmt with the named profile."""
+    if name not in ENCODER_PROFILES:
+        raise ValueError("Unknown encoder profile '{}', available: {}".format(name, ", ".join(ENCODER_PROFILES)))
+    profile = ENCODER_PROFILES[name]
+    if pixfmt not in profile["pixfmt"]:
+        raise ValueError("Encoder profile '{}' does not support pixel format '{}'.".format(name, pixfmt))
+    return {"writer": profile.get("writer", "ffmpeg"), "codec": profile["codec"], "preset": profile["preset"],
+            "out_pixfmt": profile["pixfmt"][pixfmt], "ffmpeg_params": list(profile["params"])}
+
+def profile_extension(name):
+    """ File extension of the videos of this profile."""
+    return ENCODER_PROFILES[name].get("ext", "avi")
+
+def create_writer(writer="ffmpeg", preallocate_bytes=0, **writer_args):
+    """ The writer for the arguments from profile_writer_args (plus filename, size, fps, pixfmt, ...):
+    an FFMPEG_VideoWriter, or a RawFrameWriter for writer='raw'. With preallocate_bytes, the blocks
+    of the video file are reserved first where possible (see storage.py), and ffmpeg writes into them."""
+    if writer == "raw":
+        from raw_writer import RawFrameWriter
+        return RawFrameWriter(**writer_args)
+    from b_record_to_vid import FFMPEG_VideoWriter
+    if preallocate_bytes:
+        from storage import preallocate
+        if preallocate(writer_args["filename"], preallocate_bytes):
+            # write into the preallocated blocks instead of freeing them
+            writer_args["ffmpeg_params"] = list(writer_args.get("ffmpeg_params") or []) + ["-truncate", "0"]
+    return FFMPEG_VideoWriter(**writer_args)
+
+def writer_files(filename):
+    """ All files a writer created for this video (a raw video has several)."""
+    from raw_writer import raw_files
+    return raw_files(filename) if filename.endswith(".raw") else [filename]
+
+def faster_profile(name, cpu_bound=True):
+    """ The next cheaper profile to fall back to (lossless ones stay lossless, yuv420p ones yuv420p), or None.
+    cpu_bound=False: the disk may be the limit, so no fallback that writes more (ffv1_gray -> rawvideo)."""
+    profile = ENCODER_PROFILES[name]
+    if profile.get("faster_if_cpu_bound") and not cpu_bound:
+        return None
+    return profile["faster"]
+
+def measure_profiles(ffmpeg='ffmpeg', n=300, size=(1936, 1216), names=None):
+    """ Encodes n noisy gray frames with every profile (or the named ones).
+    Returns name -> fps, bytes per frame and ffmpeg's CPU seconds per frame (None where it cannot be measured)."""
+    import os
+    import tempfile
+    import time
+    import numpy as np
+    try:
+        import resource
+    except ImportError: # Windows
+        resource = None
+    def child_cpu():
+        if resource is None:
+            return None
+        r = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return r.ru_utime + r.ru_stime
+    rng = np.random.default_rng(0)
+    # a static scene with sensor noise, closer to a real camera than pure noise
+    scene = np.tile(np.linspace(0, 200, size[0], dtype=np.uint8), (size[1], 1))
+    frames = [np.clip(scene + rng.integers(0, 16, scene.shape, dtype=np.uint8), 0, 255).astype(np.uint8) for _ in range(8)]
+    tmp = tempfile.mkdtemp()
+    results = dict()
+    for name in (names or ENCODER_PROFILES):
+        fname = os.path.join(tmp, name + "." + profile_extension(name))
+        cpu0 = child_cpu()
+        t0 = time.perf_counter()
+        with create_writer(filename=fname, size=size, fps=30, pixfmt='gray', ffmpeg_command=ffmpeg, **profile_writer_args(name, 'gray')) as writer:
+            for i in range(n):
+                writer.write_frame(frames[i % len(frames)])
+        t = time.perf_counter() - t0
+        cpu1 = child_cpu() # the writer has waited for ffmpeg
+        files = writer_files(fname)
+        results[name] = {"fps": n / t, "bytes_per_frame": sum(os.path.getsize(f) for f in files) / n,
+                         "cpu_seconds_per_frame": (cpu1 - cpu0) / n if cpu0 is not None else None}
+        for f in files:
+            os.remove(f)
+    os.rmdir(tmp)
+    return results
+
+def bench_profiles(ffmpeg='ffmpeg', n=300, size=(1936, 1216)):
+    """ Encodes n noisy gray frames with every profile and prints the frame rate and file size."""
+    for name, r in measure_profiles(ffmpeg, n, size).items():
+        cpu = "{:7.2f} ms CPU/frame".format(r["cpu_seconds_per_frame"] * 1e3) if r["cpu_seconds_per_frame"] is not None else ""
+        print("{:20s} {:7.1f} fps {:9.1f} kB/frame {}".format(name, r["fps"], r["bytes_per_frame"] / 1e3, cpu))
+
+if __name__ == '__main__':
+    import sys
+    ffmpeg = sys.argv[1] if len(sys.argv) > 1 else 'ffmpeg'
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    size = (int(sys.argv[3]), int(sys.argv[4])) if len(sys.argv) > 4 else (1936, 1216)
+    bench_profiles(ffmpeg, n, size)
@@ -0,0 +1,59 @@
+"""
+    Caches the configuration of each camera as a pylon feature persistence file
+    (.pfs), so the next start loads it with one call instead of setting the nodes
+    one by one.
+
+    Per serial number, the cache folder holds <serial>.pfs and <serial>.json. The
+    JSON file has the camera model and the recorder's configuration (size, pixel
+    format, trigger mode, ...) the .pfs file was saved with. The cached file is
+    only used if both still match, otherwise the recorder sets the nodes and
+    saves a new one.
+"""
+
+import json
+import os
+from pathlib import Path
+from pypylon import pylon
+
+class FeatureCache:
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def paths(self, serial):
+        return self.folder / (serial + ".pfs"), self.folder / (serial + ".json")
+
+    def matches(self, serial, model, config):
+        """ True if there is a cached file saved from this model with this configuration."""
+        pfs, meta = self.paths(serial)
+        try:
+            with open(meta) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return pfs.exists() and cached.get("model") == model and cached.get("config") == config
+
+    def load(self, cam, serial, model, config):
+        """ Applies the cached settings to the (open) camera. Returns False if there are none for this
+        model and configuration, or if pylon rejects the file (it is removed then)."""
+        if not self.matches(serial, model, config):
+            return False
+        try:
+            pylon.FeaturePersistence.Load(str(self.paths(serial)[0]), cam.GetNodeMap(), True)
+        except Exception:
+            self.invalidate(serial)
+            return False
+        return True
+
+    def save(self, cam, serial, model, config):
+        pfs, meta = self.paths(serial)
+        pylon.FeaturePersistence.Save(str(pfs), cam.GetNodeMap())
+        with open(meta, 'w') as f:
+            json.dump({"model": model, "config": config}, f, indent=1)
+
+    def invalidate(self, serial):
+        for p in self.paths(serial):
+            try:
+                os.remove(p)
+            except OSError:
+                pass
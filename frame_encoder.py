@@ -0,0 +1,296 @@
+"""
+    Encode stage of one camera: takes the frames the grab thread put into the
+    camera's ring, writes them to the video and their records to the sidecar.
+
+    Runs in a thread of the recorder or in an encoder worker process
+    (see mp_encoder.py); it only needs the ring, the writer and the sidecar.
+
+    Rollover without stopping the camera: the writer of the next segment is
+    started ahead of time (prepare), and switch_at(grab_index) makes the
+    encoder change to it exactly at that frame. Frames before it go to the old
+    file, frames from it on to the new one. The old writer is closed in the
+    background, so the encoder does not wait for ffmpeg to finish the file.
+
+    With an activity gate (see activity_gate.py), frames without movement are
+    left out before they reach the writer; the sidecar keeps the grab index of
+    every written frame and counts the left out ones as skipped.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+import numpy as np
+
+from cpu_meter import ThreadCpuMeter
+from encoder_profiles import writer_files
+
+class FrameEncoder:
+    def __init__(self, serial, ring, writer, sidecar, write_batch=8, on_error=None, on_segment_closed=None, segment=0, on_written=None,
+                 gate=None):
+        """
+            @param ring: FrameRing or SharedFrameRing the frames come from
+            @param writer: FFMPEG_VideoWriter
+            @param sidecar: FrameSidecar
+            @param write_batch: max. number of waiting frames written with one vectored write
+            @param on_error: called with (serial, exception) if writing fails
+            @param on_segment_closed: called with (serial, info dict) when a segment's file is closed,
+                                      from a background thread
+            @param segment: number of the first segment
+            @param on_written: called with (serial, meta records, time.time()) after frames were handed to ffmpeg,
+                               from the encode thread, so it has to be quick
+            @param gate: ActivityGate that decides which frames are written, None: all
+        """
+        self.serial = serial
+        self.ring = ring
+        self.writer = writer
+        self.sidecar = sidecar
+        self.write_batch = write_batch
+        self.on_error = on_error
+        self.on_segment_closed = on_segment_closed
+        self.on_written = on_written
+        self.gate = gate
+        self.skipped_pending = 0 # frames the gate left out since the last written frame of the segment
+        self.segment = segment
+        self.first_grab_index = 0 # grab index of the first frame of the current segment
+        self.last_grab_index = None # grab index of the last frame written to the current segment
+        self.cond = threading.Condition()
+        self.prepared = deque() # (writer, sidecar) already started for the next segments
+        self.switches = deque() # grab indices at which to change to the next prepared writer
+        self.closers = []
+        self.cpu = ThreadCpuMeter()
+        self.frames_written = 0
+        self.frames_skipped = 0 # left out by the gate
+        # over all segments, for the live metrics
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self.stderr_lines_closed = 0 # ffmpeg messages of the segments closed so far
+
+    def prepare(self, writer, sidecar, replace=False):
+        """ Hands over an already started writer (and its sidecar) for the next segment.
+        With replace=True it takes the place of the writer prepared before, which is
+        discarded (e.g. to change the encoder profile of the next segment)."""
+        old = None
+        with self.cond:
+            if replace and self.prepared:
+                old = self.prepared.pop()
+            self.prepared.append((writer, sidecar))
+            self.cond.notify_all()
+        if old is not None:
+            self.discard(*old)
+
+    def discard_prepared(self):
+        """ Discards the writer prepared last, before its replacement is started (which may use the same file names).
+        A switch in the meantime waits for the replacement."""
+        with self.cond:
+            old = self.prepared.pop() if self.prepared else None
+        if old is not None:
+            self.discard(*old)
+
+    def switch_at(self, grab_index):
+        """ The frame with this grab index and all later ones go to the next prepared writer."""
+        with self.cond:
+            self.switches.append(grab_index)
+
+    def run(self):
+        """ Encodes until the ring is closed and empty."""
+        ring = self.ring
+        self.cpu.start('encoding')
+        while True:
+            frames = ring.get_many(self.write_batch, timeout=0.5)
+            if not frames:
+                if ring.closed:
+                    break
+                continue
+            meta = ring.peek_meta(len(frames))
+            try:
+                self.write(frames, meta)
+            except Exception as err: # e.g. ffmpeg gone (IOError), a frame the raw writer cannot take (ValueError)
+                ring.close()
+                if self.on_error:
+                    self.on_error(self.serial, err)
+                break
+            ring.release(len(frames))
+        self.cpu.stop()
+
+    def write(self, frames, meta):
+        while True:
+            with self.cond:
+                switch_index = self.switches[0] if self.switches else None
+            if switch_index is None:
+                break
+            k = int(np.count_nonzero(meta['grab_index'] < switch_index))
+            if k == len(frames):
+                break
+            self.write_segment(frames[:k], meta[:k])
+            self.switch(switch_index)
+            frames, meta = frames[k:], meta[k:]
+        self.write_segment(frames, meta)
+
+    def write_segment(self, frames, meta):
+        if not frames:
+            return
+        skipped = None
+        if self.gate is not None:
+            frames, meta, skipped = self.apply_gate(frames, meta)
+            if not frames:
+                return
+        t = time.perf_counter()
+        self.writer.write_frames(frames, meta) # the ring slots go to the pipe without another copy
+        self.write_seconds += time.perf_counter() - t
+        self.bytes_written += sum(f.nbytes for f in frames)
+        if self.on_written:
+            self.on_written(self.serial, meta, time.time())
+        self.sidecar.add_meta(meta, self.first_grab_index, skipped)
+        self.last_grab_index = int(meta['grab_index'][-1])
+        self.frames_written += len(frames)
+
+    def apply_gate(self, frames, meta):
+        """ The frames (and their records) the gate keeps, and how many were left out before each of them."""
+        keep = self.gate.select(frames)
+        if self.last_grab_index is None:
+            keep[0] = True # every segment starts with a frame
+        left_out = np.concatenate(([0], np.cumsum(~keep))) # left out among the first k frames
+        self.frames_skipped += int(left_out[-1])
+        kept = np.flatnonzero(keep)
+        if not len(kept):
+            self.skipped_pending += int(left_out[-1])
+            return [], meta[:0], None
+        skipped = np.diff(np.concatenate(([-self.skipped_pending], left_out[kept])))
+        self.skipped_pending = int(left_out[-1] - left_out[kept[-1]])
+        return [frames[i] for i in kept], meta[kept], skipped
+
+    def switch(self, grab_index, timeout=10):
+        """ Changes to the next prepared writer, closing the current one in the background."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.prepared, timeout):
+                raise IOError("Cam {}: no writer prepared for segment {}.".format(self.serial, self.segment + 1))
+            self.switches.popleft()
+            writer, sidecar = self.prepared.popleft()
+        closer = threading.Thread(target=self.close_segment, args=(self.writer, self.sidecar, self.segment, self.first_grab_index,
+                                                                   self.last_grab_index, grab_index))
+        closer.daemon = True
+        closer.start()
+        self.closers.append(closer)
+        self.writer, self.sidecar = writer, sidecar
+        self.segment += 1
+        self.first_grab_index = grab_index
+        self.last_grab_index = None
+        self.skipped_pending = 0
+
+    def close_segment(self, writer, sidecar, segment, first_grab_index, last_grab_index, end_grab_index=None):
+        end_time = time.time() # the segment's last frame has been handed to the writer
+        writer.close()
+        self.stderr_lines_closed += writer.stderr_lines
+        report = sidecar.close()
+        info = {"segment": segment, "filename": writer.filename, "sidecar": sidecar.filename,
+                "first_grab_index": first_grab_index, "last_grab_index": last_grab_index, "end_grab_index": end_grab_index,
+                "bytes_written": writer.bytes_written, "write_seconds": writer.write_seconds, "end_time": end_time,
+                "report": sidecar.report_str()}
+        info.update(report)
+        if self.on_segment_closed:
+            self.on_segment_closed(self.serial, info)
+        return info
+
+    def metrics(self):
+        """ Counters over the whole recording so far (read from another thread)."""
+        writer = self.writer
+        return {"frames_written": self.frames_written, "frames_skipped": self.frames_skipped, "bytes_written": self.bytes_written,
+                "write_seconds": self.write_seconds, "segment": self.segment,
+                "ffmpeg_messages": self.stderr_lines_closed + writer.stderr_lines,
+                "ffmpeg_last_message": writer.stderr_tail[-1] if writer.stderr_tail else ""}
+
+    def close(self):
+        """ Closes the current segment (after run() has finished), waits for the
+        segments closing in the background and discards unused prepared writers.
+        Returns the info of the last segment."""
+        info = self.close_segment(self.writer, self.sidecar, self.segment, self.first_grab_index, self.last_grab_index)
+        for closer in self.closers:
+            closer.join()
+        with self.cond:
+            prepared, self.prepared = list(self.prepared), deque()
+        for writer, sidecar in prepared:
+            self.discard(writer, sidecar)
+        return info
+
+    def discard(self, writer, sidecar):
+        """ Closes a prepared writer that was never used and deletes its files."""
+        writer.close()
+        sidecar.close()
+        for fname in writer_files(writer.filename) + [sidecar.filename]:
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+def check_gapless_rollover(n_frames=3000, n_switches=20, seed=1):
+    """ Runs a producer thread and an encoder with fake writers, switches segments at
+    random frames while frames keep coming, and checks that every frame ended up in
+    exactly one segment, in order, and that each segment starts at its switch index."""
+    import tempfile
+    import random
+    from frame_ring import FrameRing
+    from frame_sidecar import FrameSidecar, read_sidecar
+
+    class ListWriter:
+        def __init__(self, filename):
+            self.filename = filename
+            self.frames = []
+            self.bytes_written = 0
+            self.write_seconds = 0.0
+            self.stderr_lines = 0
+        def write_frames(self, frames, meta=None):
+            self.frames.extend(int(f[0, 0]) for f in frames)
+        def close(self):
+            pass
+
+    rnd = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp: # the sidecars
+        def new_segment(i):
+            return ListWriter("seg{}".format(i)), FrameSidecar(os.path.join(tmp, "seg{}_frames.bin".format(i)))
+        ring = FrameRing((4, 4), dtype=np.uint32, depth=n_frames)
+        closed = []
+        writer, sidecar = new_segment(0)
+        encoder = FrameEncoder("test", ring, writer, sidecar, write_batch=8, on_segment_closed=lambda s, info: closed.append(info))
+        next_writer, next_sidecar = new_segment(1)
+        encoder.prepare(next_writer, next_sidecar)
+        writers = [writer, next_writer]
+        counter = [0]
+        def produce():
+            for i in range(n_frames):
+                ring.put(np.full((4, 4), i, dtype=np.uint32), (time.time(), i, i, i))
+                counter[0] = i + 1
+                if rnd.random() < 0.01:
+                    time.sleep(0.001)
+            ring.close()
+        producer = threading.Thread(target=produce)
+        consumer = threading.Thread(target=encoder.run)
+        producer.start()
+        consumer.start()
+        switch_indices = []
+        for i in range(n_switches):
+            time.sleep(rnd.random() * 0.002)
+            index = counter[0] # like the recorder: the next frame to be grabbed starts the new segment
+            if switch_indices and index <= switch_indices[-1]:
+                continue
+            switch_indices.append(index)
+            encoder.switch_at(index)
+            next_writer, next_sidecar = new_segment(len(writers))
+            writers.append(next_writer)
+            encoder.prepare(next_writer, next_sidecar)
+        producer.join()
+        consumer.join()
+        encoder.close()
+        used = writers[:len(switch_indices) + 1]
+        assert sum((w.frames for w in used), []) == list(range(n_frames)), "frames lost or reordered across a rollover"
+        starts = [0] + switch_indices
+        for w, start, info in zip(used, starts, sorted(closed, key=lambda i: i["segment"])):
+            assert not w.frames or w.frames[0] == start, "segment {} starts at frame {}, not at {}".format(w.filename, w.frames[0], start)
+            records = read_sidecar(info["sidecar"])
+            assert list(records['block_id']) == w.frames and list(records['frame_index']) == [f - start for f in w.frames]
+            assert info["dropped"] == 0
+        return len(used)
+
+if __name__ == '__main__':
+    n = check_gapless_rollover()
+    print("OK: 3000 frames in {} segments, none lost or duplicated across rollovers.".format(n))
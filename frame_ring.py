@@ -0,0 +1,133 @@
+"""
+    Bounded ring of preallocated frame slots between the grab thread and the
+    encode thread of one camera.
+
+    The grab thread copies each frame into the next free slot, the encode thread
+    writes the filled slots to the video in order. If the encoder falls behind
+    and all slots are full, new frames are dropped and counted instead of
+    blocking RetrieveResult.
+"""
+
+import threading
+import numpy as np
+
+# Per-frame information that travels through the ring along with the frame.
+FRAME_META_DTYPE = np.dtype([
+    ('host_time', '<f8'), # time.time() when RetrieveResult returned
+    ('timestamp', '<u8'), # camera timestamp tick
+    ('block_id', '<u8'), # camera BlockID
+    ('grab_index', '<u8'), # number of frames grabbed by this camera before this one
+])
+
+class FrameRing:
+    """ Single producer / single consumer ring of preallocated frames.
+
+    Parameters
+    -----------
+
+    shape
+      Shape of one frame as returned by GetArray, i.e. (height, width).
+
+    dtype
+      NumPy dtype of one frame (uint8 for Mono8).
+
+    depth
+      Number of slots. Frames arriving while all slots are in use are dropped.
+
+    meta_dtype
+      Structured dtype of the per-frame information kept next to each slot.
+
+    """
+
+    def __init__(self, shape, dtype=np.uint8, depth=64, meta_dtype=FRAME_META_DTYPE):
+        self.shape = tuple(shape)
+        self.capacity = depth
+        self.slots = np.empty((depth,) + self.shape, dtype=dtype)
+        self.meta = np.zeros(depth, dtype=meta_dtype)
+        self._cond = threading.Condition()
+        self._head = 0 # next slot the producer fills
+        self._tail = 0 # oldest slot not yet released by the consumer
+        self._count = 0 # filled slots not yet released
+        self.closed = False
+        self.frames_in = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def reserve(self):
+        """ Returns the next free slot for the producer to fill, or None (and counts
+        a dropped frame) if the ring is full. Must be followed by commit()."""
+        with self._cond:
+            if self._count == self.capacity:
+                self.dropped += 1
+                return None
+            return self.slots[self._head]
+
+    def commit(self, meta=None):
+        """ Hands the slot returned by reserve() over to the consumer, together with
+        its meta record (a tuple matching meta_dtype)."""
+        with self._cond:
+            if meta is not None:
+                self.meta[self._head] = meta
+            self._head = (self._head + 1) % self.capacity
+            self._count += 1
+            self.frames_in += 1
+            if self._count > self.high_water:
+                self.high_water = self._count
+            self._cond.notify()
+
+    def put(self, frame, meta=None):
+        """ Copies frame into the next free slot. Returns False if it was dropped."""
+        slot = self.reserve()
+        if slot is None:
+            return False
+        np.copyto(slot, frame, casting='no')
+        self.commit(meta)
+        return True
+
+    def get(self, timeout=None):
+        """ Waits for the oldest filled slot and returns it without removing it.
+        Returns None on timeout, or when the ring is closed and empty."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._count > 0 or self.closed, timeout)
+            if self._count == 0:
+                return None
+            return self.slots[self._tail]
+
+    def get_many(self, max_frames, timeout=None):
+        """ Like get(), but returns a list of up to max_frames filled slots (oldest
+        first), as many as are waiting. Empty list on timeout or closed and empty."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._count > 0 or self.closed, timeout)
+            n = min(self._count, max_frames)
+            return [self.slots[(self._tail + i) % self.capacity] for i in range(n)]
+
+    def peek_meta(self, n):
+        """ Copy of the meta records of the n oldest filled slots."""
+        with self._cond:
+            return self.meta[(self._tail + np.arange(n)) % self.capacity]
+
+    def release(self, n=1):
+        """ Gives the n oldest slots returned by get()/get_many() back to the producer."""
+        with self._cond:
+            self._tail = (self._tail + n) % self.capacity
+            self._count -= n
+
+    def close(self):
+        """ No more frames will be put. The consumer drains what is left."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def depth(self):
+        """ Number of frames waiting to be encoded."""
+        with self._cond:
+            return self._count
+
+    def stats(self):
+        with self._cond:
+            return {"depth": self._count, "capacity": self.capacity, "high_water": self.high_water,
+                    "frames_in": self.frames_in, "dropped": self.dropped}
+
+    def stats_str(self):
+        s = self.stats()
+        return "queue depth {depth}/{capacity}, high-water {high_water}, {frames_in} frames queued, {dropped} dropped (ring full)".format(**s)
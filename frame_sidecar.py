@@ -0,0 +1,195 @@
+"""
+    Per-frame sidecar file written next to each video segment.
+
+    One fixed-size record (32 bytes, see SIDECAR_DTYPE) per frame that made it
+    into the video: host time, camera timestamp tick, BlockID and frame index
+    within the segment. Gaps in the BlockID are frames that the camera sent
+    (or should have sent) but that are missing from the video; they are
+    summarised in a dropped-frame report when the segment is closed. Frames
+    the activity gate left out on purpose (see activity_gate.py) are counted
+    as skipped, not as dropped.
+
+    The file has no header, read it with read_sidecar() or
+    np.memmap(filename, dtype=SIDECAR_DTYPE, mode='r').
+"""
+
+import numpy as np
+
+SIDECAR_DTYPE = np.dtype([
+    ('host_time', '<f8'), # time.time() when RetrieveResult returned
+    ('timestamp', '<u8'), # camera timestamp in ticks (ns on ace USB cameras)
+    ('block_id', '<u8'), # BlockID, increases by one for every frame the camera sends
+    ('frame_index', '<u8'), # index of the frame within the segment, counting from the first grabbed frame
+])
+
+def sidecar_filename(vid_fname):
+    """ 2023-10-05_12-00-00_22334455_rec.avi -> 2023-10-05_12-00-00_22334455_rec_frames.bin"""
+    stem = vid_fname.rsplit('.', 1)[0]
+    return stem + '_frames.bin'
+
+def read_sidecar(filename):
+    return np.fromfile(filename, dtype=SIDECAR_DTYPE)
+
+class BlockIdGaps:
+    """ Counts frames missing between consecutive BlockIDs."""
+
+    def __init__(self, max_listed_gaps=20):
+        self.max_listed_gaps = max_listed_gaps
+        self.n_frames = 0
+        self.first_block_id = None
+        self.last_block_id = None
+        self.dropped = 0
+        self.skipped = 0 # left out by the activity gate
+        self.n_gaps = 0
+        self.largest_gap = 0
+        self.gaps = [] # (frame_index before which frames are missing, number missing)
+
+    def track(self, block_ids, frame_indices, skipped=None):
+        """ @param skipped: per frame, the number of frames skipped on purpose right before it (None: none)"""
+        if self.first_block_id is None:
+            self.first_block_id = int(block_ids[0])
+            prev = block_ids[:1]
+            if skipped is not None:
+                skipped = np.concatenate(([0], skipped[1:])) # before the first frame of the segment does not count
+        else:
+            prev = np.array([self.last_block_id], dtype=np.uint64)
+        missing = np.diff(np.concatenate((prev, block_ids)).astype(np.int64)) - 1
+        if skipped is not None:
+            self.skipped += int(np.sum(skipped))
+            missing -= skipped
+        gap_pos = np.flatnonzero(missing > 0)
+        if len(gap_pos):
+            self.dropped += int(missing[gap_pos].sum())
+            self.n_gaps += len(gap_pos)
+            self.largest_gap = max(self.largest_gap, int(missing[gap_pos].max()))
+            for p in gap_pos[:max(0, self.max_listed_gaps - len(self.gaps))]:
+                self.gaps.append((int(frame_indices[p]), int(missing[p])))
+        self.last_block_id = int(block_ids[-1])
+        self.n_frames += len(block_ids)
+
+    def report(self):
+        """ Dropped-frame report as a dict."""
+        expected = 0 if self.first_block_id is None else self.last_block_id - self.first_block_id + 1
+        return {"frames": self.n_frames, "expected": expected, "dropped": self.dropped, "skipped": self.skipped, "gaps": self.n_gaps,
+                "largest_gap": self.largest_gap, "first_gaps": list(self.gaps)}
+
+    def report_str(self):
+        r = self.report()
+        result = "{frames} of {expected} frames written, {dropped} dropped in {gaps} gaps (largest {largest_gap})".format(**r)
+        if r["skipped"]:
+            result += ", {} skipped as inactive".format(r["skipped"])
+        if r["first_gaps"]:
+            result += ", missing before frame index (count): " + ", ".join("{} ({})".format(i, n) for i, n in r["first_gaps"])
+            if r["gaps"] > len(r["first_gaps"]):
+                result += ", ..."
+        return result
+
+class FrameSidecar:
+    """ Appends SIDECAR_DTYPE records to a file and tracks BlockID gaps on the fly.
+
+    Parameters
+    -----------
+
+    filename
+      Path of the sidecar file, see sidecar_filename().
+
+    flush_every
+      Number of records buffered in memory before they are written to the file.
+
+    max_listed_gaps
+      The report lists the position of the first max_listed_gaps gaps, all gaps are counted.
+
+    """
+
+    def __init__(self, filename, flush_every=256, max_listed_gaps=20):
+        self.filename = filename
+        self.filep = open(filename, 'wb')
+        self.buffer = np.zeros(flush_every, dtype=SIDECAR_DTYPE)
+        self.n_buffered = 0
+        self.gaps = BlockIdGaps(max_listed_gaps)
+        self.first_host_time = None
+        self.last_host_time = None
+
+    def add(self, host_time, timestamp, block_id, frame_index):
+        rec = self.buffer[self.n_buffered]
+        rec['host_time'] = host_time
+        rec['timestamp'] = timestamp
+        rec['block_id'] = block_id
+        rec['frame_index'] = frame_index
+        self.n_buffered += 1
+        self.gaps.track(np.array([block_id], dtype=np.uint64), np.array([frame_index], dtype=np.uint64))
+        if self.first_host_time is None:
+            self.first_host_time = host_time
+        self.last_host_time = host_time
+        if self.n_buffered == len(self.buffer):
+            self.flush()
+
+    def add_many(self, records, skipped=None):
+        """ Adds an array of SIDECAR_DTYPE records (skipped: see BlockIdGaps.track)."""
+        if len(records) == 0:
+            return
+        self.gaps.track(records['block_id'], records['frame_index'], skipped)
+        if self.first_host_time is None:
+            self.first_host_time = float(records['host_time'][0])
+        self.last_host_time = float(records['host_time'][-1])
+        while len(records):
+            n = min(len(records), len(self.buffer) - self.n_buffered)
+            self.buffer[self.n_buffered:self.n_buffered+n] = records[:n]
+            self.n_buffered += n
+            records = records[n:]
+            if self.n_buffered == len(self.buffer):
+                self.flush()
+
+    def add_meta(self, meta, first_grab_index=0, skipped=None):
+        """ Adds records for frames described by FRAME_META_DTYPE meta records from
+        the frame ring. first_grab_index is the grab index of the segment's first frame,
+        skipped the number of frames the activity gate left out before each frame."""
+        records = np.empty(len(meta), dtype=SIDECAR_DTYPE)
+        records['host_time'] = meta['host_time']
+        records['timestamp'] = meta['timestamp']
+        records['block_id'] = meta['block_id']
+        records['frame_index'] = meta['grab_index'] - first_grab_index
+        self.add_many(records, skipped)
+
+    def flush(self):
+        if self.n_buffered:
+            self.filep.write(memoryview(self.buffer[:self.n_buffered]).cast('B'))
+            self.n_buffered = 0
+        self.filep.flush()
+
+    def report(self):
+        """ Dropped-frame report of the segment so far, as a dict (plus the host time of its first and last frame)."""
+        result = self.gaps.report()
+        result["first_host_time"] = self.first_host_time
+        result["last_host_time"] = self.last_host_time
+        return result
+
+    def report_str(self):
+        return self.gaps.report_str()
+
+    def close(self):
+        """ Writes the remaining records and returns the dropped-frame report."""
+        if self.filep:
+            self.flush()
+            self.filep.close()
+            self.filep = None
+        return self.report()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def dropped_frame_report(filename):
+    """ Report for a sidecar file that has already been written."""
+    records = read_sidecar(filename)
+    gaps = BlockIdGaps()
+    if len(records):
+        gaps.track(records['block_id'], records['frame_index'])
+    return gaps.report_str()
+
+if __name__ == '__main__':
+    import sys
+    for fname in sys.argv[1:]:
+        print("{}: {}".format(fname, dropped_frame_report(fname)))
@@ -0,0 +1,122 @@
+"""
+    Frames lost before they reach the recorder's ring: the grab strategy and
+    buffer pool of pylon, and what pylon and the driver count.
+
+    pylon fills MaxNumBuffer buffers per camera and hands them out in the order
+    given by the grab strategy:
+      OneByOne        every frame in order; if all buffers are full, the driver
+                      has nowhere to put the next frame and it is lost (counted
+                      by the stream grabber, and as a BlockID gap in the sidecar)
+      UpcomingImage   only the frame after RetrieveResult was called, the
+                      others are not grabbed
+      LatestImageOnly the newest frame, older ones are discarded by pylon
+      LatestImages    the newest OutputQueueSize frames
+    Only OneByOne does not drop frames on purpose; it is the default. pylon's
+    default of 10 buffers is about a third of a second at 30 fps, the recorder
+    uses more (max_num_buffer).
+
+    GrabStats counts per camera, in its grab thread, the results that failed
+    (GrabSucceeded() is False, the frame is not written) and the frames pylon
+    discarded before a result (GetNumberOfSkippedImages(), LatestImageOnly and
+    LatestImages). segment_report() adds the stream grabber statistics
+    (Statistic_*, which nodes exist depends on the transport layer) and returns
+    what changed since the last report, once per segment.
+"""
+
+import threading
+
+GRAB_STRATEGIES = ('OneByOne', 'UpcomingImage', 'LatestImageOnly', 'LatestImages')
+LOSSLESS_GRAB_STRATEGIES = ('OneByOne',)
+DEFAULT_GRAB_STRATEGY = 'OneByOne'
+DEFAULT_MAX_NUM_BUFFER = 32
+
+# stream grabber statistic -> name in the reports, for the nodes USB and GigE cameras have
+STREAM_STATISTICS = {
+    "Statistic_Total_Buffer_Count": "buffers",
+    "Statistic_Failed_Buffer_Count": "failed_buffers",
+    "Statistic_Buffer_Underrun_Count": "buffer_underruns",
+    "Statistic_Missed_Frame_Count": "missed_frames",
+    "Statistic_Failed_Packet_Count": "failed_packets",
+    "Statistic_Resynchronization_Count": "resynchronizations",
+}
+# the ones that mean a frame was lost and that have no grab result; a failed buffer is a result
+# with GrabSucceeded() False, already counted as a failed grab
+LOSS_STATISTICS = ("buffer_underruns", "missed_frames")
+
+def check_grab_settings(strategy, max_num_buffer):
+    if strategy not in GRAB_STRATEGIES:
+        raise ValueError("Unknown grab strategy '{}', available: {}".format(strategy, ", ".join(GRAB_STRATEGIES)))
+    if max_num_buffer is not None and max_num_buffer < 1:
+        raise ValueError("max_num_buffer has to be at least 1.")
+
+def read_stream_statistics(cam):
+    """ The stream grabber statistics the camera has (report name -> count)."""
+    result = dict()
+    try:
+        grabber = cam.StreamGrabber
+    except Exception: # the camera is gone
+        return result
+    for node, name in STREAM_STATISTICS.items():
+        try:
+            result[name] = int(getattr(grabber, node).GetValue())
+        except Exception: # not there for this transport layer, or not readable now
+            pass
+    return result
+
+class GrabStats:
+    """ Lost frames of one camera, see above. result() is called by the grab thread, the rest by others."""
+
+    def __init__(self, strategy=DEFAULT_GRAB_STRATEGY, max_num_buffer=None, max_listed_errors=5):
+        self.strategy = strategy
+        self.max_num_buffer = max_num_buffer
+        self.max_listed_errors = max_listed_errors
+        self.lock = threading.Lock()
+        self.failed = 0 # results with GrabSucceeded() False
+        self.skipped = 0 # frames pylon discarded before a result
+        self.errors = [] # (error code, description) of the first failed results of the segment
+        self.statistics = dict() # last read stream grabber statistics
+        self.reported = {"failed_grabs": 0, "skipped_images": 0} # counts at the last segment_report
+        self.reported_statistics = None
+
+    def result(self, grab_result):
+        """ Counts what a grab result says. Returns False if it has no frame."""
+        skipped = grab_result.GetNumberOfSkippedImages()
+        ok = grab_result.GrabSucceeded()
+        with self.lock:
+            self.skipped += skipped
+            if not ok:
+                self.failed += 1
+                if len(self.errors) < self.max_listed_errors:
+                    self.errors.append((grab_result.GetErrorCode(), grab_result.GetErrorDescription()))
+        return ok
+
+    def totals(self, statistics=None):
+        """ Counts since the start, with the stream grabber statistics read just now (None: the last ones)."""
+        with self.lock:
+            if statistics:
+                self.statistics = dict(statistics)
+            return dict(self.statistics, failed_grabs=self.failed, skipped_images=self.skipped)
+
+    def segment_report(self, statistics):
+        """ What was lost since the last report, with the stream grabber statistics read just now (None: could not be read)."""
+        with self.lock:
+            if statistics is not None:
+                self.statistics = dict(statistics)
+            current = dict(self.statistics, failed_grabs=self.failed, skipped_images=self.skipped)
+            previous = dict(self.reported_statistics or dict(), **self.reported)
+            self.reported = {"failed_grabs": self.failed, "skipped_images": self.skipped}
+            self.reported_statistics = dict(self.statistics)
+            errors, self.errors = self.errors, [] # listed once, in the report of their segment
+        report = {name: current[name] - previous.get(name, 0) for name in current}
+        report["lost"] = report["failed_grabs"] + report["skipped_images"] + sum(report.get(name, 0) for name in LOSS_STATISTICS)
+        report["first_errors"] = errors
+        return report
+
+    def report_str(self, report):
+        result = "{} grab(s) failed, {} image(s) skipped by pylon".format(report["failed_grabs"], report["skipped_images"])
+        stats = [name for name in STREAM_STATISTICS.values() if report.get(name) and name != "buffers"]
+        if stats:
+            result += "; stream grabber: " + ", ".join("{} {}".format(report[name], name.replace("_", " ")) for name in stats)
+        if report["failed_grabs"] and report["first_errors"]:
+            result += "; first errors: " + ", ".join("{} ({:#x})".format(d, c) for c, d in report["first_errors"])
+        return result + " ({} grab strategy, {} buffers)".format(self.strategy, self.max_num_buffer or "default")
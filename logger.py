@@ -1,15 +1,34 @@
 """
     @author Niek Andresen
     @date May 2020
+
+    Writes two files per recording: the readable <date>_rec_log.txt and
+    <date>_events.jsonl, one JSON object per line for tools. Every record has
+    the local time in ISO format ("ts") and time.monotonic_ns() ("mono_ns"),
+    structured records (event()) also carry their fields.
+
+    log(), logWithTime() and event() only put the record into a queue, so they
+    never wait for the disk or the console, even when called from a grab thread
+    or during a rollover. A background thread prints and writes the records,
+    flushes after each batch and fsyncs the files every fsync_interval seconds
+    and when the logger is closed.
 """
 
 from pathlib import Path
+import json
+import os
+import queue
+import threading
 import time
 from datetime import datetime
 
 class Logger:
-    def __init__(self, folder="."):
+    def __init__(self, folder=".", fsync_interval=2.0):
         self.filep = None
+        self.events_filep = None
+        self.thread = None
+        self.fsync_interval = fsync_interval
+        self.queue = queue.SimpleQueue()
         self.set_folder(folder)
     def set_folder(self, folder):
         self.closeLogger()
@@ -17,26 +36,72 @@ class Logger:
         self.folder = Path(folder)
         self.folder.mkdir(parents=True, exist_ok=True)
         self.logfile = Path(self.folder) / (self.fpre+"_rec_log.txt")
+        self.eventfile = Path(self.folder) / (self.fpre+"_events.jsonl")
     def startLogging(self):
         self.filep = open(self.logfile, 'w')
+        self.events_filep = open(self.eventfile, 'w')
+        self.thread = threading.Thread(target=self.write_records, daemon=True)
+        self.thread.start()
         self.log(self.fpre, stdout=True)
     def log(self, logmsg, stdout=False):
-        if stdout: print(logmsg)
-        if not logmsg.endswith('\n'): logmsg += '\n'
-        self.filep.write(logmsg)
+        ts, t = self.current_time_str()
+        self.queue.put((logmsg, {"ts": ts, "mono_ns": time.monotonic_ns(), "event": "log", "msg": logmsg.strip()}, stdout))
     def logWithTime(self, logmsg, stdout=False):
         ts, t = self.current_time_str()
-        logmsg = "{} - ".format(ts) + logmsg
-        self.log(logmsg, stdout=stdout)
+        self.queue.put(("{} - ".format(ts) + logmsg, {"ts": ts, "mono_ns": time.monotonic_ns(), "event": "log", "msg": logmsg.strip()}, stdout))
+        return t
+    def event(self, name, msg=None, stdout=False, **fields):
+        """ Structured record: name identifies the kind of event, fields must be JSON serialisable.
+        msg is the line for the text log (the fields in JSON if None). Returns time.time()."""
+        ts, t = self.current_time_str()
+        record = {"ts": ts, "mono_ns": time.monotonic_ns(), "event": name}
+        record.update(fields)
+        text = "{} - {}".format(ts, msg if msg is not None else "{} {}".format(name, json.dumps(fields, default=str)))
+        self.queue.put((text, record, stdout))
         return t
-        
+
+    def write_records(self):
+        """ Background thread: writes what was queued until closeLogger() puts None."""
+        last_sync = time.monotonic()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                text, record, stdout = item
+                if stdout: print(text)
+                if not text.endswith('\n'): text += '\n'
+                self.filep.write(text)
+                self.events_filep.write(json.dumps(record, default=str) + '\n')
+            self.filep.flush()
+            self.events_filep.flush()
+            if not running or time.monotonic() - last_sync >= self.fsync_interval:
+                for f in (self.filep, self.events_filep):
+                    os.fsync(f.fileno())
+                last_sync = time.monotonic()
+
     def closeLogger(self):
+        """ Writes everything queued so far and closes the files."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
         if self.filep: self.filep.close()
+        if self.events_filep: self.events_filep.close()
+        self.filep = None
+        self.events_filep = None
     def current_time_str(self):
         t = time.time()
         #l = time.localtime()
         #return "{}.{:03d}".format(time.strftime("%H:%M:%S", l), int(round(t%1*1e3))), t
-        return datetime.now().isoformat(), t
+        return datetime.fromtimestamp(t).isoformat(), t
     def durationToTimeStr(self, start, end=None):
         """ Takes difference between two times, or both a start and end time, in seconds
         and gives a human readable string showing the duration. """
@@ -58,10 +123,17 @@ class Logger:
     def __del__(self):
         self.closeLogger()
 
+def read_events(filename, name=None):
+    """ The records of an _events.jsonl file, only those of one kind if name is given."""
+    with open(filename) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [r for r in records if name is None or r["event"] == name]
+
 if __name__=="__main__":
     folder = "/home/niek/Desktop"
     l = Logger(folder)
     l.startLogging()
     l.log("This is a test line without the time in front.")
     l.logWithTime("This is a test line with the time in front.")
+    l.event("cam_found", "A structured record.", serial="22334455", model="acA1920-40um")
     l.closeLogger()
@@ -0,0 +1,253 @@
+"""
+    Live per-camera metrics of a running recording, so an overnight run can be
+    watched from another terminal:
+
+        curl -s localhost:9108/metrics        (Prometheus text format)
+        cat <vid_dir>/<date>_status.json      (rewritten every second)
+
+    Per camera: frames grabbed, written and dropped, frames lost before that
+    (failed grabs, skipped by pylon, stream grabber statistics), queue depth, encoder pipe
+    throughput, ffmpeg messages, and histograms of the grab time (RetrieveResult
+    returned -> frame in the ring and the buffer back to pylon) and of the write
+    latency (grab -> frame handed to ffmpeg).
+
+    The grab and encode threads only update counters and histograms. Everything
+    else is collected by the exporter thread once per interval. The HTTP server
+    only listens on localhost.
+"""
+
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, roughly logarithmic from 0.1 ms to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """ Prometheus-style histogram with fixed buckets. Observed from one thread, read from others."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_many(self, values):
+        with self.lock:
+            for value in values:
+                self.counts[bisect.bisect_left(self.buckets, value)] += 1
+                self.sum += float(value)
+            self.count += len(values)
+
+    def state(self):
+        """ Picklable copy, e.g. to send it from an encoder process."""
+        with self.lock:
+            return {"buckets": self.buckets, "counts": list(self.counts), "sum": self.sum, "count": self.count}
+
+    def set_state(self, state):
+        with self.lock:
+            self.buckets = tuple(state["buckets"])
+            self.counts = list(state["counts"])
+            self.sum = state["sum"]
+            self.count = state["count"]
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q-quantile (None without observations)."""
+        s = self.state()
+        if s["count"] == 0:
+            return None
+        rank = q * s["count"]
+        total = 0
+        for bound, n in zip(s["buckets"] + (float('inf'),), s["counts"]):
+            total += n
+            if total >= rank:
+                return bound
+        return float('inf')
+
+class CameraMetrics:
+    def __init__(self, serial):
+        self.serial = serial
+        self.grab_seconds = Histogram()
+        self.write_latency = Histogram()
+        self.frames_grabbed = 0
+        self.ring = dict() # ring.stats()
+        self.encoder = dict() # FrameEncoder.metrics()
+        self.grab = dict() # GrabStats.totals(), frames lost before the ring
+        self.rates = dict() # per second over the last interval
+        self.prev = None # (time, frames grabbed, frames written, bytes written)
+
+    def written(self, serial, meta, t):
+        """ on_written callback of the FrameEncoder (encode thread)."""
+        self.write_latency.observe_many(t - meta['host_time'])
+
+    def update_rates(self, t):
+        cur = (t, self.frames_grabbed, self.encoder.get("frames_written", 0), self.encoder.get("bytes_written", 0))
+        if self.prev is not None and cur[0] > self.prev[0]:
+            dt = cur[0] - self.prev[0]
+            self.rates = {"grab_fps": (cur[1] - self.prev[1]) / dt, "write_fps": (cur[2] - self.prev[2]) / dt,
+                          "pipe_bytes_per_second": (cur[3] - self.prev[3]) / dt}
+        self.prev = cur
+
+    def status(self):
+        return {"frames_grabbed": self.frames_grabbed, "frames_written": self.encoder.get("frames_written", 0),
+                "frames_skipped": self.encoder.get("frames_skipped", 0),
+                "frames_dropped": self.ring.get("dropped", 0), "grabs_failed": self.grab.get("failed_grabs", 0),
+                "images_skipped": self.grab.get("skipped_images", 0),
+                "stream_statistics": {k: v for k, v in self.grab.items() if k not in ("failed_grabs", "skipped_images")},
+                "queue_depth": self.ring.get("depth", 0),
+                "queue_capacity": self.ring.get("capacity", 0), "queue_high_water": self.ring.get("high_water", 0),
+                "segment": self.encoder.get("segment", 0), "bytes_written": self.encoder.get("bytes_written", 0),
+                "write_seconds": self.encoder.get("write_seconds", 0.0),
+                "ffmpeg_messages": self.encoder.get("ffmpeg_messages", 0),
+                "ffmpeg_last_message": self.encoder.get("ffmpeg_last_message", ""),
+                "grab_seconds_p99": self.grab_seconds.quantile(0.99),
+                "write_latency_p50": self.write_latency.quantile(0.5),
+                "write_latency_p99": self.write_latency.quantile(0.99),
+                "rates": dict(self.rates)}
+
+class MetricsRegistry:
+    def __init__(self, serials, session=""):
+        self.session = session
+        self.cameras = {s: CameraMetrics(s) for s in serials}
+        self.t_start = time.time()
+        self.extra = dict() # recorder wide values for the status, e.g. the segment number
+
+    def __getitem__(self, serial):
+        return self.cameras[serial]
+
+    def status(self):
+        return {"time": time.time(), "session": self.session, "running_seconds": time.time() - self.t_start,
+                **self.extra, "cameras": {s: c.status() for s, c in self.cameras.items()}}
+
+    def prometheus_text(self):
+        lines = []
+        def metric(name, kind, help_text, values):
+            lines.append("# HELP basler_{} {}".format(name, help_text))
+            lines.append("# TYPE basler_{} {}".format(name, kind))
+            for serial, value in values:
+                lines.append('basler_{}{{serial="{}"}} {}'.format(name, serial, value))
+        cams = list(self.cameras.values())
+        metric("frames_grabbed_total", "counter", "Frames retrieved from the camera.", [(c.serial, c.frames_grabbed) for c in cams])
+        metric("frames_written_total", "counter", "Frames handed to ffmpeg.", [(c.serial, c.encoder.get("frames_written", 0)) for c in cams])
+        metric("frames_skipped_total", "counter", "Frames left out by the activity gate.", [(c.serial, c.encoder.get("frames_skipped", 0)) for c in cams])
+        metric("frames_dropped_total", "counter", "Frames dropped because the queue to the encoder was full.", [(c.serial, c.ring.get("dropped", 0)) for c in cams])
+        metric("grabs_failed_total", "counter", "Grab results without a frame (GrabSucceeded false).", [(c.serial, c.grab.get("failed_grabs", 0)) for c in cams])
+        metric("images_skipped_total", "counter", "Frames pylon discarded because of the grab strategy.", [(c.serial, c.grab.get("skipped_images", 0)) for c in cams])
+        metric("stream_buffers_failed_total", "counter", "Failed buffers counted by the stream grabber (the same frames as grabs_failed_total, as the driver saw them).", [(c.serial, c.grab.get("failed_buffers", 0)) for c in cams])
+        metric("queue_depth", "gauge", "Frames waiting to be encoded.", [(c.serial, c.ring.get("depth", 0)) for c in cams])
+        metric("queue_capacity", "gauge", "Slots of the queue to the encoder.", [(c.serial, c.ring.get("capacity", 0)) for c in cams])
+        metric("encoder_bytes_total", "counter", "Bytes written into the ffmpeg pipe.", [(c.serial, c.encoder.get("bytes_written", 0)) for c in cams])
+        metric("encoder_write_seconds_total", "counter", "Time spent writing into the ffmpeg pipe.", [(c.serial, c.encoder.get("write_seconds", 0.0)) for c in cams])
+        metric("encoder_pipe_bytes_per_second", "gauge", "Bytes per second into the ffmpeg pipe over the last interval.", [(c.serial, c.rates.get("pipe_bytes_per_second", 0.0)) for c in cams])
+        metric("ffmpeg_messages_total", "counter", "Lines ffmpeg wrote to stderr.", [(c.serial, c.encoder.get("ffmpeg_messages", 0)) for c in cams])
+        metric("segment", "gauge", "Number of the segment being written.", [(c.serial, c.encoder.get("segment", 0)) for c in cams])
+        for name, attr, help_text in (("grab_seconds", "grab_seconds", "Time from RetrieveResult returning until the frame is queued and the buffer released."),
+                                      ("write_latency_seconds", "write_latency", "Time from the grab until the frame is handed to ffmpeg.")):
+            lines.append("# HELP basler_{} {}".format(name, help_text))
+            lines.append("# TYPE basler_{} histogram".format(name))
+            for c in cams:
+                s = getattr(c, attr).state()
+                total = 0
+                for bound, n in zip(s["buckets"] + (float('inf'),), s["counts"]):
+                    total += n
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append('basler_{}_bucket{{serial="{}",le="{}"}} {}'.format(name, c.serial, le, total))
+                lines.append('basler_{}_sum{{serial="{}"}} {}'.format(name, c.serial, s["sum"]))
+                lines.append('basler_{}_count{{serial="{}"}} {}'.format(name, c.serial, s["count"]))
+        return "\n".join(lines) + "\n"
+
+def write_json_atomic(filename, data):
+    """ Writes to a temporary file and renames it, so a reader never sees a half written file."""
+    tmp = filename + ".tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, filename)
+
+class MetricsExporter:
+    """ Thread that refreshes the registry (through collect) once per interval, rewrites the
+    status file and serves /metrics and /status.json on localhost."""
+
+    def __init__(self, registry, collect=None, json_path=None, port=None, interval=1.0, on_error=None):
+        """
+            @param collect: called every interval to copy the current values into the registry
+            @param json_path: status file, rewritten every interval (None: no file)
+            @param port: HTTP port on 127.0.0.1 (None: no server)
+            @param on_error: called with the exception if a refresh fails (None: printed to stderr), once until it changes
+        """
+        self.registry = registry
+        self.collect = collect
+        self.on_error = on_error
+        self.last_error = None
+        self.json_path = json_path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.server = None
+        if port is not None:
+            registry_ = registry
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.startswith("/metrics"):
+                        body, ctype = registry_.prometheus_text().encode(), "text/plain; version=0.0.4"
+                    elif self.path.startswith("/status"):
+                        body, ctype = json.dumps(registry_.status(), indent=1).encode(), "application/json"
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header("Content-Type", ctype)
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, *args):
+                    pass
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.refresh()
+
+    def refresh(self):
+        """ Collects the values and rewrites the status file. An error is reported, it does not stop the
+        exporter (or the recorder's shutdown, which calls this through stop())."""
+        try:
+            if self.collect:
+                self.collect()
+            t = time.perf_counter()
+            for c in self.registry.cameras.values():
+                c.update_rates(t)
+            if self.json_path:
+                write_json_atomic(self.json_path, self.registry.status())
+        except Exception as e:
+            if repr(e) != self.last_error: # not every second
+                self.last_error = repr(e)
+                if self.on_error is not None:
+                    self.on_error(e)
+                else:
+                    print("Metrics: refresh failed: {!r}".format(e), file=sys.stderr)
+        else:
+            self.last_error = None
+
+    def stop(self):
+        """ Writes the final status and stops the server."""
+        self.stop_event.set()
+        self.thread.join()
+        self.refresh()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
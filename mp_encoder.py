@@ -0,0 +1,276 @@
+"""
+    Multi-process encoding backend.
+
+    With one interpreter, grabbing, preview and the Python side of every
+    writer share one GIL. In this mode each camera (or group of cameras) is
+    encoded in its own worker process. The grab thread in the main process
+    copies frames into a SharedFrameRing, a ring of slots in
+    multiprocessing.shared_memory, so frames are neither pickled nor copied
+    again. The worker takes them from there and writes them to ffmpeg.
+
+    The main process only coordinates over a pipe per worker: it sends
+    'prepare' (start the writer of a camera's next segment, or replace it), 'switch' (roll
+    over to it at a grab index) and 'stop', and gets back 'ready', 'closed'
+    (segment info with the dropped-frame report), 'cpu' and 'error' messages,
+    and once per second 'metrics' for the live metrics (see metrics.py).
+"""
+
+import os
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+from frame_ring import FRAME_META_DTYPE
+
+class SharedFrameRing:
+    """ FrameRing (see frame_ring.py) whose slots live in shared memory. The
+    producer (grab thread) and the consumer (encoder) are in different processes.
+
+    Two semaphores count the free and the filled slots. A small counter array
+    in the shared block holds the number of committed and released frames and
+    the closed flag.
+
+    Create it in the main process, pass spec() to the worker and call
+    SharedFrameRing.attach(spec) there.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, depth=64, meta_dtype=FRAME_META_DTYPE, _spec=None):
+        if _spec is None:
+            frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            size = depth * frame_bytes + depth * np.dtype(meta_dtype).itemsize + 3 * 8
+            _spec = {"name": None, "shape": tuple(shape), "dtype": np.dtype(dtype).str, "depth": depth,
+                     "meta_dtype": np.dtype(meta_dtype).descr, "size": size,
+                     "free": mp.Semaphore(depth), "filled": mp.Semaphore(0)}
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            _spec["name"] = self.shm.name
+            self.owner = True
+        else:
+            # the worker shares the resource tracker of the main process, which unlinks the block
+            self.shm = shared_memory.SharedMemory(name=_spec["name"])
+            self.owner = False
+        self._spec = _spec
+        self.shape = tuple(_spec["shape"])
+        self.capacity = depth = _spec["depth"]
+        dtype = np.dtype(_spec["dtype"])
+        meta_dtype = np.dtype([tuple(f) for f in _spec["meta_dtype"]])
+        frame_bytes = int(np.prod(self.shape)) * dtype.itemsize
+        self.slots = np.ndarray((depth,) + self.shape, dtype=dtype, buffer=self.shm.buf)
+        self.meta = np.ndarray(depth, dtype=meta_dtype, buffer=self.shm.buf, offset=depth * frame_bytes)
+        # committed frames, released frames, closed flag
+        self.counters = np.ndarray(3, dtype=np.int64, buffer=self.shm.buf, offset=depth * frame_bytes + depth * meta_dtype.itemsize)
+        self._free = _spec["free"]
+        self._filled = _spec["filled"]
+        self._head = 0 # only used by the producer
+        self._tail = 0 # only used by the consumer
+        self._taken = 0 # filled slots the consumer has acquired but not released
+        self.frames_in = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def spec(self):
+        """ Everything a worker process needs to attach to this ring (picklable)."""
+        return self._spec
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(None, _spec=spec)
+
+    # producer side
+
+    def reserve(self):
+        if not self._free.acquire(block=False):
+            self.dropped += 1
+            return None
+        return self.slots[self._head % self.capacity]
+
+    def commit(self, meta=None):
+        if meta is not None:
+            self.meta[self._head % self.capacity] = meta
+        self._head += 1
+        self.counters[0] = self._head
+        self.frames_in += 1
+        depth = self._head - int(self.counters[1])
+        if depth > self.high_water:
+            self.high_water = depth
+        self._filled.release()
+
+    def put(self, frame, meta=None):
+        slot = self.reserve()
+        if slot is None:
+            return False
+        np.copyto(slot, frame, casting='no')
+        self.commit(meta)
+        return True
+
+    def close(self):
+        self.counters[2] = 1
+        self._filled.release() # wake the consumer
+
+    @property
+    def closed(self):
+        return bool(self.counters[2])
+
+    def depth(self):
+        return int(self.counters[0] - self.counters[1])
+
+    def stats(self):
+        return {"depth": self.depth(), "capacity": self.capacity, "high_water": self.high_water,
+                "frames_in": self.frames_in, "dropped": self.dropped}
+
+    def stats_str(self):
+        return "queue depth {depth}/{capacity}, high-water {high_water}, {frames_in} frames queued, {dropped} dropped (ring full)".format(**self.stats())
+
+    # consumer side
+
+    def get_many(self, max_frames, timeout=None):
+        if self._taken == 0:
+            if not self._filled.acquire(timeout=timeout):
+                return []
+            self._taken = 1
+        while self._taken < max_frames and self._filled.acquire(block=False):
+            self._taken += 1
+        # a wake-up from close() is not a frame
+        self._taken = min(self._taken, int(self.counters[0]) - self._tail)
+        return [self.slots[(self._tail + i) % self.capacity] for i in range(min(self._taken, max_frames))]
+
+    def peek_meta(self, n):
+        return self.meta[(self._tail + np.arange(n)) % self.capacity]
+
+    def release(self, n=1):
+        self._tail += n
+        self._taken -= n
+        self.counters[1] = self._tail
+        for _ in range(n):
+            self._free.release()
+
+    def detach(self):
+        """ Closes this process's view. The creating process also frees the block."""
+        self.slots = self.meta = self.counters = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def encoder_worker(specs, conn):
+    """ Entry point of an encoder process. specs is a list of dicts with the keys
+    serial, ring, writer (keyword arguments for create_writer, see encoder_profiles.py),
+    sidecar (file name), segment, write_batch and activity_gate (ActivityGate parameters or None)."""
+    from encoder_profiles import create_writer
+    from frame_sidecar import FrameSidecar
+    from frame_encoder import FrameEncoder
+    from activity_gate import ActivityGate
+    from metrics import Histogram
+    send_lock = threading.Lock()
+    def send(msg):
+        with send_lock:
+            conn.send(msg)
+    def on_error(serial, err):
+        send(('error', serial, str(err)))
+    def on_segment_closed(serial, info):
+        send(('closed', serial, info))
+    encoders = dict()
+    write_latency = dict() # serial -> Histogram
+    def on_written(serial, meta, t):
+        write_latency[serial].observe_many(t - meta['host_time'])
+    def send_metrics():
+        for serial, encoder in encoders.items():
+            send(('metrics', serial, {"encoder": encoder.metrics(), "write_latency": write_latency[serial].state()}))
+    threads = []
+    try:
+        for spec in specs:
+            ring = SharedFrameRing.attach(spec["ring"])
+            writer = create_writer(**spec["writer"])
+            write_latency[spec["serial"]] = Histogram()
+            encoder = FrameEncoder(spec["serial"], ring, writer, FrameSidecar(spec["sidecar"]), spec["write_batch"],
+                                   on_error, on_segment_closed, spec["segment"], on_written,
+                                   ActivityGate(**spec["activity_gate"]) if spec.get("activity_gate") is not None else None)
+            encoders[spec["serial"]] = encoder
+            threads.append(threading.Thread(target=encoder.run, daemon=True))
+            threads[-1].start()
+        send(('ready', list(encoders)))
+        while True:
+            if not conn.poll(1.0):
+                send_metrics()
+                continue
+            cmd = conn.recv()
+            if cmd[0] == 'prepare':
+                _, serial, writer_args, sidecar_fname, replace = cmd
+                if replace:
+                    encoders[serial].discard_prepared()
+                encoders[serial].prepare(create_writer(**writer_args), FrameSidecar(sidecar_fname))
+            elif cmd[0] == 'switch':
+                _, serial, grab_index = cmd
+                encoders[serial].switch_at(grab_index)
+            elif cmd[0] == 'stop':
+                break
+        for t in threads:
+            t.join()
+        send_metrics()
+        for serial, encoder in encoders.items():
+            encoder.close()
+            send(('cpu', serial, encoder.cpu.report_str()))
+            if encoder.gate is not None:
+                send(('log', serial, encoder.gate.report_str()))
+    except Exception:
+        send(('error', None, traceback.format_exc()))
+    finally:
+        for encoder in encoders.values():
+            encoder.ring.detach()
+        send(('exit', os.getpid()))
+        conn.close()
+
+class EncoderProcess:
+    """ Main process side of one encoder worker."""
+
+    def __init__(self, specs):
+        self.serials = [s["serial"] for s in specs]
+        self.conn, child_conn = mp.Pipe()
+        self.proc = mp.Process(target=encoder_worker, args=(specs, child_conn), daemon=True,
+                               name="encoder " + ",".join(self.serials))
+        self.proc.start()
+        child_conn.close()
+        self.messages = []
+
+    def send(self, cmd):
+        self.conn.send(cmd)
+
+    def poll(self):
+        """ Returns the messages the worker sent since the last call."""
+        try:
+            while self.conn.poll():
+                self.messages.append(self.conn.recv())
+        except (EOFError, OSError):
+            pass
+        msgs, self.messages = self.messages, []
+        return msgs
+
+    def stop(self, timeout=60):
+        """ Call after the rings were closed. Waits until the worker has written
+        everything, returns all messages it sent."""
+        msgs = self.poll()
+        try:
+            self.conn.send(('stop',))
+        except (BrokenPipeError, OSError):
+            pass
+        while True:
+            try:
+                if not self.conn.poll(timeout):
+                    break
+                msg = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            msgs.append(msg)
+            if msg[0] == 'exit':
+                break
+        self.proc.join(timeout)
+        if self.proc.is_alive():
+            self.proc.terminate()
+            msgs.append(('error', None, "encoder process {} did not finish in time and was terminated".format(self.proc.name)))
+        self.conn.close()
+        return msgs
+
+def group_serials(serials, cameras_per_process):
+    """ Splits the cameras into groups that share one encoder process."""
+    n = max(1, cameras_per_process)
+    return [serials[i:i+n] for i in range(0, len(serials), n)]
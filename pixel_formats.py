@@ -0,0 +1,99 @@
+"""
+    Camera pixel formats the recorder supports.
+
+    Mono8
+      One byte per pixel, written to the video as it is ('gray').
+    Mono12p
+      12 bit pixels, packed: two pixels in three bytes, so the camera sends 1.5
+      bytes per pixel over USB instead of 2 for Mono16. The grab thread unpacks
+      each frame straight into its (16 bit) ring slot, which replaces the copy
+      it does for Mono8 anyway. The video gets 12 bit values in 16 bit words
+      ('gray12le').
+
+    The layout of Mono12p (little endian, lowest bits first), for the pixels
+    p0 and p1 in the bytes b0 b1 b2:
+        p0 = b0 | (b1 & 0x0F) << 8
+        p1 = b1 >> 4 | b2 << 4
+    i.e. p0 is the low 12 bits of the 16 bit word in b0 b1, and p1 the high 12
+    bits of the 16 bit word in b1 b2. unpack_mono12p reads both words through
+    two overlapping strided views of the buffer, so it needs one mask and one
+    shift over the frame and no temporary arrays.
+
+    Run this file to measure the unpacking on your machine:
+    python pixel_formats.py [n_frames] [width] [height] [fps]
+"""
+
+import numpy as np
+
+PIXEL_FORMATS = {
+    'Mono8': {"dtype": np.uint8, "pixfmt": 'gray', "bytes_per_pixel": 1.0, "packed": False},
+    'Mono12p': {"dtype": np.uint16, "pixfmt": 'gray12le', "bytes_per_pixel": 1.5, "packed": True},
+}
+
+def check_pixel_format(name):
+    if name not in PIXEL_FORMATS:
+        raise ValueError("Unsupported pixel format '{}', available: {}".format(name, ", ".join(PIXEL_FORMATS)))
+    return PIXEL_FORMATS[name]
+
+def unpack_mono12p(packed, out):
+    """ Unpacks a Mono12p buffer into out (uint16, any shape with as many pixels, e.g. a ring slot).
+
+        @param packed: the raw buffer as uint8 (1.5 bytes per pixel), e.g. GetArrayZeroCopy(raw=True)
+        @param out: preallocated C-contiguous uint16 array, gets values from 0 to 4095
+    """
+    n = out.size
+    if out.dtype != np.uint16 or not out.flags.c_contiguous:
+        raise ValueError("Mono12p frames are unpacked into C-contiguous uint16 arrays.")
+    if n % 2 or packed.size != n * 3 // 2:
+        raise ValueError("Mono12p buffer of {} bytes does not match a frame of {} pixels.".format(packed.size, n))
+    packed = np.ascontiguousarray(packed).reshape(-1)
+    pairs = out.reshape(-1, 2) # a view, because out is contiguous
+    word = np.dtype('<u2')
+    # 16 bit words at byte 0 and byte 1 of every 3 byte group
+    low = np.ndarray((n // 2,), word, packed, 0, (3,))
+    high = np.ndarray((n // 2,), word, packed, 1, (3,))
+    np.bitwise_and(low, 0x0FFF, out=pairs[:, 0])
+    np.right_shift(high, 4, out=pairs[:, 1])
+    return out
+
+def pack_mono12p(pixels):
+    """ The Mono12p buffer of an array of 12 bit values (for tests and benchmarks)."""
+    p = np.asarray(pixels, dtype=np.uint16).reshape(-1)
+    if p.size % 2:
+        raise ValueError("Mono12p needs an even number of pixels.")
+    p0, p1 = p[0::2], p[1::2]
+    packed = np.empty((p0.size, 3), dtype=np.uint8)
+    packed[:, 0] = p0 & 0xFF
+    packed[:, 1] = (p0 >> 8) | ((p1 & 0x0F) << 4)
+    packed[:, 2] = p1 >> 4
+    return packed.reshape(-1)
+
+def bench_unpack(n=200, size=(1936, 1216), fps=30):
+    """ Prints the time to unpack one Mono12p frame and the share of a camera's frame interval it takes."""
+    import time
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 4096, size[0] * size[1], dtype=np.uint16).reshape(size[1], size[0])
+    packed = pack_mono12p(pixels)
+    out = np.empty_like(pixels)
+    unpack_mono12p(packed, out)
+    if not np.array_equal(out, pixels):
+        raise AssertionError("unpack_mono12p does not invert pack_mono12p")
+    t0 = time.perf_counter()
+    for _ in range(n):
+        unpack_mono12p(packed, out)
+    t = (time.perf_counter() - t0) / n
+    copy_out = np.empty((size[1], size[0]), dtype=np.uint8)
+    frame8 = pixels.astype(np.uint8)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        np.copyto(copy_out, frame8)
+    t_copy = (time.perf_counter() - t0) / n
+    print("{}x{} Mono12p: unpack {:.2f} ms/frame ({:.0f} MB/s packed, {:.1%} of a frame at {} fps); Mono8 copy {:.2f} ms/frame".format(
+        size[0], size[1], t * 1e3, packed.nbytes / t / 1e6, t * fps, fps, t_copy * 1e3))
+
+if __name__ == '__main__':
+    import sys
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else (1936, 1216)
+    fps = float(sys.argv[4]) if len(sys.argv) > 4 else 30
+    bench_unpack(n, size, fps)
@@ -0,0 +1,158 @@
+"""
+    Live preview of all cameras in one tiled mosaic window.
+
+    The grab threads only offer their frames. At the configured preview rate, a
+    frame is downsampled by strided slicing into a small preallocated tile, and
+    all other frames cost one time comparison. The manager thread composes the
+    tiles into the mosaic at the same fixed rate and draws the camera fps and
+    drop count on each tile.
+
+    The time spent on the preview is measured. If it exceeds max_load (share of
+    one core), the preview rate is halved until it fits again. With
+    enabled=False nothing is shown and OpenCV is not even imported, for
+    headless runs.
+"""
+
+import math
+import threading
+import time
+import numpy as np
+
+class MosaicPreview:
+    def __init__(self, serials, frame_size, enabled=True, fps=4, tile_width=480, max_load=0.05, window_name='Basler preview'):
+        """
+            @param serials: cameras in the order of the tiles
+            @param frame_size: (width, height) of the camera frames
+            @param fps: preview refresh rate
+            @param tile_width: max. width of one tile in pixels, frames are downsampled by an integer step to fit
+            @param max_load: max. share of one core the preview may use before its rate is lowered
+        """
+        self.serials = list(serials)
+        self.enabled = enabled
+        self.fps = fps
+        self.interval = 1.0 / fps
+        self.max_load = max_load
+        self.window_name = window_name
+        self.step = max(1, math.ceil(frame_size[0] / tile_width))
+        self.tile_shape = (math.ceil(frame_size[1] / self.step), math.ceil(frame_size[0] / self.step))
+        self.cols = max(1, math.ceil(math.sqrt(len(self.serials))))
+        self.rows = max(1, math.ceil(len(self.serials) / self.cols))
+        self.lock = threading.Lock()
+        self.cost = 0.0 # seconds spent on the preview since the last load check
+        self.total_cost = 0.0
+        self.t_check = time.perf_counter()
+        self.t_start = self.t_check
+        self.next_show = 0.0
+        self.frames_seen = {s: 0 for s in self.serials}
+        self.cam_fps = {s: 0.0 for s in self.serials}
+        self.t_fps = self.t_check
+        self.frames_at_fps = {s: 0 for s in self.serials}
+        if not enabled:
+            return
+        import cv2
+        self.cv2 = cv2
+        # two tiles per camera: the grab thread fills one while the other may be composed
+        self.tiles = {s: np.zeros((2,) + self.tile_shape, dtype=np.uint8) for s in self.serials}
+        self.front = {s: 0 for s in self.serials}
+        self.next_offer = {s: 0.0 for s in self.serials}
+        self.mosaic = np.zeros((self.rows * self.tile_shape[0], self.cols * self.tile_shape[1]), dtype=np.uint8)
+        cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
+        cv2.resizeWindow(window_name, self.mosaic.shape[1], self.mosaic.shape[0])
+
+    def offer(self, serial, frame):
+        """ Called by the grab thread with every frame. Only copies it when a new
+        tile is due, and then only every step-th pixel."""
+        self.frames_seen[serial] += 1
+        if not self.enabled:
+            return
+        t = time.perf_counter()
+        if t < self.next_offer[serial]:
+            return
+        self.next_offer[serial] = t + self.interval
+        back = 1 - self.front[serial]
+        small = frame[::self.step, ::self.step]
+        if frame.dtype == np.uint8:
+            np.copyto(self.tiles[serial][back], small)
+        else: # 12 bit pixels in 16 bit
+            np.right_shift(small, 4, out=self.tiles[serial][back], casting='unsafe')
+        self.front[serial] = back
+        with self.lock:
+            self.cost += time.perf_counter() - t
+
+    def show(self, drop_counts=None):
+        """ Called by the manager thread. Updates the window if the next refresh is due.
+            @param drop_counts: dict serial -> number of frames dropped so far, drawn on the tiles
+        """
+        t = time.perf_counter()
+        if t < self.next_show:
+            return
+        self.next_show = t + self.interval
+        if t - self.t_fps >= 1.0:
+            for s in self.serials:
+                n = self.frames_seen[s]
+                self.cam_fps[s] = (n - self.frames_at_fps[s]) / (t - self.t_fps)
+                self.frames_at_fps[s] = n
+            self.t_fps = t
+        if self.enabled:
+            cv2 = self.cv2
+            th, tw = self.tile_shape
+            for i, s in enumerate(self.serials):
+                r, c = divmod(i, self.cols)
+                tile = self.mosaic[r*th:(r+1)*th, c*tw:(c+1)*tw]
+                np.copyto(tile, self.tiles[s][self.front[s]])
+                text = "{} {:.1f} fps".format(s, self.cam_fps[s])
+                if drop_counts is not None:
+                    text += " {} dropped".format(drop_counts.get(s, 0))
+                cv2.putText(tile, text, (8, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 255, 2)
+            cv2.imshow(self.window_name, self.mosaic)
+        with self.lock:
+            self.cost += time.perf_counter() - t
+        self.check_load()
+
+    def check_load(self):
+        """ Halves the preview rate if it uses more than max_load of a core, and goes back
+        up once there is room again."""
+        t = time.perf_counter()
+        if t - self.t_check < 5.0:
+            return
+        with self.lock:
+            load = self.cost / (t - self.t_check)
+            self.total_cost += self.cost
+            self.cost = 0.0
+        self.t_check = t
+        if load > self.max_load:
+            self.interval *= 2
+        elif load < self.max_load / 4 and self.interval > 1.0 / self.fps:
+            self.interval = max(1.0 / self.fps, self.interval / 2)
+
+    def slow_down(self, min_fps=0.5):
+        """ Halves the preview rate (e.g. when an encoder falls behind), but not below min_fps.
+        Returns False if it was already that slow."""
+        if self.interval * 2 > 1.0 / min_fps:
+            return False
+        self.interval *= 2
+        return True
+
+    def wait(self, ms, stop=None):
+        """ Lets the window process its events for ms milliseconds (just sleeps when disabled, until
+        the threading.Event stop is set if given)."""
+        if self.enabled:
+            self.cv2.waitKey(max(1, int(ms)))
+        elif stop is not None:
+            stop.wait(ms / 1000)
+        else:
+            time.sleep(ms / 1000)
+
+    def stats_str(self):
+        with self.lock:
+            cost = self.total_cost + self.cost
+        elapsed = time.perf_counter() - self.t_start
+        if not self.enabled:
+            return "Preview disabled."
+        return "Preview used {:.2f} s in {:.0f} s ({:.2f}% of a core), now at {:.1f} fps.".format(
+            cost, elapsed, 100 * cost / max(elapsed, 1e-9), 1.0 / self.interval)
+
+    def close(self):
+        if self.enabled:
+            self.cv2.destroyWindow(self.window_name)
+            self.cv2.waitKey(1)
@@ -0,0 +1,237 @@
+"""
+    Uncompressed recording without ffmpeg, for sessions that need more frames
+    per second than an encoder can take (e.g. on a fast NVMe disk). The videos
+    can be compressed later.
+
+    RawFrameWriter has the interface of FFMPEG_VideoWriter (write_frame,
+    write_frames, close, filename, bytes_written, ...). For a filename like
+    2023-10-05_12-00-00_22334455_rec_0000.raw it writes
+
+      <filename>             JSON header: frame size, dtype, fps, chunk layout, number of frames
+      <filename>.0000, ...   chunk files, preallocated and filled through mmap, whole frames only
+      <filename>.idx         one RAW_INDEX_DTYPE record (40 bytes) per frame: chunk, offset in
+                             the chunk, camera timestamp, BlockID and host time
+
+    A frame is copied once, from the ring slot into the mapped chunk. A chunk
+    that is full is unmapped and the next one is allocated, the last one is cut
+    to the frames it holds. Read the result with RawVideo.
+
+    Select it with the encoder profile 'raw_mmap' (see encoder_profiles.py).
+"""
+
+import json
+import mmap
+import os
+import time
+from collections import deque
+import numpy as np
+
+RAW_INDEX_DTYPE = np.dtype([
+    ('chunk', '<u4'), # number of the chunk file
+    ('reserved', '<u4'),
+    ('offset', '<u8'), # byte offset of the frame in the chunk file
+    ('timestamp', '<u8'), # camera timestamp tick
+    ('block_id', '<u8'), # camera BlockID
+    ('host_time', '<f8'), # time.time() when RetrieveResult returned
+])
+
+# bytes per pixel for the pixel formats the recorder hands to its writers
+RAW_PIXFMT_DTYPES = {'gray': np.uint8, 'gray12le': np.dtype('<u2'), 'gray16le': np.dtype('<u2')}
+
+def raw_size(filename):
+    """ Bytes of frames written so far (from the index, the chunk files are preallocated)."""
+    try:
+        with open(filename) as f:
+            header = json.load(f)
+        return os.path.getsize(filename + ".idx") // RAW_INDEX_DTYPE.itemsize * header["frame_bytes"]
+    except (OSError, ValueError, KeyError):
+        return 0
+
+def raw_files(filename):
+    """ All files belonging to a raw video (header, index and chunks)."""
+    chunks = []
+    i = 0
+    while os.path.exists("{}.{:04d}".format(filename, i)):
+        chunks.append("{}.{:04d}".format(filename, i))
+        i += 1
+    return [filename, filename + ".idx"] + chunks
+
+class RawFrameWriter:
+    """ Writes frames into preallocated, memory-mapped chunk files plus a per-frame index.
+
+    Parameters
+    -----------
+
+    filename
+      Name of the header file, the chunks and the index are named after it.
+
+    size
+      Size (width,height) of the frames in pixels.
+
+    fps
+      Frame rate, only stored in the header.
+
+    pixfmt
+      'gray' (8 bit) or 'gray12le'/'gray16le' (16 bit words), as for FFMPEG_VideoWriter.
+
+    chunk_bytes
+      Approximate size of a chunk file (rounded down to whole frames).
+
+    ffmpeg_args
+      The other arguments of FFMPEG_VideoWriter (codec, preset, ...) are accepted and ignored.
+
+    """
+
+    def __init__(self, filename, size, fps, pixfmt='gray', chunk_bytes=256 * 2**20, **ffmpeg_args):
+        if pixfmt not in RAW_PIXFMT_DTYPES:
+            raise ValueError("Raw recording does not support pixel format '{}', available: {}".format(pixfmt, ", ".join(RAW_PIXFMT_DTYPES)))
+        self.filename = filename
+        self.codec = 'raw'
+        self.dtype = np.dtype(RAW_PIXFMT_DTYPES[pixfmt])
+        self.frame_bytes = size[0] * size[1] * self.dtype.itemsize
+        self.frames_per_chunk = max(1, chunk_bytes // self.frame_bytes)
+        self.header = {"width": size[0], "height": size[1], "dtype": self.dtype.str, "pixfmt": pixfmt, "fps": fps,
+                       "frame_bytes": self.frame_bytes, "frames_per_chunk": self.frames_per_chunk, "frames": 0, "chunks": 0}
+        self.write_header()
+        self.index = open(filename + ".idx", 'wb')
+        self.chunk = -1 # number of the open chunk
+        self.chunk_file = None
+        self.chunk_map = None
+        self.chunk_buf = None # uint8 view of chunk_map
+        self.pos = 0 # frames in the open chunk
+        self.frames = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0 # time spent copying frames into the chunks
+        # no ffmpeg, so no messages (the encoder's metrics read these)
+        self.stderr_lines = 0
+        self.stderr_tail = deque(maxlen=20)
+
+    def write_header(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.header, f, indent=1)
+        os.replace(tmp, self.filename)
+
+    def open_chunk(self):
+        self.close_chunk()
+        self.chunk += 1
+        self.chunk_file = open("{}.{:04d}".format(self.filename, self.chunk), 'w+b')
+        size = self.frames_per_chunk * self.frame_bytes
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self.chunk_file.fileno(), 0, size) # the blocks are allocated now, not page by page while recording
+        else:
+            self.chunk_file.truncate(size)
+        self.chunk_map = mmap.mmap(self.chunk_file.fileno(), size)
+        self.chunk_buf = np.frombuffer(self.chunk_map, dtype=np.uint8)
+        self.pos = 0
+
+    def close_chunk(self):
+        if self.chunk_file is None:
+            return
+        self.chunk_buf = None # the mapping can only be closed without views on it
+        self.chunk_map.close()
+        if self.pos < self.frames_per_chunk:
+            self.chunk_file.truncate(self.pos * self.frame_bytes)
+        self.chunk_file.close()
+        self.chunk_file = None
+        self.chunk_map = None
+
+    def write_frame(self, img_array, meta=None):
+        self.write_frames([img_array], meta)
+
+    def write_frames(self, img_arrays, meta=None):
+        """ Copies the frames into the chunks and appends their index records.
+            @param meta: per-frame information (FRAME_META_DTYPE records) for the index, None: only the host time
+        """
+        t = time.perf_counter()
+        records = np.zeros(len(img_arrays), dtype=RAW_INDEX_DTYPE)
+        for i, img_array in enumerate(img_arrays):
+            if img_array.nbytes != self.frame_bytes:
+                raise ValueError("Frame of {} bytes, the raw video {} has {} bytes per frame.".format(img_array.nbytes, self.filename, self.frame_bytes))
+            if self.chunk_file is None or self.pos == self.frames_per_chunk:
+                self.open_chunk()
+            offset = self.pos * self.frame_bytes
+            np.copyto(self.chunk_buf[offset:offset + self.frame_bytes], np.ascontiguousarray(img_array).reshape(-1).view(np.uint8))
+            records[i]['chunk'] = self.chunk
+            records[i]['offset'] = offset
+            self.pos += 1
+        if meta is not None:
+            for name in ('timestamp', 'block_id', 'host_time'):
+                records[name] = meta[name]
+        else:
+            records['host_time'] = time.time()
+        self.index.write(records.tobytes())
+        self.index.flush() # raw_size() reads the index size
+        self.frames += len(img_arrays)
+        self.write_seconds += time.perf_counter() - t
+        self.bytes_written += len(img_arrays) * self.frame_bytes
+
+    def close(self):
+        if self.index is None:
+            return
+        self.close_chunk()
+        self.index.close()
+        self.index = None
+        self.header.update({"frames": self.frames, "chunks": self.chunk + 1})
+        self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class RawVideo:
+    """ Reads a video written by RawFrameWriter (also one that was not closed, through its index)."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename) as f:
+            self.header = json.load(f)
+        self.index = np.fromfile(filename + ".idx", dtype=RAW_INDEX_DTYPE)
+        self.shape = (self.header["height"], self.header["width"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.fps = self.header["fps"]
+        self.chunks = dict() # number -> np.memmap, opened when first needed
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame(self, i):
+        """ Frame i as a read-only array (a view of the chunk file)."""
+        rec = self.index[i]
+        c = int(rec['chunk'])
+        if c not in self.chunks:
+            self.chunks[c] = np.memmap("{}.{:04d}".format(self.filename, c), dtype=np.uint8, mode='r')
+        offset = int(rec['offset'])
+        return self.chunks[c][offset:offset + self.header["frame_bytes"]].view(self.dtype).reshape(self.shape)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+def bench_raw_writer(out_dir, n=300, size=(1936, 1216), chunk_bytes=256 * 2**20):
+    """ Writes n frames, reads them back and checks them, and prints the write rate."""
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (size[1], size[0]), dtype=np.uint8) for _ in range(8)]
+    meta = np.zeros(n, dtype=[('host_time', '<f8'), ('timestamp', '<u8'), ('block_id', '<u8'), ('grab_index', '<u8')])
+    meta['block_id'] = np.arange(n) + 100
+    fname = os.path.join(out_dir, "bench_raw.raw")
+    t0 = time.perf_counter()
+    with RawFrameWriter(fname, size, 30, 'gray', chunk_bytes=chunk_bytes) as writer:
+        for i in range(0, n, 8):
+            writer.write_frames([frames[(i + k) % 8] for k in range(min(8, n - i))], meta[i:i + 8])
+    t = time.perf_counter() - t0
+    video = RawVideo(fname)
+    assert len(video) == n and all(np.array_equal(video.frame(i), frames[i % 8]) for i in range(n))
+    assert (video.index['block_id'] == meta['block_id']).all()
+    print("{} frames {}x{} in {} chunk(s): {:.0f} fps, {:.0f} MB/s (copy into the page cache, not necessarily on disk yet)".format(
+        n, size[0], size[1], video.header["chunks"], n / t, n * writer.frame_bytes / t / 1e6))
+    del video
+    for f in raw_files(fname):
+        os.remove(f)
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    bench_raw_writer(sys.argv[1] if len(sys.argv) > 1 else tempfile.gettempdir())
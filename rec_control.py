@@ -0,0 +1,170 @@
+"""
+    Starting and stopping recordings on cue, from the GUI and/or over a local
+    socket.
+
+    RecorderControl has one BaslerMouseRecorder at a time, in one of the states
+      idle       no recorder
+      arming     the recorder is being set up (USB reset, cameras, writers)
+      armed      cameras grabbing and writers running, nothing recorded yet
+      recording  between start and stop
+    start on an armed recorder only opens the gate for the frames (see
+    b_record_all_cams.py), so the videos begin with the first frame after the
+    cue. stop closes the gate at the next frame and waits until the files are
+    closed. With rearm=True the next recorder (a new session) is armed right
+    after a stop, ready for the next trial.
+
+    ControlServer takes one command per line on 127.0.0.1:<port> and answers
+    each with one line of JSON (state, session and the measured latencies):
+        arm | start | stop | status
+    e.g.  echo start | nc -q1 127.0.0.1 9109
+
+    python rec_control.py <video folder> [port]
+        arms a recorder (no preview) and serves the commands until Ctrl-C
+"""
+
+import json
+import socketserver
+import threading
+import time
+
+DEFAULT_CONTROL_PORT = 9109
+
+class RecorderControl:
+    """ Arms, starts and stops recorders made by make_recorder(), see above. Thread-safe."""
+
+    def __init__(self, make_recorder, rearm=False, arm_timeout=120.0, first_frame_timeout=1.0):
+        """
+            @param make_recorder: returns a new BaslerMouseRecorder (called in a background thread)
+            @param rearm: arm the next recorder as soon as one has stopped
+            @param arm_timeout: seconds start waits for a recorder that is still arming
+            @param first_frame_timeout: seconds start waits for the first frames, to report the start latency
+        """
+        self.make_recorder = make_recorder
+        self.rearm = rearm
+        self.arm_timeout = arm_timeout
+        self.first_frame_timeout = first_frame_timeout
+        self.lock = threading.Lock() # one command at a time, status does not wait for it
+        self.rec = None
+        self.arming = None # thread making and arming the next recorder
+        self.error = None # why the last arming failed
+        self.last = dict() # session and latencies of the last recording
+
+    def state(self):
+        if self.arming is not None and self.arming.is_alive():
+            return 'arming'
+        rec = self.rec
+        if rec is None or not rec.manager_thread.is_alive():
+            return 'idle'
+        if not rec.armed.is_set():
+            return 'arming'
+        if not rec.start_event.is_set():
+            return 'armed'
+        return 'recording'
+
+    def status(self):
+        rec = self.rec
+        return {"state": self.state(), "session": rec.fpre if rec is not None else None, "error": self.error, "last": self.last}
+
+    def make_and_arm(self):
+        try:
+            rec = self.make_recorder()
+            rec.arm_recording_thread()
+            self.rec = rec
+        except Exception as e:
+            self.error = "could not arm a recorder: {}".format(e)
+
+    def arm(self):
+        """ Arms a new recorder in the background, unless there is one already."""
+        with self.lock:
+            self.arm_locked()
+        return self.status()
+
+    def arm_locked(self):
+        if self.state() == 'idle':
+            self.error = None
+            self.rec = None
+            self.arming = threading.Thread(target=self.make_and_arm, daemon=True)
+            self.arming.start()
+
+    def wait_armed(self):
+        """ Waits until the recorder being armed is ready. Returns it, or None if arming failed or timed out."""
+        arming = self.arming
+        if arming is not None:
+            arming.join(self.arm_timeout)
+        rec = self.rec
+        if rec is None or not rec.wait_armed(self.arm_timeout):
+            return None
+        return rec
+
+    def start(self):
+        """ Starts the armed recorder (arms one first if there is none, which takes a while).
+        Returns the status with the time of the start and every camera's start latency."""
+        with self.lock:
+            self.arm_locked()
+            rec = self.wait_armed()
+            if rec is None:
+                return dict(self.status(), error=self.error or "the recorder could not be armed")
+            cue = rec.start_armed()
+        rec.first_frames_in.wait(self.first_frame_timeout)
+        first_frames = dict(rec.first_frame_t)
+        return dict(self.status(), start_time=cue, start_latency={serial: t - cue for serial, t in first_frames.items()})
+
+    def stop(self):
+        """ Stops the recording (or disarms the recorder) and returns the status with the measured latencies."""
+        with self.lock:
+            rec = self.rec
+            if rec is None or self.state() not in ('armed', 'recording'):
+                return dict(self.status(), error="nothing to stop")
+            started = rec.start_event.is_set()
+            latency = rec.stop_recording()
+            self.last = {"session": rec.fpre, "recorded": started, "latency": latency}
+            self.rec = None
+            if self.rearm:
+                self.arm_locked()
+        return self.status()
+
+    def command(self, name):
+        """ Runs a command by name (see above), returns the answer."""
+        commands = {"arm": self.arm, "start": self.start, "stop": self.stop, "status": self.status}
+        if name not in commands:
+            return {"error": "unknown command '{}', use one of {}".format(name, ", ".join(commands))}
+        return commands[name]()
+
+class ControlServer:
+    """ Serves the commands of a RecorderControl on localhost, one line each way per command."""
+
+    def __init__(self, control, port=DEFAULT_CONTROL_PORT):
+        control_ = control
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    name = line.decode(errors='replace').strip().lower()
+                    if name:
+                        self.wfile.write((json.dumps(control_.command(name), default=str) + "\n").encode())
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    import sys
+    from b_record_all_cams import BaslerMouseRecorder
+    vid_dir = sys.argv[1]
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_CONTROL_PORT
+    control = RecorderControl(lambda: BaslerMouseRecorder(vid_dir, show_preview=False), rearm=True)
+    control.arm()
+    server = ControlServer(control, port)
+    print("Listening on 127.0.0.1:{} (arm, start, stop, status).".format(port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    if control.state() in ('armed', 'recording'):
+        print(control.stop())
+    server.close()
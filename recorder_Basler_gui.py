@@ -9,12 +9,14 @@
     Also has a text entry field. Put the a path here to the directory
     where the resulting videos should be stored. If nothing is there,
     the hard coded default path will be used.
+    With pre_arm, the cameras and writers are set up when the window opens,
+    so Start begins the recording within a frame (see rec_control.py).
 """
 from tkinter import *
 import threading
 import platform
 from b_record_all_cams import BaslerMouseRecorder
-import time
+from rec_control import RecorderControl, ControlServer
 
 ffmpeg_command = 'C:\\Users\\Paul Mieske\\Desktop\\bmd_VidAud_hardwareTrigger_DavorVirag\\basler_gui_py\\ffmpeg\\bin\\ffmpeg.exe' if platform.system() == 'Windows' else 'ffmpeg'
 #ffmpeg_command = 'C:\\Users\\Davor\\ffmpeg\\bin\\ffmpeg.exe' if platform.system() == 'Windows' else 'ffmpeg'
@@ -25,6 +27,58 @@ use_bedsy = True
 # specify BeDSy's signal frequency
 bedsy_fps = 30
 
+# Encoder config
+# encoder profile for all cameras (see encoder_profiles.py), e.g. 'x264_ultrafast_gray', 'ffv1_gray', 'rawvideo', 'mjpeg',
+# or the old default 'x264_medium'. camera_profiles overrides it for single cameras: {'22334455': 'ffv1_gray'}
+encoder_profile = 'x264_ultrafast_gray'
+camera_profiles = {}
+# 'thread' encodes every camera in a thread of this process, 'process' in separate
+# worker processes (cameras_per_process cameras each), which scales better beyond ~4 cameras
+encoder_backend = 'thread'
+cameras_per_process = 1
+
+# Preview config
+# one mosaic window of all cameras, refreshed preview_fps times per second. False for headless runs.
+show_preview = True
+preview_fps = 4
+
+# Segment config (only without BeDSy, which requests its own rollovers)
+# start new video files every segment_seconds, or as soon as a camera's file reaches segment_bytes. None to not split by that.
+segment_seconds = None
+segment_bytes = None
+
+# Live metrics config
+# status_json: rewrite <date>_status.json in the video folder every second. metrics_port: serve Prometheus
+# metrics on http://127.0.0.1:<port>/metrics (None: off). See metrics.py.
+status_json = True
+metrics_port = None
+
+# USB reset before recording (see reset_USB.py): 'never', 'unhealthy' (cameras pylon does not list or that run
+# slower than USB 3), 'selected' (the serials in usb_reset_serials) or 'all' (the old behaviour)
+usb_reset = 'unhealthy'
+usb_reset_serials = []
+
+# 'Mono8' or 'Mono12p' (12 bit, 1.5 bytes per pixel over USB, unpacked to 16 bit for the video; see pixel_formats.py)
+pixel_format = 'Mono8'
+# leave frames without movement out of the videos (see activity_gate.py): None records every frame, {} uses the
+# defaults, e.g. {"idle_keep_every": 0} writes no frames at all while nothing moves
+activity_gate = None
+# spread the videos over several disks (see storage.py), e.g. ["/mnt/disk1/basler", "/mnt/disk2/basler"]; None: all in the result folder.
+# A volume with less than min_free_bytes left gets no new segments
+storage_volumes = None
+min_free_bytes = 5e9
+# how pylon hands out the frames (see grab_stats.py): 'OneByOne' loses none as long as the max_num_buffer buffers do not
+# run full; 'LatestImageOnly' (the old behaviour with BeDSy) drops frames when the recorder falls behind
+grab_strategy = 'OneByOne'
+max_num_buffer = 32
+# Start/stop config (see rec_control.py)
+# pre_arm: set up the cameras and writers when the window opens (and again after every stop, without preview), so Start
+# only has to let the frames through. control_port: also take arm/start/stop/status on 127.0.0.1:<port> (None: off)
+pre_arm = True
+control_port = None
+
+STATE_TEXT = {'idle': "Currently not recording", 'arming': "Getting ready", 'armed': "Ready to record", 'recording': "Currently recording"}
+
 class Rec_gui:
     def __init__(self, result_folder):# Recorder
         #self.rec = BaslerMouseRecorder(result_folder, ffmpeg=ffmpeg_command, use_bedsy=use_bedsy, bedsy_fps=bedsy_fps)
@@ -47,9 +101,36 @@ class Rec_gui:
         self.close_btn = Button(self.frame, text="Quit", command=self.quit_pressed)
         self.close_btn.grid(sticky='W', column=0, row=2)
 
+        self.folder = result_folder # read from the entry field in the Tk thread, for recorders made in the background
+        self.armed_folder = None
+        self.control = RecorderControl(self.make_recorder, rearm=pre_arm and not show_preview)
+        self.server = ControlServer(self.control, control_port) if control_port else None
+        if pre_arm:
+            self.control.arm()
+
         self.bind_keys()
 
+        self.window.after(200, self.show_state)
         self.window.mainloop()
+    def make_recorder(self):
+        self.armed_folder = self.folder
+        return BaslerMouseRecorder(self.folder if len(self.folder)>0 else None, ffmpeg=ffmpeg_command, use_bedsy=use_bedsy, bedsy_fps=bedsy_fps,
+                                   encoder_backend=encoder_backend, cameras_per_process=cameras_per_process,
+                                   show_preview=show_preview, preview_fps=preview_fps,
+                                   segment_seconds=segment_seconds, segment_bytes=segment_bytes,
+                                   encoder_profile=encoder_profile, camera_profiles=camera_profiles,
+                                   status_json=status_json, metrics_port=metrics_port,
+                                   usb_reset=usb_reset, usb_reset_serials=usb_reset_serials, pixel_format=pixel_format,
+                                   activity_gate=activity_gate, storage_volumes=storage_volumes, min_free_bytes=min_free_bytes,
+                                   grab_strategy=grab_strategy, max_num_buffer=max_num_buffer)
+    def show_state(self):
+        # the control port can start and stop recordings too
+        if self.btn['state'] != 'disabled':
+            self.folder = self.tb.get()
+            state = self.control.state()
+            self.lbl.configure(text=STATE_TEXT[state])
+            self.btn.configure(text="Stop" if state == 'recording' else "Start")
+        self.window.after(200, self.show_state)
     def bind_keys(self):
         self.window.bind('<Return>', self.enter_pressed)
         self.window.bind('q', self.q_pressed)
@@ -60,32 +141,37 @@ class Rec_gui:
         if self.btn['state'] == 'disabled': return
         self.unbind_all()
         self.btn.configure(state='disabled')
-        if self.lbl['text'] == "Currently recording":
-            self.lbl.configure(text="Currently not recording")
-            self.btn.configure(text="Start")
+        stopped = False
+        if self.control.state() == 'recording':
+            self.lbl.configure(text="Currently shutting down")
             self.frame.update()
-            #self.thread.thread_running = False
-            self.rec.stop_recording()
-            time.sleep(5) # give him time to log everything
+            self.control.stop() # returns when the files are closed and everything is logged
+            stopped = True
         else:
-            self.lbl.configure(text="Currently recording")
+            self.folder = self.tb.get()
+            if self.control.state() in ('arming', 'armed') and self.folder != self.armed_folder:
+                self.control.wait_armed()
+                self.control.stop() # armed for another folder, set up again
+            self.lbl.configure(text="Currently recording" if self.control.state() == 'armed' else "Getting ready")
             self.btn.configure(text="Stop")
             self.frame.update()
-            self.rec = BaslerMouseRecorder(self.tb.get() if len(self.tb.get())>0 else None, ffmpeg=ffmpeg_command, use_bedsy=use_bedsy, bedsy_fps=bedsy_fps)
-            #self.thread = threading.Thread(target=self.rec.start_recording, args=())
-            #self.thread.thread_running = True
-            #self.thread.daemon = True
-            #self.thread.start()
-            self.rec.start_recording_thread()
+            self.control.start()
         self.frame.update() # flush all the inputs that have been made while this was executing
         self.bind_keys()
         self.btn.configure(state='normal')
-        if self.lbl['text'] == "Currently not recording":
+        if stopped and show_preview:
             self.window.destroy() # have to do this currently, because the OpenCV preview window will not work the second time.
     def enter_pressed(self, event): self.btn_pressed()
     def quit_pressed(self):
-        if self.lbl['text'] == "Currently recording":
+        if self.control.state() == 'recording':
             self.btn_pressed()
+            if show_preview: return # the window is closed already
+        self.control.rearm = False
+        if self.control.state() in ('arming', 'armed'):
+            self.control.wait_armed()
+            self.control.stop()
+        if self.server is not None:
+            self.server.close()
         self.window.destroy()
     def q_pressed(self, event): self.quit_pressed()
 
@@ -6,6 +6,8 @@
     Can be call e.g. by Windows Task Scheduler. One has to hard code
     parameters like the duration of the recording in this script below.
     A window is opened while recording.
+    The videos are split into segments of segment_seconds (or segment_bytes),
+    so a long recording does not end up in one huge file per camera.
 """
 from tkinter import *
 import threading
@@ -15,12 +17,47 @@ import time
 
 ffmpeg_command = 'C:\\Users\\Paul Mieske\\Desktop\\work_videos\\B2_verhBeob\\Basler_Camera_Code\\ffmpeg-N-102753-gfcb80aa289-win64-gpl\\bin\\ffmpeg.exe' if platform.system() == 'Windows' else 'ffmpeg'
 
+# Encoder config
+# encoder profile for all cameras (see encoder_profiles.py), e.g. 'x264_ultrafast_gray', 'ffv1_gray', 'rawvideo', 'mjpeg',
+# or the old default 'x264_medium'. camera_profiles overrides it for single cameras: {'22334455': 'ffv1_gray'}
+encoder_profile = 'x264_ultrafast_gray'
+camera_profiles = {}
+
+# Segment config (free-run, without BeDSy)
+# start new video files every segment_seconds, or as soon as a camera's file reaches segment_bytes. None to not split by that.
+segment_seconds = 3600
+segment_bytes = None
+
+# Live metrics config
+# status_json: rewrite <date>_status.json in the video folder every second. metrics_port: serve Prometheus
+# metrics on http://127.0.0.1:<port>/metrics (None: off). See metrics.py.
+status_json = True
+metrics_port = 9108
+
+# USB reset before recording (see reset_USB.py): 'never', 'unhealthy' (cameras pylon does not list or that run
+# slower than USB 3), 'selected' (the serials in usb_reset_serials) or 'all' (the old behaviour)
+usb_reset = 'unhealthy'
+usb_reset_serials = []
+
+# 'Mono8' or 'Mono12p' (12 bit, 1.5 bytes per pixel over USB, unpacked to 16 bit for the video; see pixel_formats.py)
+pixel_format = 'Mono8'
+# leave frames without movement out of the videos (see activity_gate.py): None records every frame, {} uses the
+# defaults, e.g. {"idle_keep_every": 0} writes no frames at all while nothing moves
+activity_gate = None
+# spread the videos over several disks (see storage.py), e.g. ["/mnt/disk1/basler", "/mnt/disk2/basler"]; None: all in the result folder.
+# A volume with less than min_free_bytes left gets no new segments
+storage_volumes = None
+min_free_bytes = 5e9
+# how pylon hands out the frames (see grab_stats.py): 'OneByOne' loses none as long as the max_num_buffer buffers do not
+# run full; 'LatestImageOnly' (the old behaviour with BeDSy) drops frames when the recorder falls behind
+grab_strategy = 'OneByOne'
+max_num_buffer = 32
+
 class rec_gui:
     def __init__(self, result_folder, rec_time=None):
         """
             @param rec_time: time in seconds, that the recording should last. Program shuts down afterwards.
         """
-        self.rec = BaslerMouseRecorder(result_folder, ffmpeg=ffmpeg_command)
         # GUI
         self.window = Tk()
         self.window.title("Basler Cam Mouse Recorder (scripted)")
@@ -43,10 +80,14 @@ class rec_gui:
 
         self.bind_keys()
 
-        self.rec = BaslerMouseRecorder(self.tb.get() if len(self.tb.get())>0 else None, ffmpeg=ffmpeg_command)
-        self.thread = threading.Thread(target=self.rec.start_recording, args=())
-        self.thread.daemon = True
-        self.thread.start()
+        self.rec = BaslerMouseRecorder(self.tb.get() if len(self.tb.get())>0 else None, ffmpeg=ffmpeg_command,
+                                       segment_seconds=segment_seconds, segment_bytes=segment_bytes,
+                                       encoder_profile=encoder_profile, camera_profiles=camera_profiles,
+                                       status_json=status_json, metrics_port=metrics_port,
+                                       usb_reset=usb_reset, usb_reset_serials=usb_reset_serials, pixel_format=pixel_format,
+                                       activity_gate=activity_gate, storage_volumes=storage_volumes, min_free_bytes=min_free_bytes,
+                                       grab_strategy=grab_strategy, max_num_buffer=max_num_buffer)
+        self.rec.start_recording_thread()
 
         if rec_time:
             self.window.after(rec_time*1000, self.quit_pressed)
@@ -64,8 +105,7 @@ class rec_gui:
         self.close_btn.configure(state='disabled')
         self.lbl.configure(text="Currently shutting down")
         self.frame.update()
-        self.rec.stop_recording()
-        time.sleep(5) # give him time to log everything
+        self.rec.stop_recording() # returns when the files are closed and everything is logged
         self.frame.update() # flush all the inputs that have been made while this was executing
         self.window.destroy()
     def enter_pressed(self, event): self.btn_pressed()
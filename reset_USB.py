@@ -4,49 +4,72 @@
     adjusted by Niek Andresen for Basler Cams and added windows support, March 2020
 
     For resetting the USB port that a Basler Camera is attached to.
+
+    On Linux, the Basler devices (vendor 2676, any model) are found in sysfs,
+    which is cheaper than running lsusb and has the serial number and the link
+    speed of each device. Which cameras are reset depends on the mode:
+      'all'        every Basler camera (the old behaviour)
+      'unhealthy'  cameras pylon does not list (visible_serials) and cameras that
+                   run at less than USB 3 speed
+      'selected'   the cameras with the given serial numbers
+      'never'      none
+    The resets are sent at the same time, then the cameras are polled until
+    they are back (at most timeout seconds; pass list_serials, e.g. a pylon
+    enumeration, to wait until they can be opened again, not only for the USB
+    device). The functions return a report (which cameras were reset, which
+    did not come back, how long it took).
 """
 
+import glob
+import os
 import platform
+import threading
+import time
 # Equivalent of the _IO('U', 20) constant in the linux kernel.
 USBDEVFS_RESET = ord('U') << (4*2) | 20
 
+BASLER_VENDOR_ID = 0x2676
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+RESET_MODES = ('never', 'unhealthy', 'selected', 'all')
+
+def read_sysfs_attr(path, name):
+    try:
+        with open(os.path.join(path, name)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def find_baslers_sysfs(root=SYSFS_USB_DEVICES):
+    """ All Basler USB devices as dicts with serial, product id, speed (Mbit/s) and devfs path."""
+    result = []
+    for path in sorted(glob.glob(os.path.join(root, "*"))):
+        vendor = read_sysfs_attr(path, "idVendor")
+        if vendor is None or int(vendor, 16) != BASLER_VENDOR_ID:
+            continue
+        busnum, devnum = read_sysfs_attr(path, "busnum"), read_sysfs_attr(path, "devnum")
+        if busnum is None or devnum is None:
+            continue
+        speed = read_sysfs_attr(path, "speed")
+        result.append({"serial": read_sysfs_attr(path, "serial"), "product": read_sysfs_attr(path, "idProduct"),
+                       "speed": float(speed) if speed else None, "sysfs": path,
+                       "devfs": "/dev/bus/usb/{:03d}/{:03d}".format(int(busnum), int(devnum))})
+    return result
 
 def get_basler():
     """
-        Gets the devfs path to a basler camera by scraping the output
-        of the lsusb command
-        
-        The lsusb command outputs a list of USB devices attached to a computer
-        in the format:
-            Bus 002 Device 009: ID 16c0:0483 Van Ooijen Technische Informatica Teensyduino Serial
-            Bus 002 Device 014: ID 8086:0ad3 Intel Corp.
-        The devfs path to these devices is:
-            /dev/bus/usb/<busnum>/<devnum>
-        So for the above device, it would be:
-            /dev/bus/usb/002/009
-        This function generates that path.
+        Gets the devfs paths to the basler cameras (/dev/bus/usb/<busnum>/<devnum>).
+        Used to scrape the output of lsusb, now reads sysfs (see find_baslers_sysfs).
     """
-    import subprocess
-    results = []
-    proc = subprocess.run(['lsusb'], stdout=subprocess.PIPE, universal_newlines=True)
-    lines = proc.stdout.split('\n')
-    for line in lines:
-        if '2676:ba02' in line: # ace acA1920-40um
-            parts = line.split()
-            bus = parts[1]
-            dev = parts[3][:3]
-            results.append("/dev/bus/usb/{}/{}".format(bus, dev))
-    return results
+    return [dev["devfs"] for dev in find_baslers_sysfs()]
 
 
 def send_reset(dev_path):
     """
         Sends the USBDEVFS_RESET IOCTL to a USB device.
-        
+
         dev_path - The devfs path to the USB device (under /dev/bus/usb/)
                    See get_basler for example of how to obtain this.
     """
-    import os
     import fcntl
     fd = os.open(dev_path, os.O_WRONLY)
     try:
@@ -54,21 +77,124 @@ def send_reset(dev_path):
     finally:
         os.close(fd)
 
-def reset_baslers_linux():
+def select_for_reset(devices, mode, serials=None, visible_serials=None, min_speed=5000):
+    """ The devices to reset in this mode, as (device, reason) pairs. In mode 'unhealthy', a device whose
+    serial number cannot be read (on Windows with the pylon driver) is not reset, see unchecked_devices().
+        @param visible_serials: serial numbers pylon lists (mode 'unhealthy'), None: not checked
+        @param min_speed: link speed in Mbit/s below which a camera is unhealthy (5000 = USB 3)
+    """
+    if mode not in RESET_MODES:
+        raise ValueError("Unknown USB reset mode '{}', available: {}".format(mode, ", ".join(RESET_MODES)))
+    result = []
+    for dev in devices:
+        if mode == 'all':
+            result.append((dev, "all"))
+        elif mode == 'selected' and serials and dev["serial"] in serials:
+            result.append((dev, "selected"))
+        elif mode == 'unhealthy':
+            if dev["serial"] is None:
+                continue # cannot tell whether pylon lists it
+            if visible_serials is not None and dev["serial"] not in visible_serials:
+                result.append((dev, "not listed by pylon"))
+            elif dev["speed"] is not None and dev["speed"] < min_speed:
+                result.append((dev, "running at {:g} Mbit/s".format(dev["speed"])))
+    return result
+
+def unchecked_devices(devices, mode):
+    """ The devices whose health mode 'unhealthy' cannot check (serial number unknown)."""
+    return [dev for dev in devices if dev["serial"] is None] if mode == 'unhealthy' else []
+
+def serials_to_wait_for(selected, errors, listed_before):
+    """ The serials to be listed again after the resets: those of the reset devices and, if a reset
+    device's serial is unknown, all that were listed before (it can be any of them)."""
+    reset = [dev for (dev, reason), err in zip(selected, errors) if err is None]
+    serials = {dev["serial"] for dev in reset if dev["serial"]}
+    if any(not dev["serial"] for dev in reset):
+        serials |= set(listed_before)
+    return sorted(serials)
+
+def reset_parallel(items, reset):
+    """ Calls reset(item) for all items at the same time. Returns the error message per item (None if it worked)."""
+    errors = dict()
+    def run(i, item):
+        try:
+            reset(item)
+            errors[i] = None
+        except Exception as e:
+            errors[i] = str(e) or type(e).__name__
+    threads = [threading.Thread(target=run, args=(i, item), daemon=True) for i, item in enumerate(items)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return [errors[i] for i in range(len(items))]
+
+def wait_for_serials(serials, list_serials, timeout=10.0, interval=0.05):
+    """ Polls list_serials() until all serials are listed or timeout seconds have passed.
+    Returns the serials that are still missing and the seconds waited."""
+    t0 = time.perf_counter()
+    missing = set(serials)
+    while True:
+        missing = set(serials) - set(list_serials())
+        if not missing or time.perf_counter() - t0 >= timeout:
+            return sorted(missing), time.perf_counter() - t0
+        time.sleep(interval)
+
+def reset_report(found, selected, errors, missing, seconds, unchecked=()):
+    return {"found": len(found), "reset": [{"serial": dev["serial"], "reason": reason, "error": err} for (dev, reason), err in zip(selected, errors)],
+            "missing": missing, "seconds": seconds, "unchecked": [dev["product"] for dev in unchecked]}
+
+def reset_report_str(report):
+    if not report["reset"]:
+        result = "USB reset: none of the {} Basler camera(s) needed a reset".format(report["found"])
+    else:
+        result = "USB reset of {} of {} Basler camera(s) ({}) took {:.2f} s".format(
+            len(report["reset"]), report["found"], ", ".join("{}: {}".format(r["serial"], r["error"] or r["reason"]) for r in report["reset"]), report["seconds"])
+    if report["missing"]:
+        result += ", not back: {}".format(", ".join(str(s) for s in report["missing"]))
+    if report.get("unchecked"):
+        result += "; {} camera(s) not checked, their serial number cannot be read over USB (mode 'all' resets them)".format(len(report["unchecked"]))
+    return result + "."
+
+def reset_baslers_linux(mode='all', serials=None, visible_serials=None, timeout=10.0, list_serials=None):
     """
-        Finds a basler cam and reset it.
+        Resets the basler cams selected by mode (see above) and waits until they are back.
     """
-    baslers = get_basler()
-    for ba in baslers:
-        send_reset(ba)
+    found = find_baslers_sysfs()
+    selected = select_for_reset(found, mode, serials, visible_serials)
+    list_serials = list_serials or (lambda: [dev["serial"] for dev in find_baslers_sysfs() if dev["serial"]])
+    listed_before = list_serials() if any(not dev["serial"] for dev, reason in selected) else []
+    t0 = time.perf_counter()
+    errors = reset_parallel([dev["devfs"] for dev, reason in selected], send_reset)
+    missing, _ = wait_for_serials(serials_to_wait_for(selected, errors, listed_before), list_serials, timeout)
+    return reset_report(found, selected, errors, missing, time.perf_counter() - t0, unchecked_devices(found, mode))
 
-def reset_baslers_windows():
+def reset_baslers_windows(mode='all', serials=None, visible_serials=None, timeout=10.0, list_serials=None):
     from usb.core import find as finddev
-    devs = finddev(find_all=True, custom_match=lambda dev: (dev.idVendor == 0x2676 and dev.idProduct == 0xba02)) # Basler ace acA1920-40um
-    for dev in devs: dev.reset()
+    def find_all():
+        result = []
+        for dev in finddev(find_all=True, idVendor=BASLER_VENDOR_ID):
+            try:
+                serial = dev.serial_number
+            except Exception: # needs a driver that allows reading string descriptors
+                serial = None
+            result.append({"serial": serial, "product": "{:04x}".format(dev.idProduct), "speed": None, "usb": dev})
+        return result
+    found = find_all()
+    selected = select_for_reset(found, mode, serials, visible_serials)
+    list_serials = list_serials or (lambda: [dev["serial"] for dev in find_all() if dev["serial"]])
+    listed_before = list_serials() if any(not dev["serial"] for dev, reason in selected) else []
+    t0 = time.perf_counter()
+    errors = reset_parallel([dev["usb"] for dev, reason in selected], lambda usb: usb.reset())
+    missing, _ = wait_for_serials(serials_to_wait_for(selected, errors, listed_before), list_serials, timeout)
+    return reset_report(found, selected, errors, missing, time.perf_counter() - t0, unchecked_devices(found, mode))
 
 if __name__=="__main__":
+    import sys
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'all'
+    serials = sys.argv[2:]
     if platform.system() == 'Windows':
-        reset_baslers_windows()
+        report = reset_baslers_windows(mode, serials)
     else:
-        reset_baslers_linux()
+        report = reset_baslers_linux(mode, serials)
+    print(reset_report_str(report))
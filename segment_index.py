@@ -0,0 +1,77 @@
+"""
+    Per-session index of the video segments, one CSV line per closed segment:
+    camera, segment number, video and sidecar file name, first and last frame
+    (grab index counted over the whole session), number of frames written and
+    dropped, and host time (time.time()) of the first and last frame.
+
+    A line is written and flushed as soon as a segment's file is complete, so
+    after a crash the index still lists every finished segment.
+
+    The file names are relative to the index's folder, or absolute for videos
+    on another volume (see storage.py), so os.path.join(folder, name) finds
+    them either way.
+"""
+
+import csv
+import os
+import threading
+
+SEGMENT_INDEX_FIELDS = ["serial", "segment", "filename", "sidecar", "first_frame", "last_frame",
+                        "frames", "dropped", "start_time", "end_time"]
+
+def segment_index_filename(vid_dir, fpre):
+    """ <vid_dir>/2023-10-05_12-00-00_segments.csv"""
+    return os.path.join(str(vid_dir), fpre + "_segments.csv")
+
+class SegmentIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock() # segments are closed from background threads
+        self.filep = open(filename, 'w', newline='')
+        self.writer = csv.DictWriter(self.filep, fieldnames=SEGMENT_INDEX_FIELDS)
+        self.writer.writeheader()
+        self.filep.flush()
+
+    def index_path(self, filename):
+        """ filename as written to the index: relative if it is in the index's folder, else absolute."""
+        filename = os.path.abspath(filename)
+        if os.path.dirname(filename) == os.path.dirname(os.path.abspath(self.filename)):
+            return os.path.basename(filename)
+        return filename
+
+    def add(self, serial, info):
+        """ Adds a segment, info is what FrameEncoder reports when it closes one."""
+        row = {"serial": serial, "segment": info["segment"],
+               "filename": self.index_path(info["filename"]), "sidecar": self.index_path(info["sidecar"]),
+               "first_frame": info["first_grab_index"], "last_frame": info["last_grab_index"],
+               "frames": info["frames"], "dropped": info["dropped"],
+               "start_time": "" if info["first_host_time"] is None else "{:.6f}".format(info["first_host_time"]),
+               "end_time": "" if info["last_host_time"] is None else "{:.6f}".format(info["last_host_time"])}
+        with self.lock:
+            if self.filep is None:
+                return
+            self.writer.writerow(row)
+            self.filep.flush()
+
+    def close(self):
+        with self.lock:
+            if self.filep:
+                self.filep.close()
+                self.filep = None
+
+def read_segment_index(filename):
+    """ Returns the segments as a list of dicts, numbers converted, sorted by camera and segment."""
+    with open(filename, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for key in ("segment", "first_frame", "last_frame", "frames", "dropped"):
+            row[key] = int(row[key]) if row[key] != "" else None
+        for key in ("start_time", "end_time"):
+            row[key] = float(row[key]) if row[key] != "" else None
+    rows.sort(key=lambda r: (r["serial"], r["segment"]))
+    return rows
+
+if __name__ == '__main__':
+    import sys
+    for row in read_segment_index(sys.argv[1]):
+        print("{serial} {segment:4d} {filename}: frames {first_frame}-{last_frame} ({frames} written, {dropped} dropped)".format(**row))
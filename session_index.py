@@ -0,0 +1,262 @@
+"""
+    Session-level frame table: which frame of each camera belongs to the same
+    instant (or, with BeDSy, to the same trigger).
+
+    It is built from the session's segment index and the sidecars of its
+    segments (see segment_index.py and frame_sidecar.py), plus the messages
+    BeDSy sent during the recording ("bedsy" events in <date>_events.jsonl).
+    Each row of the table is one trigger (or one frame of the reference camera
+    without BeDSy) and has, per camera, the segment and the position of the
+    frame in that segment's video, its camera timestamp and host time (-1 and
+    NaN where the camera has no frame).
+
+    The cameras are aligned
+      by trigger  (BeDSy) a camera's trigger count is its BlockID counted from
+                  its first frame, shifted if that first frame came a whole
+                  frame interval after the other cameras' first frames
+      by time     (free run) the frames of the other cameras closest in host
+                  time to those of the camera with the most frames, if they
+                  are at most half a frame interval away; of several frames
+                  of one camera close to the same frame (jitter, a slightly
+                  faster camera) only the closest is in the table
+
+    The table is stored column by column in <date>_frames.npz next to the
+    segment index. frames_at(t) and frame_row(i) look up frames with a binary
+    search over the row times.
+
+    python session_index.py <date>_segments.csv [host time]
+    python session_index.py --check    checks the alignment by time
+"""
+
+import os
+import numpy as np
+
+from frame_sidecar import read_sidecar
+from segment_index import read_segment_index
+
+def frame_table_filename(segments_csv):
+    """ <folder>/2023-10-05_12-00-00_segments.csv -> <folder>/2023-10-05_12-00-00_frames.npz"""
+    return segments_csv[:-len("_segments.csv")] + "_frames.npz"
+
+def events_filename(segments_csv):
+    return segments_csv[:-len("_segments.csv")] + "_events.jsonl"
+
+def read_bedsy_messages(events_file):
+    """ The BeDSy messages of a session as (host time, BeDSy time, message) tuples."""
+    from logger import read_events
+    return [(r["host_time"], r["bedsy_time"], r["message"]) for r in read_events(events_file, "bedsy")]
+
+def camera_frames(segments_csv):
+    """ Per camera, all frames of the session as columns: segment, position in the segment's
+    video, session grab index, host time, camera timestamp and BlockID. Also returns the
+    file names per (serial, segment)."""
+    vid_dir = os.path.dirname(os.path.abspath(segments_csv))
+    parts = dict()
+    files = dict()
+    for row in read_segment_index(segments_csv):
+        files[(row["serial"], row["segment"])] = row["filename"]
+        records = read_sidecar(os.path.join(vid_dir, row["sidecar"]))
+        parts.setdefault(row["serial"], []).append((row, records))
+    result = dict()
+    for serial, segments in parts.items():
+        result[serial] = {
+            "segment": np.concatenate([np.full(len(r), row["segment"], dtype=np.int32) for row, r in segments]),
+            "frame": np.concatenate([np.arange(len(r), dtype=np.int64) for row, r in segments]),
+            "grab_index": np.concatenate([row["first_frame"] + r['frame_index'].astype(np.int64) for row, r in segments]),
+            "host_time": np.concatenate([r['host_time'] for row, r in segments]),
+            "timestamp": np.concatenate([r['timestamp'] for row, r in segments]),
+            "block_id": np.concatenate([r['block_id'].astype(np.int64) for row, r in segments]),
+        }
+    return result, files
+
+def frame_interval(host_times):
+    """ Median time between frames (None for fewer than two frames)."""
+    if len(host_times) < 2:
+        return None
+    return float(np.median(np.diff(host_times)))
+
+def align_by_trigger(frames):
+    """ Row of every frame per camera, a row being a trigger count."""
+    firsts = {serial: f["host_time"][0] for serial, f in frames.items() if len(f["host_time"])}
+    intervals = [frame_interval(f["host_time"]) for f in frames.values()]
+    interval = np.median([i for i in intervals if i]) if any(intervals) else None
+    t0 = min(firsts.values()) if firsts else 0.0
+    rows = dict()
+    for serial, f in frames.items():
+        offset = int(round((firsts[serial] - t0) / interval)) if interval and serial in firsts else 0
+        rows[serial] = f["block_id"] - (f["block_id"][0] if len(f["block_id"]) else 0) + offset
+    return rows
+
+def align_by_time(frames):
+    """ Row of every frame per camera, a row being a frame of the camera with the most frames (-1: no row)."""
+    ref = max(frames, key=lambda s: len(frames[s]["host_time"]))
+    ref_times = frames[ref]["host_time"]
+    tolerance = (frame_interval(ref_times) or float('inf')) / 2
+    rows = {ref: np.arange(len(ref_times), dtype=np.int64)}
+    for serial, f in frames.items():
+        if serial == ref:
+            continue
+        if not len(ref_times):
+            rows[serial] = np.full(len(f["host_time"]), -1, dtype=np.int64)
+            continue
+        # the closest reference frame: the one before or the one after
+        after = np.clip(np.searchsorted(ref_times, f["host_time"]), 0, len(ref_times) - 1)
+        before = np.clip(after - 1, 0, len(ref_times) - 1)
+        closest = np.where(np.abs(ref_times[before] - f["host_time"]) <= np.abs(ref_times[after] - f["host_time"]), before, after)
+        distance = np.abs(ref_times[closest] - f["host_time"])
+        row = np.where(distance <= tolerance, closest, -1)
+        # one frame per row: of several frames matching the same reference frame only the closest stays
+        matched = np.flatnonzero(row >= 0)
+        order = matched[np.lexsort((distance[matched], row[matched]))] # by row, then by distance
+        row[order[1:][row[order[1:]] == row[order[:-1]]]] = -1
+        rows[serial] = row
+    return rows
+
+class SessionIndex:
+    """ The frame table of a session, see above. Build it with SessionIndex.build() or load a saved one."""
+
+    def __init__(self, serials, columns, files, messages, align, vid_dir="."):
+        self.serials = list(serials)
+        self.columns = columns # name -> array, one entry per row ("<serial>.frame", ...)
+        self.files = files # (serial, segment) -> video file name
+        self.messages = messages # (host time, BeDSy time, message) in the order they came
+        self.message_times = np.array([m[0] for m in messages], dtype=np.float64)
+        self.align = align
+        self.vid_dir = vid_dir
+        # rows are in trigger/frame order, their times could step back by jitter
+        self.search_times = np.maximum.accumulate(columns["time"]) if len(columns["time"]) else columns["time"]
+
+    @classmethod
+    def build(cls, segments_csv, messages=None, align=None):
+        """ Builds the table of a session.
+            @param messages: the BeDSy messages as (host time, BeDSy time, message), None: from the session's events file
+            @param align: 'trigger' or 'time', None: by trigger if BeDSy sent messages
+        """
+        if messages is None:
+            events = events_filename(segments_csv)
+            messages = read_bedsy_messages(events) if os.path.exists(events) else []
+        align = align or ('trigger' if messages else 'time')
+        if align not in ('trigger', 'time'):
+            raise ValueError("Unknown alignment '{}', use 'trigger' or 'time'.".format(align))
+        frames, files = camera_frames(segments_csv)
+        serials = sorted(frames)
+        rows = align_by_trigger(frames) if align == 'trigger' else align_by_time(frames)
+        n = max([int(r.max()) + 1 for r in rows.values() if len(r)] + [0])
+        columns = dict()
+        used = np.zeros(n, dtype=bool)
+        time_sum = np.zeros(n)
+        time_count = np.zeros(n)
+        for serial in serials:
+            f, r = frames[serial], rows[serial]
+            keep = r >= 0
+            r = r[keep]
+            if len(np.unique(r)) != len(r):
+                raise ValueError("Camera {} has several frames in one row of the frame table.".format(serial))
+            used[r] = True
+            for name, dtype, missing in (("segment", np.int32, -1), ("frame", np.int64, -1), ("grab_index", np.int64, -1),
+                                         ("timestamp", np.uint64, 0), ("host_time", np.float64, np.nan)):
+                column = np.full(n, missing, dtype=dtype)
+                column[r] = f[name][keep]
+                columns["{}.{}".format(serial, name)] = column
+            np.add.at(time_sum, r, f["host_time"][keep])
+            np.add.at(time_count, r, 1)
+        rows_used = np.flatnonzero(used)
+        columns = {name: c[rows_used] for name, c in columns.items()}
+        columns["trigger"] = rows_used.astype(np.int64)
+        columns["time"] = time_sum[rows_used] / time_count[rows_used] # mean host time of the cameras' frames
+        message_times = np.array([m[0] for m in messages], dtype=np.float64)
+        columns["message"] = (np.searchsorted(message_times, columns["time"], 'right') - 1).astype(np.int32)
+        return cls(serials, columns, files, list(messages), align, os.path.dirname(os.path.abspath(segments_csv)))
+
+    def save(self, filename):
+        arrays = dict(self.columns)
+        arrays["serials"] = np.array(self.serials)
+        arrays["align"] = np.array(self.align)
+        arrays["files.serial"] = np.array([s for s, seg in self.files], dtype=str)
+        arrays["files.segment"] = np.array([seg for s, seg in self.files], dtype=np.int32)
+        arrays["files.filename"] = np.array(list(self.files.values()), dtype=str)
+        arrays["messages.host_time"] = self.message_times
+        arrays["messages.bedsy_time"] = np.array([str(m[1]) for m in self.messages], dtype=str)
+        arrays["messages.text"] = np.array([m[2] for m in self.messages], dtype=str)
+        tmp = filename + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            serials = [str(s) for s in data["serials"]]
+            columns = {name: data[name] for name in data.files
+                       if name in ("trigger", "time", "message") or name.split(".")[0] in serials}
+            files = {(str(s), int(seg)): str(f) for s, seg, f in zip(data["files.serial"], data["files.segment"], data["files.filename"])}
+            messages = list(zip(data["messages.host_time"].tolist(), data["messages.bedsy_time"].tolist(), data["messages.text"].tolist()))
+            align = str(data["align"])
+        return cls(serials, columns, files, messages, align, os.path.dirname(os.path.abspath(filename)))
+
+    def __len__(self):
+        return len(self.columns["time"])
+
+    def row_at(self, t):
+        """ Index of the last row at or before host time t (-1 if t is before the first)."""
+        return int(np.searchsorted(self.search_times, t, 'right')) - 1
+
+    def frames_at(self, t):
+        """ The frame of each camera that was current at host time t (see frame_row), None before the first frame."""
+        i = self.row_at(t)
+        return self.frame_row(i) if i >= 0 else None
+
+    def frame_row(self, i):
+        """ Row i: trigger, time, the latest BeDSy message and per camera its frame
+        (video file, position in the video, segment, timestamp, host time) or None."""
+        c = self.columns
+        message = int(c["message"][i])
+        result = {"row": i, "trigger": int(c["trigger"][i]), "time": float(c["time"][i]),
+                  "message": self.messages[message][2] if message >= 0 else None, "frames": dict()}
+        for serial in self.serials:
+            frame = int(c[serial + ".frame"][i])
+            if frame < 0:
+                result["frames"][serial] = None
+                continue
+            segment = int(c[serial + ".segment"][i])
+            result["frames"][serial] = {"filename": os.path.join(self.vid_dir, self.files[(serial, segment)]), "frame": frame,
+                                        "segment": segment, "grab_index": int(c[serial + ".grab_index"][i]),
+                                        "timestamp": int(c[serial + ".timestamp"][i]), "host_time": float(c[serial + ".host_time"][i])}
+        return result
+
+    def summary_str(self):
+        complete = sum(np.count_nonzero(self.columns[s + ".frame"] >= 0) for s in self.serials)
+        missing = len(self) * len(self.serials) - complete
+        return "{} rows ({}) for {} camera(s), {} frame(s) missing, {} BeDSy message(s)".format(
+            len(self), "by trigger" if self.align == 'trigger' else "by time", len(self.serials), missing, len(self.messages))
+
+def check_align_by_time(seconds=60, seed=1):
+    """ Aligns a 30 fps camera and one running 2 % faster that starts later (fewer frames, so it is
+    not the reference), both with host time jitter. Checks that every row has at most one frame of
+    the faster camera, the closest of those matching it, and returns (aligned, frames)."""
+    rng = np.random.default_rng(seed)
+    ref_times = np.sort(np.arange(0, seconds, 1 / 30.0) + rng.normal(0, 0.003, int(np.ceil(seconds * 30))))
+    other_times = np.arange(2.0, seconds, 1 / 30.6)
+    other_times = np.sort(other_times + rng.normal(0, 0.003, len(other_times)))
+    rows = align_by_time({"ref": {"host_time": ref_times}, "other": {"host_time": other_times}})["other"]
+    aligned = rows[rows >= 0]
+    assert len(np.unique(aligned)) == len(aligned), "several frames of a camera in one row"
+    tolerance = frame_interval(ref_times) / 2
+    closest = np.argmin(np.abs(other_times[:, None] - ref_times[None, :]), axis=1)
+    for r in range(len(ref_times)):
+        candidates = np.flatnonzero((closest == r) & (np.abs(other_times - ref_times[r]) <= tolerance))
+        expected = candidates[np.argmin(np.abs(other_times[candidates] - ref_times[r]))] if len(candidates) else None
+        got = np.flatnonzero(rows == r)
+        assert list(got) == ([] if expected is None else [expected]), "row {}: frames {}, expected {}".format(r, got, expected)
+    return len(aligned), len(other_times)
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1] == '--check':
+        print("Alignment by time: {} of {} frames of the faster camera in a row, at most one per row.".format(*check_align_by_time()))
+        sys.exit(0)
+    segments_csv = sys.argv[1]
+    index = SessionIndex.build(segments_csv)
+    index.save(frame_table_filename(segments_csv))
+    print("{}: {}".format(frame_table_filename(segments_csv), index.summary_str()))
+    if len(sys.argv) > 2:
+        print(SessionIndex.load(frame_table_filename(segments_csv)).frames_at(float(sys.argv[2])))
@@ -0,0 +1,243 @@
+"""
+    Spreads the videos of a recording over several volumes (disks) and keeps
+    them from running full.
+
+    A volume is a folder, normally on a disk of its own. StorageManager first
+    measures how fast each volume takes data (measure_bytes written to a
+    temporary file and fsynced). For every new video file, choose() then takes
+    the volume
+      - with room for the file: its free space, minus what is reserved for
+        files not closed yet, has to exceed the expected size plus min_free_bytes
+      - among those, with the most throughput to spare: the measured write
+        speed minus the expected bytes per second of the cameras whose next
+        file is on it (ties: the most free space)
+    so the cameras are spread by throughput, and a volume that fills up gets
+    no new files (if none has room, the one with the most free space).
+
+    reserve() counts the space of the chosen file as taken. On Linux the
+    writer preallocates the file when it creates it (fallocate with
+    FALLOC_FL_KEEP_SIZE: the blocks are taken, the file stays empty and ffmpeg
+    writes into it with -truncate 0, see create_writer in encoder_profiles.py),
+    so the file is not scattered over the disk and nothing else can take its
+    space. That happens in the process that writes the file, after a writer
+    prepared for the same file and replaced has removed it. closed() gives back the blocks a
+    file did not use and counts the bytes written per volume; the achieved
+    MB/s of a volume is that over the time since the start.
+
+    low_volumes() are the volumes with less than min_free_bytes left (after the
+    reservations); the recorder moves the cameras writing to them to other
+    volumes with an early rollover (see b_record_all_cams.py).
+
+    python storage.py <folder> [<folder> ...]
+        measures the write speed and free space of the folders
+"""
+
+import ctypes
+import os
+import platform
+import shutil
+import threading
+import time
+
+from encoder_profiles import writer_files
+from raw_writer import raw_size
+
+FALLOC_FL_KEEP_SIZE = 1
+# space planned for a file whose length is not known in advance (BeDSy or unsegmented recordings)
+DEFAULT_FILE_SECONDS = 600
+
+def preallocate(filename, nbytes):
+    """ Reserves the blocks for nbytes without changing the size of the file (created if needed).
+    Returns False where that is not possible (not Linux, file system without fallocate, disk full)."""
+    if platform.system() != 'Linux' or nbytes <= 0:
+        return False
+    try:
+        fallocate = ctypes.CDLL(None, use_errno=True).fallocate
+    except (OSError, AttributeError):
+        return False
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        return fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, int(nbytes)) == 0
+    finally:
+        os.close(fd)
+
+def release_preallocation(filename):
+    """ Frees the blocks preallocated beyond the end of the file."""
+    try:
+        os.truncate(filename, os.path.getsize(filename))
+    except OSError:
+        pass
+
+def video_size(filename):
+    """ Bytes of a video written so far (all files of a raw video)."""
+    if filename.endswith(".raw"):
+        return raw_size(filename)
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def measure_write_speed(folder, nbytes=64 * 2**20, block_bytes=4 * 2**20):
+    """ Bytes per second written and fsynced to a temporary file in folder (random data, which a file system cannot compress)."""
+    fname = os.path.join(folder, ".write_test_{}".format(os.getpid()))
+    block = os.urandom(block_bytes)
+    written = 0
+    t0 = time.perf_counter()
+    try:
+        with open(fname, 'wb', buffering=0) as f:
+            while written < nbytes:
+                written += f.write(block)
+            os.fsync(f.fileno())
+        t = time.perf_counter() - t0
+    finally:
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+    return written / t if t > 0 else None
+
+class Volume:
+    def __init__(self, folder):
+        self.folder = str(folder)
+        self.measured_bytes_per_second = None
+        self.pending = dict() # file not closed yet -> bytes reserved for it but not preallocated
+        self.preallocated = dict() # file not closed yet -> bytes its writer preallocates
+        self.files = 0 # closed files
+        self.bytes_written = 0 # by the closed files
+
+    def free(self):
+        try:
+            return shutil.disk_usage(self.folder).free
+        except OSError:
+            return 0
+
+    def available(self):
+        """ Free space minus what the open files will still need."""
+        return self.free() - sum(self.pending.values())
+
+class StorageManager:
+    """ Chooses the volume of every new video file, see above. Thread-safe, files are closed from background threads."""
+
+    def __init__(self, folders, min_free_bytes=5e9, preallocate=True, measure_bytes=64 * 2**20):
+        """
+            @param folders: one folder per volume, created if needed
+            @param min_free_bytes: space to leave free on every volume
+            @param preallocate: reserve the blocks of every new file (Linux)
+            @param measure_bytes: bytes written to measure each volume's speed (0: not measured, the volumes count as equally fast)
+        """
+        self.volumes = [Volume(folder) for folder in folders]
+        self.min_free_bytes = min_free_bytes
+        self.preallocate = preallocate
+        self.lock = threading.Lock()
+        self.next_volume = dict() # serial -> volume of its latest chosen file
+        self.rates = dict() # serial -> expected bytes per second
+        for v in self.volumes:
+            os.makedirs(v.folder, exist_ok=True)
+            if measure_bytes:
+                v.measured_bytes_per_second = measure_write_speed(v.folder, measure_bytes)
+        self.start_t = time.time()
+
+    def volume_of(self, filename):
+        folder = os.path.dirname(os.path.abspath(filename))
+        for v in self.volumes:
+            if os.path.abspath(v.folder) == folder:
+                return v
+        return None
+
+    def spare_bytes_per_second(self, volume, serial=None):
+        """ Measured speed minus what the cameras (except serial) will write to the volume."""
+        load = sum(self.rates[s] for s, v in self.next_volume.items() if v is volume and s != serial)
+        return (volume.measured_bytes_per_second or 0.0) - load
+
+    def choose(self, serial, nbytes, bytes_per_second):
+        """ The volume for the next file of this camera (nbytes expected, written at bytes_per_second)."""
+        with self.lock:
+            self.rates[serial] = bytes_per_second
+            available = {v: v.available() for v in self.volumes}
+            candidates = [v for v in self.volumes if available[v] >= nbytes + self.min_free_bytes]
+            if candidates:
+                volume = max(candidates, key=lambda v: (self.spare_bytes_per_second(v, serial), available[v]))
+            else:
+                volume = max(self.volumes, key=lambda v: available[v])
+            self.next_volume[serial] = volume
+            return volume
+
+    def fits(self, volume, nbytes):
+        return volume.available() >= nbytes + self.min_free_bytes
+
+    def reserve(self, filename, nbytes, allocate=True):
+        """ Counts nbytes of the volume as taken by this file until it is closed. Its writer preallocates
+        them where possible (see preallocation(); allocate=False for writers that allocate their files themselves)."""
+        volume = self.volume_of(filename)
+        with self.lock:
+            if self.preallocate and allocate and platform.system() == 'Linux' and nbytes > 0:
+                volume.preallocated[filename] = int(nbytes)
+            else:
+                volume.pending[filename] = nbytes
+
+    def preallocation(self, filename):
+        """ Bytes the writer of this file should preallocate when it creates it (0: none)."""
+        volume = self.volume_of(filename)
+        if volume is None:
+            return 0
+        with self.lock:
+            return volume.preallocated.get(filename, 0)
+
+    def forget(self, filename):
+        """ The file was not used (a prepared writer that was replaced)."""
+        volume = self.volume_of(filename)
+        if volume is None:
+            return
+        with self.lock:
+            volume.pending.pop(filename, None)
+            volume.preallocated.pop(filename, None)
+
+    def closed(self, filename):
+        """ The file is complete: gives back its unused blocks and counts it. Returns its size in bytes."""
+        volume = self.volume_of(filename)
+        if volume is None:
+            return 0
+        if filename in volume.preallocated:
+            release_preallocation(filename)
+        size = 0
+        for f in writer_files(filename):
+            try:
+                size += os.path.getsize(f)
+            except OSError:
+                pass
+        with self.lock:
+            volume.pending.pop(filename, None)
+            volume.preallocated.pop(filename, None)
+            volume.files += 1
+            volume.bytes_written += size
+        return size
+
+    def low_volumes(self):
+        """ The volumes with less than min_free_bytes left."""
+        with self.lock:
+            return [v for v in self.volumes if v.available() < self.min_free_bytes]
+
+    def status(self):
+        """ Per volume: free space, measured and achieved write speed (including the open files), files and cameras."""
+        elapsed = max(time.time() - self.start_t, 1e-9)
+        result = []
+        with self.lock:
+            for v in self.volumes:
+                written = v.bytes_written + sum(video_size(f) for f in list(v.pending) + list(v.preallocated))
+                result.append({"folder": v.folder, "free_bytes": v.free(), "measured_bytes_per_second": v.measured_bytes_per_second,
+                               "achieved_bytes_per_second": written / elapsed, "bytes_written": written, "files": v.files,
+                               "serials": sorted(s for s, nv in self.next_volume.items() if nv is v)})
+        return result
+
+    def status_str(self):
+        return "; ".join("{}: {:.2f} GB written in {} file(s), {:.1f} MB/s achieved{}, {:.1f} GB free".format(
+            s["folder"], s["bytes_written"] / 1e9, s["files"], s["achieved_bytes_per_second"] / 1e6,
+            " (takes {:.0f} MB/s)".format(s["measured_bytes_per_second"] / 1e6) if s["measured_bytes_per_second"] else "",
+            s["free_bytes"] / 1e9) for s in self.status())
+
+if __name__ == '__main__':
+    import sys
+    storage = StorageManager(sys.argv[1:], min_free_bytes=0, preallocate=False)
+    for v in storage.volumes:
+        print("{}: writes {:.0f} MB/s, {:.1f} GB free".format(v.folder, v.measured_bytes_per_second / 1e6, v.free() / 1e9))
@@ -0,0 +1,255 @@
+"""
+    Compresses the segments of finished sessions for the archive.
+
+    Sessions recorded raw ('raw_mmap') or lossless ('ffv1_gray', 'rawvideo')
+    take a lot of disk. This tool reads a session's segment index
+    (<date>_segments.csv), encodes every raw or lossless segment with an
+    archive profile (default 'x264_archive_gray', see encoder_profiles.py) and
+    checks that each new video has exactly as many frames as the index says
+    were written. Segments of other profiles are already compressed and are
+    copied as they are.
+
+    The results go to <session folder>/archive: the videos under the same
+    names (with the profile's extension), a copy of each sidecar, and, once
+    every segment is verified, a segment index that lists the new files.
+
+    Segments are encoded in a pool of processes, at most one per available
+    core, and ffmpeg gets the remaining cores as threads. A video is written
+    under a temporary name and only renamed after it was verified, and every
+    verified segment is recorded in <date>_transcode.json in the archive
+    folder. An interrupted run therefore simply starts again: verified
+    segments are skipped, half-written ones are encoded again.
+
+    Frames are counted with ffprobe, or with ffmpeg if there is no ffprobe
+    next to it or on the PATH (e.g. the ffmpeg of imageio-ffmpeg).
+
+    python transcode_batch.py <session folder or segments.csv> ... [--profile x264_archive_gray] [--jobs N] [--delete-source]
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import shutil
+import subprocess as sp
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from b_read_vid import ffprobe_command
+from encoder_profiles import ENCODER_PROFILES, create_writer, profile_extension, profile_writer_args, writer_files
+from frame_sidecar import sidecar_filename
+from segment_index import SEGMENT_INDEX_FIELDS, read_segment_index
+
+ARCHIVE_PROFILE = 'x264_archive_gray'
+LOSSLESS_CODECS = ('ffv1', 'rawvideo')
+WRITE_BATCH = 16 # frames per write when encoding a raw video
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def probe_video(filename, ffmpeg='ffmpeg', ffprobe=None):
+    """ Codec, pixel format and number of frames of the first video stream (packets with ffprobe, decoded frames with ffmpeg)."""
+    if ffprobe:
+        out = sp.run([ffprobe, '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+                      '-show_entries', 'stream=codec_name,pix_fmt,nb_read_packets', '-of', 'json', filename],
+                     stdout=sp.PIPE, stderr=sp.PIPE, check=True).stdout
+        streams = json.loads(out)["streams"]
+        if not streams:
+            raise ValueError("{} has no video stream.".format(filename))
+        return {"codec": streams[0].get("codec_name"), "pix_fmt": streams[0].get("pix_fmt"),
+                "frames": int(streams[0].get("nb_read_packets", 0))}
+    # without ffprobe: decode the video to nowhere and read ffmpeg's progress report
+    proc = sp.run([ffmpeg, '-hide_banner', '-nostats', '-i', filename, '-map', '0:v:0',
+                   '-f', 'null', '-progress', 'pipe:1', '-'], stdout=sp.PIPE, stderr=sp.PIPE, check=True)
+    frames = re.findall(r'^frame=(\d+)', proc.stdout.decode(errors='replace'), re.M)
+    stream = re.search(r'Video: (\w+)[^,]*, (\w+)', proc.stderr.decode(errors='replace'))
+    if stream is None:
+        raise ValueError("{} has no video stream.".format(filename))
+    return {"codec": stream.group(1), "pix_fmt": stream.group(2), "frames": int(frames[-1]) if frames else 0}
+
+def part_filename(out):
+    """ archive/x_rec_0000.avi -> archive/x_rec_0000.part.avi (ffmpeg picks the format by the extension)"""
+    stem, ext = os.path.splitext(out)
+    return stem + ".part" + ext
+
+def encode_raw(src, out, profile, ffmpeg, threads):
+    from raw_writer import RawVideo
+    video = RawVideo(src)
+    size = (video.header["width"], video.header["height"])
+    args = profile_writer_args(profile, video.header["pixfmt"])
+    with create_writer(filename=out, size=size, fps=video.fps, pixfmt=video.header["pixfmt"],
+                       ffmpeg_command=ffmpeg, threads=threads, **args) as writer:
+        for i in range(0, len(video), WRITE_BATCH):
+            writer.write_frames([video.frame(k) for k in range(i, min(i + WRITE_BATCH, len(video)))])
+    return len(video)
+
+def encode_video(src, out, profile, ffmpeg, threads, pix_fmt):
+    args = profile_writer_args(profile, pix_fmt)
+    cmd = [ffmpeg, '-y', '-loglevel', 'error', '-i', src, '-map', '0:v:0', '-an', '-vcodec', args["codec"]]
+    if args["preset"] is not None:
+        cmd.extend(['-preset', args["preset"]])
+    cmd.extend(args["ffmpeg_params"])
+    cmd.extend(['-threads', str(threads), '-pix_fmt', args["out_pixfmt"], out])
+    proc = sp.run(cmd, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    if proc.returncode != 0:
+        raise IOError("ffmpeg failed on {}: {}".format(src, proc.stderr.decode(errors='replace').strip()[-500:]))
+
+def transcode_segment(src, out, expected_frames, profile, ffmpeg='ffmpeg', ffprobe=None, threads=1):
+    """ Encodes one segment into out (via a temporary file) and checks its number of frames.
+    Runs in a worker process. Returns a result dict; status 'verified', 'mismatch' or 'failed'."""
+    result = {"source": src, "output": out, "expected_frames": expected_frames, "frames": None, "seconds": None, "error": None, "copied": False}
+    part = part_filename(out)
+    t0 = time.perf_counter()
+    try:
+        if src.endswith(".raw"):
+            encode_raw(src, part, profile, ffmpeg, threads)
+        else:
+            info = probe_video(src, ffmpeg, ffprobe)
+            if info["codec"] in LOSSLESS_CODECS:
+                encode_video(src, part, profile, ffmpeg, threads, info["pix_fmt"])
+            else: # already compressed, encoding it again would only lose quality
+                shutil.copy2(src, part)
+                result["copied"] = True
+        result["frames"] = probe_video(part, ffmpeg, ffprobe)["frames"]
+    except Exception as e:
+        result.update(status="failed", error=str(e) or type(e).__name__)
+        if os.path.exists(part):
+            os.remove(part)
+        return result
+    result["seconds"] = time.perf_counter() - t0
+    if expected_frames is not None and result["frames"] != expected_frames:
+        result.update(status="mismatch", error="{} frames, the segment index has {}".format(result["frames"], expected_frames))
+        return result # the part file stays for inspection, it is replaced by the next run
+    os.replace(part, out)
+    result["status"] = "verified"
+    return result
+
+class TranscodeManifest:
+    """ The verified segments of a session, in <archive>/<date>_transcode.json, rewritten after every segment."""
+
+    def __init__(self, filename, profile):
+        self.filename = filename
+        self.profile = profile
+        self.segments = dict() # source file name -> result
+        if os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            if data.get("profile") == profile: # another profile: start over
+                self.segments = data.get("segments", dict())
+
+    def is_verified(self, name, out):
+        return self.segments.get(name, dict()).get("status") == "verified" and os.path.exists(out)
+
+    def add(self, name, result):
+        self.segments[name] = {k: v for k, v in result.items() if k != "source"}
+        self.save()
+
+    def save(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"profile": self.profile, "segments": self.segments}, f, indent=1)
+        os.replace(tmp, self.filename)
+
+def session_prefix(segments_csv):
+    """ <folder>/2023-10-05_12-00-00_segments.csv -> 2023-10-05_12-00-00"""
+    return os.path.basename(segments_csv)[:-len("_segments.csv")]
+
+def find_sessions(paths):
+    """ The segment index files of the given session folders or index files."""
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            result.extend(sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith("_segments.csv")))
+        else:
+            result.append(path)
+    return result
+
+def write_archive_index(filename, rows, outputs):
+    """ The session's segment index with the archived file names."""
+    tmp = filename + ".tmp"
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SEGMENT_INDEX_FIELDS)
+        writer.writeheader()
+        for row in rows:
+            row = dict(row)
+            row["filename"] = os.path.basename(outputs.get(row["filename"], row["filename"]))
+            row["sidecar"] = os.path.basename(sidecar_filename(row["filename"])) # copied next to the archived video
+            writer.writerow({k: "" if row[k] is None else row[k] for k in SEGMENT_INDEX_FIELDS})
+    os.replace(tmp, filename)
+
+def transcode_session(segments_csv, profile=ARCHIVE_PROFILE, out_dir=None, jobs=None, ffmpeg='ffmpeg', delete_source=False):
+    """ Archives the raw and lossless segments of one session (see above).
+        @param out_dir: folder for the results, None: <session folder>/archive
+        @param jobs: segments encoded at the same time, None: one per available core
+        @param delete_source: remove a segment's original video once its archived copy is verified
+        @return: the results of this run, one dict per segment that was not already verified
+    """
+    if ENCODER_PROFILES[profile].get("writer", "ffmpeg") != "ffmpeg":
+        raise ValueError("Encoder profile '{}' does not compress, choose another one for the archive.".format(profile))
+    vid_dir = os.path.dirname(os.path.abspath(segments_csv))
+    out_dir = out_dir or os.path.join(vid_dir, "archive")
+    os.makedirs(out_dir, exist_ok=True)
+    fpre = session_prefix(segments_csv)
+    rows = read_segment_index(segments_csv)
+    manifest = TranscodeManifest(os.path.join(out_dir, fpre + "_transcode.json"), profile)
+    ffprobe = ffprobe_command(ffmpeg)
+    outputs = dict() # source file name -> archived file
+    todo = []
+    for row in rows:
+        src = os.path.join(vid_dir, row["filename"])
+        out = os.path.join(out_dir, os.path.splitext(os.path.basename(row["filename"]))[0] + "." + profile_extension(profile))
+        if manifest.is_verified(row["filename"], out):
+            outputs[row["filename"]] = out
+        elif os.path.exists(src):
+            todo.append((row, src, out))
+        else:
+            print("{}: missing, not archived".format(row["filename"]))
+    cores = available_cores()
+    jobs = max(1, min(jobs or cores, cores, len(todo) or 1))
+    threads = max(1, cores // jobs)
+    print("{}: {} segment(s) to encode with '{}', {} already archived, {} job(s) with {} thread(s) each".format(
+        fpre, len(todo), profile, len(outputs), jobs, threads))
+    results = []
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(transcode_segment, src, out, row["frames"], profile, ffmpeg, ffprobe, threads): row
+                   for row, src, out in todo}
+        for future in as_completed(futures):
+            row = futures[future]
+            result = future.result()
+            results.append(result)
+            if result["status"] == "verified":
+                sidecar = os.path.join(vid_dir, row["sidecar"])
+                if os.path.exists(sidecar):
+                    shutil.copy2(sidecar, os.path.join(out_dir, os.path.basename(sidecar_filename(result["output"]))))
+                manifest.add(row["filename"], result)
+                outputs[row["filename"]] = result["output"]
+                if delete_source:
+                    for f in writer_files(result["source"]):
+                        if os.path.exists(f):
+                            os.remove(f)
+                print("{}: {} frames {} in {:.1f} s -> {} ({:.1f} MB)".format(row["filename"], result["frames"], "copied" if result["copied"] else "encoded",
+                                                                           result["seconds"], result["output"], os.path.getsize(result["output"]) / 1e6))
+            else:
+                print("{}: {} ({})".format(row["filename"], result["status"], result["error"]))
+    if len(outputs) == len(rows):
+        write_archive_index(os.path.join(out_dir, fpre + "_segments.csv"), rows, outputs)
+        print("{}: all {} segment(s) archived in {} ({:.1f} s)".format(fpre, len(rows), out_dir, time.perf_counter() - t0))
+    else:
+        print("{}: {} of {} segment(s) archived, run again to retry the others".format(fpre, len(outputs), len(rows)))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compress raw and lossless recordings for the archive and verify them.")
+    parser.add_argument("sessions", nargs='+', help="session folders or <date>_segments.csv files")
+    parser.add_argument("--profile", default=ARCHIVE_PROFILE, choices=sorted(ENCODER_PROFILES))
+    parser.add_argument("--out", default=None, help="output folder (default: <session folder>/archive)")
+    parser.add_argument("--jobs", type=int, default=None, help="segments encoded at the same time (default: available cores)")
+    parser.add_argument("--ffmpeg", default='ffmpeg')
+    parser.add_argument("--delete-source", action='store_true', help="delete the original videos after verification")
+    args = parser.parse_args()
+    for segments_csv in find_sessions(args.sessions):
+        transcode_session(segments_csv, args.profile, args.out, args.jobs, args.ffmpeg, args.delete_source)